@@ -1,11 +1,18 @@
+import os
 from pyramid.config import Configurator
-from pyramid.settings import aslist
+from pyramid.tweens import EXCVIEW
+from pyramid.settings import aslist, asbool
 import pymongo
 from gridfs import GridFS
 import pyes
 from audrey.resources import root_factory, root
+from audrey.renderers import HALRenderer
+from audrey.mongoutil import parse_write_concern
+from audrey import indexqueue
+from audrey import outbox
+from audrey import elasticindex
 
-from pyramid.renderers import JSON
+import atexit
 import datetime
 from bson.objectid import ObjectId
 from bson.dbref import DBRef
@@ -27,14 +34,23 @@ def audrey_main(root_factory, root_cls, global_config, **settings):
     # If "elastic_name" setting not found, fallback to "mongo_name".
     if 'elastic_name' not in settings:
         settings['elastic_name'] = settings['mongo_name']
+    # If "search_cursor_secret" setting not found, use a random one
+    # (so cursors only work with the process that made them).
+    if not settings.get('search_cursor_secret'):
+        settings['search_cursor_secret'] = os.urandom(32).encode('hex')
 
-    elastic_basic_auth_username = settings.get('elastic_basic_auth_username')
-    elastic_basic_auth_password = settings.get('elastic_basic_auth_password')
+    # Parse write concern settings ("write_concern" and
+    # "write_concern.<collection name>").
+    for (key, value) in settings.items():
+        if key == 'write_concern' or key.startswith('write_concern.'):
+            settings[key] = parse_write_concern(value)
 
     # Standard Pyramid ZCML configuration.
     config = Configurator(root_factory=root_factory, settings=settings)
 
-    json_renderer = JSON()
+    # Like Pyramid's JSON renderer, but can stream generators of items
+    # and can negotiate binary encodings (msgpack, BSON) of HAL responses.
+    json_renderer = HALRenderer()
     def datetime_adapter(obj, request):
         return obj.isoformat()
     json_renderer.add_adapter(datetime.datetime, datetime_adapter)
@@ -48,36 +64,71 @@ def audrey_main(root_factory, root_cls, global_config, **settings):
         return ret
     json_renderer.add_adapter(DBRef, dbref_adapter)
     config.add_renderer('json', json_renderer)
+    # Compress HAL and JSON Schema responses (see "compress_*" settings).
+    config.add_tween('audrey.tweens.compression_tween_factory')
+    # Optionally write each request's saves and deletes in bulk
+    # (see "auto_unit_of_work" setting).
+    config.add_tween('audrey.tweens.unit_of_work_tween_factory', under=EXCVIEW)
 
     zcml_file = settings.get('configure_zcml', 'configure.zcml')
     config.include('pyramid_zcml')
     config.load_zcml(zcml_file)
 
     # Do initialization based on custom settings.
-    mongo_conn = pymongo.Connection(mongo_uri, tz_aware=True)
-    mongo_db = mongo_conn[settings['mongo_name']]
-    # Note that for simplicity we use one GridFS (the default "fs")
-    # for the entire DB/webapp.
-    gridfs = GridFS(mongo_db)
-    config.registry.settings['mongo_conn'] = mongo_conn
-    config.registry.settings['mongo_db'] = mongo_db
-    config.registry.settings['gridfs'] = gridfs
+    config.registry.settings.update(make_connections(settings))
+    mongo_db = config.registry.settings['mongo_db']
     ensure_mongo_indexes(mongo_db, root_cls)
 
     # Not all projects will use Elastic.
-    elastic_conn = None
-    if elastic_uri:
-        basic_auth = None
-        if elastic_basic_auth_username:
-            basic_auth = dict(username=elastic_basic_auth_username,
-                              password=elastic_basic_auth_password)
-        elastic_conn = pyes.ES(elastic_uri, basic_auth=basic_auth)
+    elastic_conn = config.registry.settings['elastic_conn']
+    if elastic_conn is not None:
         ensure_elastic_index(elastic_conn, settings['elastic_name'], root_cls)
-    config.registry.settings['elastic_conn'] = elastic_conn
+
+    # Optionally leave ElasticSearch writes to a consumer of a durable
+    # outbox or to a background worker (see "elastic_outbox" and
+    # "elastic_index_queue" settings).
+    index_queue = None
+    if elastic_conn is not None and asbool(settings.get('elastic_outbox', False)):
+        index_queue = outbox.Outbox(mongo_db[settings.get('elastic_outbox_collection', outbox.DEFAULT_COLLECTION_NAME)],
+            write_concern=settings.get('write_concern'))
+        index_queue.ensure_indexes()
+    elif elastic_conn is not None and asbool(settings.get('elastic_index_queue', False)):
+        index_queue = indexqueue.IndexQueue(config.registry, root_cls,
+            make_elastic_connection(settings),
+            maxsize=int(settings.get('elastic_index_queue_size', indexqueue.DEFAULT_MAXSIZE)),
+            batch_size=int(settings.get('elastic_index_queue_batch_size', indexqueue.DEFAULT_BATCH_SIZE)))
+        index_queue.start()
+        atexit.register(index_queue.stop)
+    config.registry.settings['index_queue'] = index_queue
 
     # Finally, return a wsgi app.
     return config.make_wsgi_app()
 
+def make_connections(settings):
+    """ Return new connections for the app's (type converted) settings,
+    as a dictionary with the keys "mongo_conn", "mongo_db", "gridfs"
+    and "elastic_conn" (which may be ``None``).
+    """
+    mongo_conn = pymongo.Connection(settings['mongo_uri'], tz_aware=True)
+    mongo_db = mongo_conn[settings['mongo_name']]
+    # Note that for simplicity we use one GridFS (the default "fs")
+    # for the entire DB/webapp.
+    gridfs = GridFS(mongo_db)
+    return dict(mongo_conn=mongo_conn, mongo_db=mongo_db, gridfs=gridfs,
+                elastic_conn=make_elastic_connection(settings))
+
+def make_elastic_connection(settings):
+    """ Return a new ElasticSearch connection for the app's (type converted)
+    settings, or ``None`` if the app doesn't use Elastic.
+    """
+    if not settings['elastic_uri']:
+        return None
+    basic_auth = None
+    if settings.get('elastic_basic_auth_username'):
+        basic_auth = dict(username=settings['elastic_basic_auth_username'],
+                          password=settings.get('elastic_basic_auth_password'))
+    return pyes.ES(settings['elastic_uri'], basic_auth=basic_auth)
+
 def ensure_mongo_indexes(db, root_cls):
     for coll_cls in root_cls.get_collection_classes():
         mongo_coll = db[coll_cls._collection_name]
@@ -85,14 +136,8 @@ def ensure_mongo_indexes(db, root_cls):
             mongo_coll.ensure_index(key_or_list, **kwargs)
 
 def ensure_elastic_index(conn, idx_name, root_cls):
-    # Not working w/ pyes-0.19.1
-    # See https://github.com/aparo/pyes/issues/69
-    #conn.indices.create_index_if_missing(idx_name)
-    if not conn.indices.exists_index(idx_name):
-        conn.indices.create_index(idx_name)
-    for coll_cls in root_cls.get_collection_classes():
-        if coll_cls._use_elastic:
-            conn.indices.put_mapping(coll_cls._collection_name, {'properties':coll_cls.get_elastic_mapping()}, [idx_name])
+    # idx_name is an alias for a versioned index.
+    elasticindex.ensure_index(conn, idx_name, root_cls)
 
 def main(global_config, **settings):  # pragma: no cover
     return audrey_main(root_factory, root.Root, global_config, **settings)
@@ -0,0 +1,146 @@
+import time
+from pyes.exceptions import IndexMissingException
+from audrey import dateutil
+
+# An app's ElasticSearch index name (the "elastic_name" setting) is an
+# alias for a versioned index named like "<alias>_20121224015245281000".
+# While a new version is being built by rebuild_index(), the alias
+# "<alias>_rebuild" points to it, so that writes go to both versions.
+REBUILD_ALIAS_SUFFIX = '_rebuild'
+
+# How long (in seconds) each process caches the names of the indices
+# to write to.  rebuild_index() waits this long after creating a new
+# version before filling it.
+WRITE_INDEX_NAMES_TTL = 5
+
+# Cached write index names: alias -> (expiration time, names)
+_write_index_names_cache = {}
+
+def make_index_name(alias):
+    """ Return a name for a new version of the index with the given alias.
+
+    :rtype: string
+    """
+    return '%s_%s' % (alias, dateutil.utcnow().strftime('%Y%m%d%H%M%S%f'))
+
+def get_alias_indices(conn, alias):
+    """ Return the names of the indices that ``alias`` refers to
+    (``[alias]`` if it's the name of an index instead of an alias,
+    or an empty list if there's no such alias or index).
+
+    :rtype: list of strings
+    """
+    try:
+        return sorted(conn.indices.get_alias(alias))
+    except IndexMissingException:
+        return []
+
+def put_mappings(conn, index_names, root_cls):
+    """ Put the mappings of the collections of ``root_cls``
+    (see :meth:`audrey.resources.collection.Collection.get_elastic_mapping`)
+    in the named indices.
+    """
+    for coll_cls in root_cls.get_collection_classes():
+        if coll_cls._use_elastic:
+            conn.indices.put_mapping(coll_cls._collection_name, {'properties':coll_cls.get_elastic_mapping()}, index_names)
+
+def create_index(conn, index_name, root_cls):
+    """ Create an index with the mappings of the collections of ``root_cls``.
+    """
+    conn.indices.create_index(index_name)
+    put_mappings(conn, [index_name], root_cls)
+
+def ensure_index(conn, alias, root_cls):
+    """ Make sure there's an index for the app.
+    If ``alias`` doesn't exist, a new versioned index is created
+    and ``alias`` is pointed at it.  Otherwise the mappings are put in
+    the existing index (which fails if they aren't compatible; use
+    :func:`rebuild_index` to change them).
+    """
+    index_names = get_alias_indices(conn, alias)
+    if index_names:
+        put_mappings(conn, index_names, root_cls)
+    else:
+        index_name = make_index_name(alias)
+        create_index(conn, index_name, root_cls)
+        conn.indices.add_alias(alias, [index_name])
+
+def get_write_index_names(conn, alias):
+    """ Return the names of the indices (or aliases) that writes
+    should go to: ``alias`` and the new version of the index being built
+    by :func:`rebuild_index` (if any).
+    Cached for :data:`WRITE_INDEX_NAMES_TTL` seconds.
+
+    :rtype: list of strings
+    """
+    now = time.time()
+    cached = _write_index_names_cache.get(alias)
+    if cached is not None and cached[0] > now:
+        return cached[1]
+    names = [alias] + get_alias_indices(conn, alias + REBUILD_ALIAS_SUFFIX)
+    _write_index_names_cache[alias] = (now + WRITE_INDEX_NAMES_TTL, names)
+    return names
+
+def rebuild_index(root, keep_old=False, delay=WRITE_INDEX_NAMES_TTL, **kwargs):
+    """ Rebuild the app's ElasticSearch index without interrupting searches.
+
+    A new version of the index is created with the current mappings and
+    filled (by :meth:`audrey.resources.root.Root.reindex_all`, which is
+    passed the other keyword arguments, such as ``processes``).
+    Meanwhile, searches keep using the old version and writes go to both.
+    Since a copy of an object read while filling the new version may be
+    written after a newer copy from a save (or after its deletion), the
+    new version is then caught up with the objects modified since the
+    fill started and those deleted meanwhile (see
+    :meth:`audrey.resources.root.Root.reindex_modified`); this leaves
+    only the much shorter catch-up itself open to the same race.
+    Then the app's alias is switched to the new version in one atomic
+    step, and the old version is deleted (unless ``keep_old``).
+
+    If the app's index name is an index instead of an alias (as created
+    by older versions of Audrey), that index has to be deleted just
+    before the alias is added, so searches fail briefly (only once).
+
+    :param root: the app root
+    :type root: :class:`audrey.resources.root.Root`
+    :param keep_old: Should the old version(s) of the index be kept?
+    :type keep_old: boolean
+    :param delay: seconds to wait for all processes to notice the new version before filling it
+    :type delay: number
+    :rtype: dictionary with the keys "index" (the new index name), "count" (the number of objects indexed) and "caught_up" (the counts returned by the catch-up)
+    """
+    from audrey.resources.collection import REINDEX_CHECKPOINT_MARGIN
+    conn = root.get_elastic_connection()
+    alias = root.get_elastic_index_name()
+    rebuild_alias = alias + REBUILD_ALIAS_SUFFIX
+    old_index_names = get_alias_indices(conn, alias)
+    index_name = make_index_name(alias)
+    create_index(conn, index_name, root.__class__)
+    conn.indices.add_alias(rebuild_alias, [index_name])
+    old_index_deleted = False
+    try:
+        time.sleep(delay)
+        since = dateutil.utcnow() - REINDEX_CHECKPOINT_MARGIN
+        count = root.reindex_all(index_name=index_name, **kwargs)
+        catch_up_kwargs = dict([(key, kwargs[key]) for key in ('bulk_size', 'rate_limit') if key in kwargs])
+        caught_up = root.reindex_modified(since=since, save_checkpoint=False, index_name=index_name, **catch_up_kwargs)
+        commands = [('remove', name, alias) for name in old_index_names if name != alias]
+        commands.append(('add', index_name, alias))
+        commands.append(('remove', index_name, rebuild_alias))
+        if alias in old_index_names:
+            conn.indices.delete_index(alias)
+            old_index_deleted = True
+        conn.indices.change_aliases(commands)
+    except:
+        # Deleting the new index also deletes its aliases.
+        # (Keep it if it's all that's left.)
+        if not old_index_deleted:
+            conn.indices.delete_index(index_name)
+        raise
+    finally:
+        _write_index_names_cache.pop(alias, None)
+    if not keep_old:
+        for name in old_index_names:
+            if name != alias:
+                conn.indices.delete_index(name)
+    return dict(index=index_name, count=count, caught_up=caught_up)
@@ -7,3 +7,42 @@ class Veto(Exception):
     """
     def __init__(self, msg):
         Exception.__init__(self, msg)
+
+class CommitError(Exception):
+    """ Raised by :meth:`audrey.unitofwork.UnitOfWork.commit` when some of
+    the pending writes failed.
+    The ``errors`` attribute is a list of ``(object, message)`` tuples,
+    one for each failed write.  The other writes are not undone.
+    """
+    def __init__(self, errors):
+        Exception.__init__(self, "; ".join([msg for (obj, msg) in errors]))
+        self.errors = errors
+
+class ReindexError(Exception):
+    """ Raised by a parallel reindex (see :func:`audrey.parallel.reindex_collections`)
+    when some of the ``_id`` ranges failed.
+    The ``count`` attribute is the number of objects that were reindexed.
+    The ``failures`` attribute is a list of
+    ``(collection name, start_after, up_to, traceback)`` tuples,
+    one for each failed range (see :meth:`audrey.resources.collection.Collection.reindex_all`).
+    """
+    def __init__(self, count, failures):
+        Exception.__init__(self, "%d ranges failed to reindex" % len(failures))
+        self.count = count
+        self.failures = failures
+
+class PreconditionFailed(Exception):
+    """ Raised by conditional writes (such as
+    :meth:`audrey.resources.object.Object.save` with ``if_match``)
+    when the stored object has changed (or no longer exists).
+    """
+    def __init__(self, msg):
+        Exception.__init__(self, msg)
+
+class OutboxError(Exception):
+    """ Raised by :meth:`audrey.outbox.Outbox.apply` when none of the
+    change records could be written because ElasticSearch reported
+    errors for all of them.
+    """
+    def __init__(self, msg):
+        Exception.__init__(self, msg)
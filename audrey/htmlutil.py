@@ -10,6 +10,9 @@ def sniff_html(s):
 #  Originally based on code in The Python Cookbook, recipe 10.8
 
 import htmllib, formatter, cStringIO
+import hashlib
+import threading
+from collections import OrderedDict
 import htmlentitydefs
 import re
 
@@ -82,9 +85,12 @@ class HTML_to_text_parser(htmllib.HTMLParser):
 
 SELF_CLOSING_FIX_RE = re.compile(r'(\S)/>')
 
+# The original implementation of html_to_text(), based on htmllib.
+# It's slower, but kept for comparison (see the audrey_htmlbench
+# console script and the tests).
 # Assumes html is a Unicode string or UTF-8 encoded.
 # The return value is the same type as the input.
-def html_to_text(html, show_link_urls=False, skip_tags=('head', 'script'), unknown_entity_replacement=None):
+def legacy_html_to_text(html, show_link_urls=False, skip_tags=('head', 'script'), unknown_entity_replacement=None):
     output_unicode = False
     if type(html) == unicode:
         html = html.encode('utf-8')
@@ -105,3 +111,220 @@ def html_to_text(html, show_link_urls=False, skip_tags=('head', 'script'), unkno
     del textout, formtext, parser
     if output_unicode: return unicode(text, 'utf-8')
     else: return text
+
+# A faster HTML to text converter.  It produces the same text as
+# legacy_html_to_text() (except for SGML shorthand such as
+# "<tag/text/", which it doesn't support), but scans the HTML only
+# once with a single regular expression, without copying it first.
+
+# Tags whose end closes any other tags opened since their start,
+# like htmllib does.  End tags for other tags are passed on as-is,
+# and end tags for these tags are ignored unless they're open.
+_CONTAINER_TAGS = frozenset([
+    'a', 'address', 'b', 'blockquote', 'body', 'cite', 'code', 'dir',
+    'dl', 'em', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'head', 'html', 'i',
+    'kbd', 'listing', 'menu', 'ol', 'pre', 'samp', 'strong', 'title', 'tt',
+    'ul', 'var', 'xmp'])
+
+# Text to write at the start of tags.
+_START_TAG_TEXT = {
+    'h1': '\n\n', 'h2': '\n\n', 'h3': '\n\n', 'h4': '\n\n', 'h5': '\n\n', 'h6': '\n\n',
+    'p': '\n\n',
+    'br': '\n',
+    'li': '\n\n- ',
+}
+
+_HEADING_TAGS = frozenset(['h1', 'h2', 'h3', 'h4', 'h5', 'h6'])
+
+# The alternatives' last groups identify the tokens.
+_TEXT, _START_TAG, _END_TAG, _CHARREF, _ENTITYREF, _IGNORED, _REST, _LAST_TAG, _LITERAL = (1, 4, 6, 7, 8, 9, 10, 11, 12)
+_TOKEN_RE = re.compile(
+    r'([^&<]+)'
+    # A start tag ends at the next "<" or ">" (like in sgmllib).
+    r'|<([a-zA-Z][-_.a-zA-Z0-9]*)([^<>]*)(>|(?=<)|\Z)'
+    r'|</([^<>]*)(>|(?=<)|\Z)'
+    r'|&#([0-9]+)(?:;|(?=[^0-9]))'
+    r'|&([a-zA-Z][-.a-zA-Z0-9]*)(?:;|(?=[^a-zA-Z0-9]))'
+    # Comments, declarations and processing instructions.
+    r'|(<!--.*?--\s*>|<![^-][^>]*>|<!>|<\?[^>]*>)'
+    # Unterminated ones make the rest of the HTML text.
+    r'|(<!|<\?)'
+    # SGML shorthand for the last start tag.
+    r'|(<>)'
+    r'|([&<])',
+    re.S)
+
+_ATTR_RE = re.compile(
+    r'\s*([a-zA-Z_][-:.a-zA-Z_0-9]*)(\s*=\s*'
+    r'(\'[^\']*\'|"[^"]*"|[][\-a-zA-Z0-9./,:;+*%?!&$\(\)_#=~\'"@]*))?')
+
+_ATTR_REF_RE = re.compile(r'&(?:([a-zA-Z][-.a-zA-Z0-9]*)|#([0-9]+));')
+
+def _convert_attr_ref(match):
+    if match.group(2):
+        n = int(match.group(2))
+        if n < 128: return chr(n)
+    elif match.group(1) in htmlentitydefs.name2codepoint:
+        c = unichr(htmlentitydefs.name2codepoint[match.group(1)])
+        # The match is from a str or unicode, like the result should be.
+        if type(match.string) == unicode: return c
+        return c.encode('utf-8')
+    return match.group(0)
+
+def _get_attr(attrs, name):
+    # Return the value of the named attribute (or None) from the
+    # attributes part of a start tag.
+    i = 0
+    n = len(attrs)
+    while i < n:
+        match = _ATTR_RE.match(attrs, i)
+        if not match: break
+        (attr_name, rest, value) = match.group(1, 2, 3)
+        if attr_name.lower() == name:
+            if not rest: return attr_name
+            if value[:1] in ('"', "'") and value[:1] == value[-1:]:
+                value = value[1:-1]
+            return _ATTR_REF_RE.sub(_convert_attr_ref, value)
+        i = match.end()
+    return None
+
+def write_html_text(html, write, show_link_urls=False, skip_tags=('head', 'script'), unknown_entity_replacement=None):
+    """ Convert HTML to text like :func:`html_to_text`, passing the text
+    to ``write`` in pieces as the HTML is scanned (so a large document
+    can be written to a file, for example, without building the whole
+    text first).  Unlike :func:`html_to_text`, leading and trailing
+    whitespace isn't stripped.
+
+    :param html: the HTML
+    :type html: unicode or UTF-8 encoded string
+    :param write: called with each piece of text (of the same type as ``html``)
+    :type write: callable
+    """
+    if type(html) == unicode:
+        nbsp = u'\xa0'
+        encode_char = lambda c: c
+    else:
+        nbsp = '\xc2\xa0'
+        encode_char = lambda c: c.encode('utf-8')
+    skip_tags = frozenset(skip_tags)
+    skip = 0
+    stack = []
+    last_href = None
+    last_tag = '???'
+    for match in _TOKEN_RE.finditer(html):
+        token = match.lastindex
+        if token == _TEXT or token == _LITERAL:
+            if not skip:
+                write(match.group(token).replace(nbsp, ' '))
+            continue
+        if token == _START_TAG or token == _LAST_TAG:
+            if token == _START_TAG:
+                if not match.group(4) and match.end() == len(html):
+                    # Unterminated
+                    if not skip: write(match.group(0).replace(nbsp, ' '))
+                    continue
+                tag = last_tag = match.group(2).lower()
+            else:
+                tag = last_tag
+            if tag in _CONTAINER_TAGS:
+                stack.append(tag)
+            if tag in skip_tags:
+                skip += 1
+            if skip: continue
+            if tag == 'a' and show_link_urls:
+                last_href = token == _START_TAG and _get_attr(match.group(3), 'href') or None
+            text = _START_TAG_TEXT.get(tag)
+            if text: write(text)
+            continue
+        if token == _END_TAG:
+            if not match.group(6) and match.end() == len(html):
+                # Unterminated
+                if not skip: write(match.group(0).replace(nbsp, ' '))
+                continue
+            tag = match.group(5).strip().lower()
+            if tag and tag in stack:
+                found = len(stack) - 1 - stack[::-1].index(tag)
+                tags = stack[found:][::-1]
+                del stack[found:]
+            elif not tag and stack:
+                tags = [stack.pop()]
+            elif tag in _CONTAINER_TAGS:
+                # Unbalanced
+                continue
+            else:
+                tags = [tag]
+            for tag in tags:
+                if tag in skip_tags:
+                    if skip: skip -= 1
+                    continue
+                if skip: continue
+                if tag == 'a' and show_link_urls and last_href:
+                    write(' [%s]' % last_href)
+                if tag in _HEADING_TAGS:
+                    write('\n\n')
+            continue
+        if skip or token == _IGNORED:
+            if token == _REST: return
+            continue
+        if token == _CHARREF:
+            write(encode_char(unichr(int(match.group(7)))).replace(nbsp, ' '))
+        elif token == _ENTITYREF:
+            codepoint = htmlentitydefs.name2codepoint.get(match.group(8))
+            if codepoint:
+                write(encode_char(unichr(codepoint)).replace(nbsp, ' '))
+            elif unknown_entity_replacement:
+                write(unknown_entity_replacement)
+        elif token == _REST:
+            write(html[match.start():].replace(nbsp, ' '))
+            return
+
+def html_to_text(html, show_link_urls=False, skip_tags=('head', 'script'), unknown_entity_replacement=None):
+    """ Convert HTML to plain text, for indexing for example.
+
+    Tags are removed, except that a couple of newlines are written at
+    the start and end of headings and the start of paragraphs, a newline
+    for ``br`` tags and a newline and a "- " for list items.
+    Character and entity references are replaced (and non-breaking
+    spaces become ordinary spaces).
+
+    :param html: the HTML
+    :type html: unicode or UTF-8 encoded string
+    :param show_link_urls: Should the URL of each link be written after its text (in square brackets)?
+    :type show_link_urls: boolean
+    :param skip_tags: names of tags whose contents should be left out
+    :type skip_tags: sequence of strings
+    :param unknown_entity_replacement: text to replace unknown entity references with (they're removed if ``None``)
+    :type unknown_entity_replacement: string or ``None``
+    :rtype: string of the same type as ``html`` (with leading and trailing whitespace stripped)
+    """
+    parts = []
+    write_html_text(html, parts.append, show_link_urls, skip_tags, unknown_entity_replacement)
+    if type(html) == unicode:
+        return u''.join(parts).strip(u' \t\n\r\x0b\x0c')
+    return ''.join(parts).strip()
+
+# Maximum number of results kept by cached_html_to_text().
+HTML_TO_TEXT_CACHE_SIZE = 1000
+
+# Cached html_to_text() results, least recently used first.
+_html_to_text_cache = OrderedDict()
+_html_to_text_cache_lock = threading.Lock()
+
+# Like html_to_text(), but remembers the results for the most recently
+# converted HTML (keyed by a hash of its content and the options),
+# so that the same HTML isn't parsed again and again (such as when an
+# object is reindexed without changes to its HTML attributes).
+def cached_html_to_text(html, *args, **kwargs):
+    data = type(html) == unicode and html.encode('utf-8') or html
+    key = (type(html), hashlib.md5(data).digest(), args, tuple(sorted(kwargs.items())))
+    with _html_to_text_cache_lock:
+        text = _html_to_text_cache.pop(key, None)
+        if text is not None:
+            _html_to_text_cache[key] = text
+            return text
+    text = html_to_text(html, *args, **kwargs)
+    with _html_to_text_cache_lock:
+        _html_to_text_cache[key] = text
+        while len(_html_to_text_cache) > HTML_TO_TEXT_CACHE_SIZE:
+            _html_to_text_cache.popitem(last=False)
+    return text
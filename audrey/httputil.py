@@ -0,0 +1,30 @@
+import re
+
+# Suffixes appended to an object's ETag for the encodings of its
+# representation (see add_etag_suffix), so that caches and conditional
+# requests can tell the encodings apart.
+ETAG_SUFFIXES = ('gzip', 'deflate', 'msgpack', 'bson')
+
+_ETAG_SUFFIX_RE = re.compile('(?:-(?:%s))+(?="?$)' % '|'.join(ETAG_SUFFIXES))
+
+def add_etag_suffix(response, suffix):
+    """ Append ``-<suffix>`` to the (strong or weak) ETag of ``response``,
+    if it has one.
+
+    :param response: a response
+    :type response: :class:`webob.Response`
+    :param suffix: one of :data:`ETAG_SUFFIXES`
+    :type suffix: string
+    """
+    etag = response.headers.get('ETag')
+    if etag and len(etag) > 1 and etag.endswith('"'):
+        response.headers['ETag'] = '%s-%s"' % (etag[:-1], suffix)
+
+def strip_etag_suffixes(etag):
+    """ Return an entity tag (quoted or not) without the suffixes added by
+    :func:`add_etag_suffix`, such as when comparing an ``If-Match``
+    header to an object's ``_etag``.
+
+    :rtype: string
+    """
+    return _ETAG_SUFFIX_RE.sub('', etag)
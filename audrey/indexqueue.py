@@ -0,0 +1,233 @@
+from collections import OrderedDict
+import logging
+import Queue
+import threading
+from pyramid.registry import Registry
+from pyramid.request import Request
+
+log = logging.getLogger(__name__)
+
+# Queued operations.
+INDEX = 'index'
+UNINDEX = 'unindex'
+
+# Default maximum number of pending operations.  When the queue is full,
+# writers block until the worker catches up.
+DEFAULT_MAXSIZE = 10000
+
+# Default maximum number of operations taken off the queue (and written
+# with one ElasticSearch bulk request) at a time.
+DEFAULT_BATCH_SIZE = 500
+
+class IndexQueue(object):
+    """ A bounded queue of pending ElasticSearch writes, drained by a
+    background worker thread.
+
+    When an app has an index queue (see the ``elastic_index_queue``
+    setting and :meth:`audrey.resources.root.Root.get_index_queue`),
+    :meth:`audrey.resources.object.Object.index` and
+    :meth:`audrey.resources.object.Object.unindex` only put the
+    collection name, ``_id`` and operation on the queue, so saving and
+    deleting objects doesn't wait for ElasticSearch (or for the full text
+    extraction of :meth:`audrey.resources.object.Object.get_fulltext_to_index`).
+
+    The worker takes up to ``batch_size`` operations at a time, keeps
+    only the latest operation for each object, loads the objects to be
+    indexed from MongoDB (objects that no longer exist are unindexed)
+    and writes them all with one ElasticSearch bulk request.
+    It uses its own ElasticSearch connection, since a :class:`pyes.es.ES`
+    can't be shared between threads.
+
+    Use :meth:`flush` to wait for the pending operations to be written
+    (in tests, for example).
+    """
+
+    def __init__(self, registry, root_cls, elastic_conn, maxsize=DEFAULT_MAXSIZE, batch_size=DEFAULT_BATCH_SIZE):
+        self.registry = registry
+        self.root_cls = root_cls
+        self.elastic_conn = elastic_conn
+        self.batch_size = batch_size
+        self._queue = Queue.Queue(maxsize)
+        self._thread = None
+
+    def __len__(self):
+        return self._queue.qsize()
+
+    def put(self, collection_name, id, op, timeout=None):
+        """ Queue an operation.
+        If the queue is full, block until there's room (or raise
+        :exc:`Queue.Full` after ``timeout`` seconds).
+
+        :param collection_name: name of the object's collection
+        :type collection_name: string
+        :param id: the object's ID
+        :type id: :class:`bson.objectid.ObjectId`
+        :param op: :data:`INDEX` or :data:`UNINDEX`
+        :type op: string
+        :param timeout: maximum number of seconds to wait for room, or ``None`` to wait as long as it takes
+        :type timeout: number or ``None``
+        """
+        self._queue.put((collection_name, id, op), True, timeout)
+
+    def put_many(self, items, timeout=None):
+        """ Queue several operations (in order).
+
+        :param items: ``(collection_name, id, op)`` tuples, as for :meth:`put`
+        :type items: list
+        :param timeout: as for :meth:`put` (applies to each operation)
+        :type timeout: number or ``None``
+        """
+        for (collection_name, id, op) in items:
+            self.put(collection_name, id, op, timeout=timeout)
+
+    def start(self):
+        """ Start the worker thread.
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='audrey-index-queue')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        """ Write the pending operations and stop the worker thread.
+        """
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def flush(self):
+        """ Return after all the operations queued so far have been written.
+        If the worker thread isn't running, they are written by the
+        calling thread.
+        """
+        if self._thread is not None:
+            self._queue.join()
+            return
+        while True:
+            items = self._get_batch(block=False)
+            if not items:
+                return
+            self._process_batch(items)
+
+    def _run(self):
+        while True:
+            items = self._get_batch(block=True)
+            if not self._process_batch(items):
+                return
+
+    def _get_batch(self, block):
+        items = []
+        try:
+            if block:
+                items.append(self._queue.get())
+            while len(items) < self.batch_size:
+                items.append(self._queue.get_nowait())
+        except Queue.Empty:
+            pass
+        return items
+
+    def _process_batch(self, items):
+        # Returns False if the batch contained the stop marker.
+        try:
+            self.process([item for item in items if item is not None])
+        except Exception:
+            log.exception("Failed to write %d queued ElasticSearch operations." % len(items))
+        finally:
+            for item in items:
+                self._queue.task_done()
+        return None not in items
+
+    def process(self, items):
+        """ Write a batch of queued operations
+        (see :func:`write_operations`).
+
+        :param items: (collection name, ID, operation) tuples, oldest first
+        :type items: list
+        :rtype: dictionary with the keys "indexed" and "unindexed" (integer counts of objects)
+        """
+        if not items:
+            return dict(indexed=0, unindexed=0)
+        return write_operations(self.make_root(), items)
+
+    def make_root(self):
+        """ Return an app root for the worker, using the worker's own
+        ElasticSearch connection (and no index queue).
+
+        :rtype: :class:`audrey.resources.root.Root`
+        """
+        registry = Registry('audrey.indexqueue')
+        registry.settings = dict(self.registry.settings, elastic_conn=self.elastic_conn, index_queue=None)
+        request = Request.blank('/')
+        request.registry = registry
+        return self.root_cls(request)
+
+def write_operations(root, items):
+    """ Write a batch of ElasticSearch operations (such as those
+    queued by an :class:`IndexQueue`) with one bulk request.
+    Only the latest operation on each object is written.
+    Objects to be indexed are loaded from MongoDB, and those that
+    no longer exist are unindexed instead.
+
+    The bulk responses are checked for errors: the result's "failed"
+    key is a list of (collection name, ID) tuples of the objects whose
+    writes weren't applied (they are still included in the counts).
+
+    :param root: the app root
+    :type root: :class:`audrey.resources.root.Root`
+    :param items: (collection name, ID, operation) tuples, oldest first
+    :type items: list
+    :rtype: dictionary with the keys "indexed" and "unindexed" (integer counts of objects) and "failed" (list)
+    """
+    by_collection = OrderedDict()
+    for (collection_name, id, op) in items:
+        ops = by_collection.setdefault(collection_name, OrderedDict())
+        # Only the latest operation on an object matters.
+        ops.pop(id, None)
+        ops[id] = op
+    counts = dict(indexed=0, unindexed=0)
+    # Bulk responses, and the objects keyed by (doctype, ID string)
+    # as they appear in the responses' items.
+    responses = []
+    keys = {}
+    for (collection_name, ops) in by_collection.items():
+        coll = root.get_collection(collection_name)
+        if coll is None: continue
+        econn = coll.get_elastic_connection()
+        if econn is None: continue
+        doctype = coll.get_elastic_doctype()
+        for id in ops:
+            keys[(doctype, str(id))] = (collection_name, id)
+        ids = [id for (id, op) in ops.items() if op == INDEX]
+        indexed = set()
+        if ids:
+            for child in coll.get_children_lazily({'_id':{'$in':ids}}):
+                responses.extend(child.index(bulk=True, defer=False))
+                indexed.add(child._id)
+        for id in ops:
+            if id not in indexed:
+                for name in coll.get_elastic_write_index_names():
+                    responses.append(econn.delete(name, doctype, str(id), bulk=True))
+                counts['unindexed'] += 1
+        counts['indexed'] += len(indexed)
+    responses.append(root.flush_elastic_bulk())
+    failed = set()
+    for response in responses:
+        for (doctype, id) in _get_failed_bulk_items(response):
+            if (doctype, id) in keys:
+                failed.add(keys[(doctype, id)])
+    counts['failed'] = [key for key in keys.values() if key in failed]
+    return counts
+
+def _get_failed_bulk_items(response):
+    # Return (doctype, ID string) tuples for the items of an ElasticSearch
+    # bulk response that report an error.  Other responses (including
+    # None, returned by queued writes) have no failed items.
+    if not isinstance(response, dict):
+        return []
+    result = []
+    for item in response.get('items') or []:
+        for details in item.values():
+            if details.get('error'):
+                result.append((details.get('_type'), details.get('_id')))
+    return result
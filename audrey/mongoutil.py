@@ -0,0 +1,39 @@
+from pyramid.settings import asbool
+
+# Audrey's default write concern: writes are acknowledged by the server.
+DEFAULT_WRITE_CONCERN = {'w': 1}
+
+# Write concern options whose values are booleans.
+BOOLEAN_WRITE_CONCERN_OPTIONS = ('j', 'fsync')
+
+def parse_write_concern(s):
+    """ Parse a write concern setting (such as ``"w=majority j=true wtimeout=5000"``;
+    options may be separated by whitespace or commas) into a dictionary
+    of :mod:`pymongo` write concern options.
+
+    :param s: write concern setting
+    :type s: string
+    :rtype: dictionary
+    """
+    ret = {}
+    for item in s.replace(',', ' ').split():
+        (key, value) = item.split('=', 1)
+        if key in BOOLEAN_WRITE_CONCERN_OPTIONS:
+            value = asbool(value)
+        elif value.isdigit():
+            value = int(value)
+        ret[key] = value
+    return ret
+
+def get_affected_count(result, default):
+    """ Return the number of documents affected by a write according to
+    ``result`` (as returned by :meth:`pymongo.collection.Collection.update`
+    or :meth:`pymongo.collection.Collection.remove`).
+    Unacknowledged writes (``w=0``) have no result, so ``default``
+    is returned for them.
+
+    :rtype: integer
+    """
+    if result is None:
+        return default
+    return result['n']
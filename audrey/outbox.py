@@ -0,0 +1,156 @@
+import logging
+import time
+import pymongo
+from audrey import indexqueue
+from audrey.exceptions import OutboxError
+
+log = logging.getLogger(__name__)
+
+# Default name of the MongoDB collection of change records.
+DEFAULT_COLLECTION_NAME = 'audrey_outbox'
+
+# Default maximum number of change records applied at a time.
+DEFAULT_BATCH_SIZE = 500
+
+class Outbox(object):
+    """ A durable log of pending ElasticSearch writes, kept in a MongoDB
+    collection.
+
+    When an app has an outbox (see the ``elastic_outbox`` setting), it
+    takes the place of the index queue (see
+    :meth:`audrey.resources.root.Root.get_index_queue`): saving,
+    deleting or renaming an object only adds a small change record
+    (collection name, ``_id`` and operation) to the outbox, and nothing
+    is written to ElasticSearch during the request.
+
+    The records are applied by a separate consumer process (see the
+    ``audrey_outbox`` console script and :meth:`run`).  Records are
+    only removed after they have been written to ElasticSearch, so
+    after an ElasticSearch outage (or a crash of the consumer) they
+    are simply applied late instead of being lost.
+
+    Since the consumer reloads each object from MongoDB (and applying a
+    record twice does no harm), records are also added *before* objects
+    are written to MongoDB (see :attr:`write_ahead`), so that a crash
+    between the MongoDB write and adding its record can't lose an
+    ElasticSearch write.  New objects are given their ``_id`` first.
+    Bulk writes (such as :meth:`audrey.resources.collection.Collection.delete_children`)
+    add the records for each chunk with a single insert (see :meth:`put_many`).
+    (Conditional deletes and renames by name look up the ``_id`` first
+    too; if that fails, only the record added after the write remains.)
+    """
+
+    # Should change records be added before the MongoDB writes as well
+    # as after them?  (See audrey.resources.object.Object._write_ahead_to_outbox.)
+    write_ahead = True
+
+    def __init__(self, mongo_coll, write_concern=None):
+        self.mongo_coll = mongo_coll
+        self.write_concern = write_concern or {}
+
+    def __len__(self):
+        return self.mongo_coll.count()
+
+    def put(self, collection_name, id, op, timeout=None):
+        """ Add a change record.
+        Takes the same params as :meth:`audrey.indexqueue.IndexQueue.put`
+        (``timeout`` is ignored).
+        """
+        self.mongo_coll.insert(dict(collection=collection_name, id=id, op=op, attempts=0), **self.write_concern)
+
+    def put_many(self, items, timeout=None):
+        """ Add several change records with one MongoDB insert.
+        Takes the same params as :meth:`audrey.indexqueue.IndexQueue.put_many`
+        (``timeout`` is ignored).
+        """
+        if not items: return
+        self.mongo_coll.insert([dict(collection=collection_name, id=id, op=op, attempts=0) for (collection_name, id, op) in items], **self.write_concern)
+
+    def ensure_indexes(self):
+        """ Ensure the MongoDB index used by the consumer.
+        """
+        self.mongo_coll.ensure_index([('attempts', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)])
+
+    def apply(self, root, batch_size=DEFAULT_BATCH_SIZE):
+        """ Apply the oldest change records to ElasticSearch (with one bulk
+        request; see :func:`audrey.indexqueue.write_operations`) and
+        remove the ones that were written.
+
+        If the bulk request fails, the batch is split in half and each
+        half is retried, down to single records, so that only the
+        records that fail on their own are kept.  Records whose items
+        in a bulk response report an error are kept too.  Kept records
+        have their ``attempts`` counts incremented, and are only retried
+        after the records that haven't failed as often.
+        If none of the records could be written, an exception is raised
+        (the last one raised while writing, or an :class:`audrey.exceptions.OutboxError`).
+
+        :param root: the app root
+        :type root: :class:`audrey.resources.root.Root`
+        :param batch_size: maximum number of records to apply
+        :type batch_size: integer
+        :rtype: integer (the number of records applied)
+        """
+        records = list(self.mongo_coll.find(sort=[('attempts', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)], limit=batch_size))
+        if not records:
+            return 0
+        # Apply records in the order they were added.
+        records.sort(key=lambda r: r['_id'])
+        (failed, error) = self._write(root, records)
+        failed_ids = set([r['_id'] for r in failed])
+        if failed_ids:
+            self.mongo_coll.update({'_id':{'$in':list(failed_ids)}}, {'$inc':{'attempts':1}}, multi=True, **self.write_concern)
+        ids = [r['_id'] for r in records if r['_id'] not in failed_ids]
+        if not ids:
+            if error is not None:
+                raise error
+            raise OutboxError("Failed to write %d outbox records." % len(failed))
+        # Removing the applied records is the consumer's checkpoint.
+        self.mongo_coll.remove({'_id':{'$in':ids}}, **self.write_concern)
+        return len(ids)
+
+    def _write(self, root, records):
+        # Write records to ElasticSearch, halving the batch after a
+        # failed bulk request.  Returns the records that couldn't be
+        # written and the last exception raised (or None).
+        try:
+            result = indexqueue.write_operations(root, [(r['collection'], r['id'], r['op']) for r in records])
+        except Exception, e:
+            if len(records) == 1:
+                log.warning("Failed to apply outbox record %s: %s" % (records[0]['_id'], e))
+                return (records, e)
+            half = len(records) // 2
+            (failed, error) = self._write(root, records[:half])
+            (more_failed, more_error) = self._write(root, records[half:])
+            return (failed + more_failed, more_error or error)
+        failed = set(result['failed'])
+        return ([r for r in records if (r['collection'], r['id']) in failed], None)
+
+    def run(self, root, batch_size=DEFAULT_BATCH_SIZE, poll_interval=1.0, max_retry_interval=60.0, forever=True):
+        """ Apply change records until the outbox is empty (or, if
+        ``forever``, until interrupted), waiting ``poll_interval`` seconds
+        between polls of an empty outbox.
+        When running forever, wait after a failure before retrying,
+        doubling the wait (up to ``max_retry_interval`` seconds) while
+        failures continue.  Otherwise failures are raised.
+
+        :rtype: integer (the number of records applied)
+        """
+        count = 0
+        retry_interval = poll_interval
+        while True:
+            try:
+                applied = self.apply(root, batch_size=batch_size)
+            except Exception:
+                if not forever:
+                    raise
+                log.exception("Failed to apply outbox records; retrying in %s seconds." % retry_interval)
+                time.sleep(retry_interval)
+                retry_interval = min(retry_interval * 2, max_retry_interval)
+                continue
+            retry_interval = poll_interval
+            count += applied
+            if not applied:
+                if not forever:
+                    return count
+                time.sleep(poll_interval)
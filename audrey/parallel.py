@@ -0,0 +1,115 @@
+import multiprocessing
+import traceback
+from pyramid.registry import Registry
+from pyramid.request import Request
+from audrey.exceptions import ReindexError
+
+# Default number of _id ranges per worker process.  More (smaller)
+# ranges than processes keep the workers busy when some ranges
+# take longer than others.
+PARTITIONS_PER_PROCESS = 4
+
+# Settings holding connections, which each worker process makes anew.
+CONNECTION_SETTINGS = ('mongo_conn', 'mongo_db', 'gridfs', 'elastic_conn', 'index_queue')
+
+def reindex_collections(root, collection_names=None, processes=None, partitions_per_process=PARTITIONS_PER_PROCESS, clear=False, start_after=None, progress=None, rate_limit=None, **kwargs):
+    """ Reindex collections in ElasticSearch with a pool of worker
+    processes, each with its own MongoDB and ElasticSearch connections.
+    This is used by :meth:`audrey.resources.root.Root.reindex_all` and
+    :meth:`audrey.resources.collection.Collection.reindex_all` when
+    they're given a ``processes`` count.
+
+    Each collection is split into ``_id`` ranges of about the same
+    number of children (see
+    :meth:`audrey.resources.collection.Collection.get_id_ranges`) and
+    each worker reindexes one range at a time.
+
+    Raises :class:`audrey.exceptions.ReindexError` if any of the
+    ranges failed (after all the others have been reindexed).
+
+    :param root: the app root
+    :type root: :class:`audrey.resources.root.Root`
+    :param collection_names: names of the collections to reindex, or ``None`` for all
+    :type collection_names: list of strings or ``None``
+    :param processes: number of worker processes (``None`` for the number of CPUs)
+    :type processes: integer or ``None``
+    :param partitions_per_process: number of ``_id`` ranges per process for each collection
+    :type partitions_per_process: integer
+    :param clear: Should the collections be cleared from the index first?
+    :type clear: boolean
+    :param start_after: like the param to :meth:`audrey.resources.root.Root.reindex_all`
+    :type start_after: tuple of (string, :class:`bson.objectid.ObjectId`) or ``None``
+    :param progress: If not ``None``, a function called after each range is done with the collection, the number of its children reindexed so far and ``None``.
+    :type progress: callable or ``None``
+    :param rate_limit: If not ``None``, the maximum number of children to reindex per second (over all the processes).
+    :type rate_limit: number or ``None``
+    :rtype: integer (the number of objects reindexed)
+
+    Other keyword arguments (such as ``bulk_size``) are passed to
+    :meth:`audrey.resources.collection.Collection.reindex_all`
+    in the workers.
+    """
+    processes = processes or multiprocessing.cpu_count()
+    if rate_limit:
+        kwargs['rate_limit'] = rate_limit / float(processes)
+    names = root._get_collection_names_to_reindex(collection_names, start_after)
+    tasks = []
+    for name in names:
+        coll = root.get_collection(name)
+        if coll.get_elastic_connection() is None:
+            continue
+        coll_start_after = None
+        if start_after is not None and name == start_after[0]:
+            coll_start_after = start_after[1]
+        elif clear:
+            coll.clear_elastic()
+        for (range_start_after, range_up_to) in coll.get_id_ranges(processes * partitions_per_process, start_after=coll_start_after):
+            tasks.append((name, range_start_after, range_up_to, kwargs))
+    if not tasks:
+        return 0
+
+    settings = dict((key, value) for (key, value) in root.request.registry.settings.items() if key not in CONNECTION_SETTINGS)
+    pool = multiprocessing.Pool(min(processes, len(tasks)), _init_worker, (root.__class__, settings))
+    counts = {}
+    failures = []
+    try:
+        for (name, range_start_after, range_up_to, count, error) in pool.imap_unordered(_reindex_range, tasks):
+            counts[name] = counts.get(name, 0) + count
+            if error is not None:
+                failures.append((name, range_start_after, range_up_to, error))
+            if progress is not None:
+                progress(root.get_collection(name), counts[name], None)
+    finally:
+        pool.close()
+        pool.join()
+    total = sum(counts.values())
+    if failures:
+        raise ReindexError(total, failures)
+    return total
+
+# The registry and root class of a worker process.
+_worker_registry = None
+_worker_root_cls = None
+
+def _init_worker(root_cls, settings):
+    from audrey import make_connections
+    global _worker_registry, _worker_root_cls
+    _worker_registry = Registry('audrey.parallel')
+    _worker_registry.settings = dict(settings, index_queue=None)
+    _worker_registry.settings.update(make_connections(settings))
+    _worker_root_cls = root_cls
+
+def _reindex_range(task):
+    (name, start_after, up_to, kwargs) = task
+    request = Request.blank('/')
+    request.registry = _worker_registry
+    coll = _worker_root_cls(request).get_collection(name)
+    def progress(coll, reindexed, last_id):
+        # Remember the count in case a later bulk request fails.
+        progress.count = reindexed
+    progress.count = 0
+    try:
+        count = coll.reindex_all(start_after=start_after, up_to=up_to, progress=progress, **kwargs)
+        return (name, start_after, up_to, count, None)
+    except Exception:
+        return (name, start_after, up_to, progress.count, traceback.format_exc())
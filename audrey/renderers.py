@@ -0,0 +1,212 @@
+import datetime
+import json
+import struct
+from inspect import isgenerator
+import bson
+from bson.dbref import DBRef
+from bson.objectid import ObjectId
+import msgpack
+from pyramid.renderers import JSON
+from audrey.httputil import add_etag_suffix
+from audrey.resources.file import File
+from audrey.resources.reference import Reference
+
+# Streamed output is buffered into chunks of (at least) this many bytes
+# before being handed to the WSGI server.
+STREAM_CHUNK_SIZE = 16 * 1024
+
+HAL_JSON_TYPE = 'application/hal+json'
+MSGPACK_TYPE = 'application/x-msgpack'
+BSON_TYPE = 'application/bson'
+
+# Application-specific msgpack extension type codes.
+# An ObjectId is packed as its 12 raw bytes; a datetime is packed
+# as a big-endian signed 64-bit count of microseconds since the epoch (UTC).
+MSGPACK_OBJECTID_EXT = 1
+MSGPACK_DATETIME_EXT = 2
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+class StreamingJSON(JSON):
+    """ A JSON renderer that can stream part of its output.
+
+    Values are rendered exactly like :class:`pyramid.renderers.JSON`
+    unless a dictionary in the value (at any depth of nested dictionaries)
+    contains a generator.  In that case the response body is produced
+    incrementally: the generator is rendered as a JSON array, one item
+    at a time, as the WSGI server consumes ``response.app_iter``.
+
+    Views such as :func:`audrey.views.collection_get` use this to emit
+    the ``item`` list of a HAL response while the items are still being
+    loaded and represented, which reduces both time-to-first-byte and
+    peak memory for large batches.
+    """
+
+    def __call__(self, info):
+        def _render(value, system):
+            request = system.get('request')
+            if request is None or not _has_generator(value):
+                return JSON.__call__(self, info)(value, system)
+            default = self._make_default(request)
+            response = request.response
+            if response.content_type == response.default_content_type:
+                response.content_type = 'application/json'
+            encode = lambda obj: self.serializer(obj, default=default, **self.kw)
+            response.app_iter = _buffer_chunks(_iterencode(value, encode))
+            return None
+        return _render
+
+def _has_generator(value):
+    if type(value) is not dict:
+        return False
+    for item in value.itervalues():
+        if isgenerator(item) or _has_generator(item):
+            return True
+    return False
+
+def _iterencode(value, encode):
+    # Yield JSON fragments for value, walking dicts and generators
+    # and encoding everything else in one piece.
+    if type(value) is dict and _has_generator(value):
+        yield '{'
+        first = True
+        for (key, item) in value.iteritems():
+            if not first: yield ', '
+            first = False
+            yield json.dumps(key) + ': '
+            for chunk in _iterencode(item, encode):
+                yield chunk
+        yield '}'
+    elif isgenerator(value):
+        yield '['
+        first = True
+        for item in value:
+            if not first: yield ', '
+            first = False
+            yield encode(item)
+        yield ']'
+    else:
+        yield encode(value)
+
+def _buffer_chunks(fragments, size=STREAM_CHUNK_SIZE):
+    buf = []
+    buf_len = 0
+    for fragment in fragments:
+        if type(fragment) is unicode:
+            fragment = fragment.encode('utf-8')
+        buf.append(fragment)
+        buf_len += len(fragment)
+        if buf_len >= size:
+            yield ''.join(buf)
+            buf = []
+            buf_len = 0
+    if buf:
+        yield ''.join(buf)
+
+class HALRenderer(StreamingJSON):
+    """ The renderer for Audrey's HAL views.
+
+    Responses whose content type the view has set to
+    ``application/hal+json`` may instead be encoded as msgpack
+    (``application/x-msgpack``) or BSON (``application/bson``)
+    when the request's ``Accept`` header prefers one of those types.
+    The binary encodings carry the same representation, but with
+    native datetimes and ObjectIds instead of the JSON adapters'
+    strings and ``{"ObjectId": "..."}`` wrappers.
+    (See :data:`MSGPACK_OBJECTID_EXT`, :data:`MSGPACK_DATETIME_EXT` and
+    :func:`msgpack_ext_hook` for msgpack clients.)
+
+    HAL+JSON wins whenever it's acceptable and no binary type has a
+    strictly higher quality, so ``Accept: */*`` still yields HAL+JSON.
+    These responses vary by ``Accept``, and a binary response's ETag
+    gets the encoding as a suffix (see :func:`audrey.httputil.add_etag_suffix`).
+    All other responses are rendered by :class:`StreamingJSON`.
+    """
+
+    def __call__(self, info):
+        render_json = StreamingJSON.__call__(self, info)
+        def _render(value, system):
+            request = system.get('request')
+            if request is not None and request.response.content_type == HAL_JSON_TYPE:
+                response = request.response
+                vary = list(response.vary or ())
+                if 'Accept' not in vary:
+                    response.vary = tuple(vary + ['Accept'])
+                content_type = request.accept.best_match([HAL_JSON_TYPE, MSGPACK_TYPE, BSON_TYPE])
+                if content_type in BINARY_ENCODERS:
+                    response.content_type = content_type
+                    add_etag_suffix(response, BINARY_ETAG_SUFFIXES[content_type])
+                    return BINARY_ENCODERS[content_type](to_binary_value(value, request))
+            return render_json(value, system)
+        return _render
+
+def to_binary_value(value, request):
+    """ Return a copy of ``value`` (as returned by a HAL view) consisting
+    only of dicts, lists, strings, numbers, booleans, ``None``, ObjectIds,
+    DBRefs and datetimes.
+    """
+    if type(value) is dict:
+        return dict((k, to_binary_value(v, request)) for (k, v) in value.iteritems())
+    if type(value) in (list, tuple, set) or isgenerator(value):
+        return [to_binary_value(v, request) for v in value]
+    if type(value) is datetime.date:
+        return datetime.datetime(value.year, value.month, value.day)
+    if type(value) is File:
+        return dict(FileId=value._id)
+    if type(value) is Reference:
+        if value.serialize_id_only:
+            return dict(ObjectId=value.id)
+        return dict(collection=value.collection, ObjectId=value.id)
+    if hasattr(value, '__json__'):
+        return to_binary_value(value.__json__(request), request)
+    return value
+
+def encode_bson(value):
+    """ Encode ``value`` (a dictionary) as a BSON document.
+    """
+    return bson.BSON.encode(value)
+
+def encode_msgpack(value):
+    """ Encode ``value`` with msgpack, using extension types for
+    ObjectIds and datetimes.
+    """
+    return msgpack.packb(value, default=_msgpack_default)
+
+def _msgpack_default(obj):
+    if type(obj) is ObjectId:
+        return msgpack.ExtType(MSGPACK_OBJECTID_EXT, obj.binary)
+    if type(obj) is datetime.datetime:
+        if obj.tzinfo is not None:
+            obj = obj.replace(tzinfo=None) - obj.utcoffset()
+        delta = obj - EPOCH
+        micros = (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+        return msgpack.ExtType(MSGPACK_DATETIME_EXT, struct.pack('>q', micros))
+    if type(obj) is DBRef:
+        # Like the JSON renderer's DBRef adapter, but with a native ObjectId.
+        ret = dict(collection=obj.collection, ObjectId=obj.id)
+        if obj.database:
+            ret['database'] = obj.database
+        return ret
+    raise TypeError('%r is not msgpack serializable' % (obj,))
+
+def msgpack_ext_hook(code, data):
+    """ An ``ext_hook`` for :func:`msgpack.unpackb` that decodes
+    the extension types produced by :class:`HALRenderer`.
+    Datetimes are returned as naive UTC datetimes.
+    """
+    if code == MSGPACK_OBJECTID_EXT:
+        return ObjectId(data)
+    if code == MSGPACK_DATETIME_EXT:
+        return EPOCH + datetime.timedelta(microseconds=struct.unpack('>q', data)[0])
+    return msgpack.ExtType(code, data)
+
+BINARY_ENCODERS = {
+    MSGPACK_TYPE: encode_msgpack,
+    BSON_TYPE: encode_bson,
+}
+
+# The ETag suffixes of the binary encodings.
+BINARY_ETAG_SUFFIXES = {
+    MSGPACK_TYPE: 'msgpack',
+    BSON_TYPE: 'bson',
+}
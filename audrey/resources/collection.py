@@ -1,8 +1,57 @@
+import datetime
+import time
+import uuid
+import colander
+from bson.dbref import DBRef
 from bson.objectid import ObjectId
-from audrey.exceptions import Veto
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+import pyes
+from pyes.exceptions import ElasticSearchException
+from pyes.utils import make_path
+from pyramid.traversal import find_root
+from audrey import dateutil
+from audrey.mongoutil import get_affected_count
+from audrey import indexqueue
+from audrey.exceptions import Veto, PreconditionFailed
+from audrey.resources.object import INDEX_HASH_FIELD, _mongify_values, _node_may_have_files
+import audrey.types
 from collections import OrderedDict
 import string
 
+# MongoDB error codes for duplicate key errors.
+DUPLICATE_KEY_ERRORS = (11000, 11001)
+
+# Default number of children removed per round of delete_children().
+DELETE_CHUNK_SIZE = 500
+
+# Default number of children updated per round of update_children()
+# (when reindexing).
+UPDATE_CHUNK_SIZE = 500
+
+# Default number of children read per MongoDB cursor batch and
+# indexed per ElasticSearch bulk request by reindex_all().
+REINDEX_BULK_SIZE = 1000
+
+# The MongoDB collection of reindex_modified() checkpoints.
+REINDEX_CHECKPOINTS_COLLECTION = 'audrey_reindex_checkpoints'
+
+# reindex_modified() saves the time it started less this margin as its
+# checkpoint, so that saves that were in progress (with _modified set
+# but not yet written) are caught by the next call.
+REINDEX_CHECKPOINT_MARGIN = datetime.timedelta(minutes=1)
+
+# Suffixes of get_elastic_filter() names for range constraints, and the
+# ESRange arguments they set.
+FILTER_RANGE_OPERATORS = {
+    'gt': ('from_value', 'include_lower', False),
+    'gte': ('from_value', 'include_lower', True),
+    'lt': ('to_value', 'include_upper', False),
+    'lte': ('to_value', 'include_upper', True),
+}
+
+# How long ElasticSearch keeps the scan searches of unindex_missing() alive.
+REINDEX_SCROLL_TIMEOUT = '5m'
+
 class Collection(object):
     """
     A set of Objects.  Corresponds to a MongoDB Collection (and 
@@ -26,6 +75,8 @@ class Collection(object):
     If an ElasticSearch mapping is desired, override the class method :meth:`get_elastic_mapping`.
 
     If ElasticSearch indexing isn't desired, override the class attribute :attr:`_use_elastic` to ``False``.
+
+    To change the MongoDB write concern for the collection, override the class attribute :attr:`_write_concern` (see :meth:`get_write_concern`).
     """
 
     _collection_name = 'base_collection'
@@ -36,6 +87,11 @@ class Collection(object):
     # for this collection.
     _use_elastic = True
 
+    # A dictionary of pymongo write concern options (such as {'w': 0}
+    # for fast unacknowledged writes or {'w': 'majority'} for durable ones)
+    # or None for the app's default.
+    _write_concern = None
+
     _ID_FIELD = '_id'
 
     # In Collection, users can't explicitly assign names to objects.
@@ -61,9 +117,11 @@ class Collection(object):
 
         :rtype: sequence of two-item tuples, each with the two parameters to be passed to a call to :meth:`pymongo.collection.Collection.ensure_index`
 
-        The default implementation returns an empty list, meaning that no indexes will be ensured.
+        The default implementation returns an index on ``_modified``
+        (used by :meth:`reindex_modified`).  Overrides should usually
+        extend it.
         """
-        return []
+        return [([('_modified', 1)], {})]
 
     @classmethod
     def get_elastic_mapping(cls):
@@ -71,9 +129,15 @@ class Collection(object):
         for this collection.
         Refer to http://www.elasticsearch.org/guide/reference/mapping/
 
+        The default implementation maps ``text``, ``_created`` and
+        ``_modified`` and the fields of the object classes (see
+        :meth:`audrey.resources.object.Object.get_elastic_mapping`).
+
         :rtype: dictionary
         """
         mapping = {}
+        for obj_cls in cls.get_object_classes():
+            mapping.update(obj_cls.get_elastic_mapping())
         mapping['text'] = dict(type='string', include_in_all=True)
         mapping['_created'] = dict(type='date', format='dateOptionalTime', include_in_all=False)
         mapping['_modified'] = dict(type='date', format='dateOptionalTime', include_in_all=False)
@@ -111,6 +175,35 @@ class Collection(object):
         """
         return self.__parent__.get_mongo_collection(self._collection_name)
 
+    def get_write_concern(self, write_concern=None):
+        """ Return the MongoDB write concern for writes to this collection
+        (including updates of the "parents" of GridFS files that its
+        children refer to).
+
+        This is the first of:
+
+        * ``write_concern``, if not ``None`` (methods that write take a ``write_concern`` param to override the collection's write concern for one call)
+        * the ``write_concern.<collection name>`` setting
+        * the class attribute :attr:`_write_concern`
+        * the app's default (see :meth:`audrey.resources.root.Root.get_write_concern`)
+
+        Note that ``find_and_modify`` commands (used for conditional writes
+        and renames) are always acknowledged.
+
+        :param write_concern: a write concern to use instead of the collection's
+        :type write_concern: dictionary of :mod:`pymongo` write concern options or ``None``
+        :rtype: dictionary of :mod:`pymongo` write concern options
+        """
+        if write_concern is not None:
+            return write_concern
+        root = self.__parent__
+        wc = root.get_write_concern_setting('write_concern.%s' % self._collection_name)
+        if wc is None and self._write_concern is not None:
+            wc = dict(self._write_concern)
+        if wc is None:
+            wc = root.get_write_concern()
+        return wc
+
     def get_elastic_connection(self):
         """ Return a connection to the ElasticSearch server.
         May return ``None`` if the class attribute :attr:`_use_elastic`
@@ -135,6 +228,15 @@ class Collection(object):
         """
         return self.__parent__.get_elastic_index_name()
 
+    def get_elastic_write_index_names(self):
+        """ Return the names of the ElasticSearch indices that writes
+        should go to.
+        This is just a convenience method that returns the names from the root.
+
+        :rtype: list of strings
+        """
+        return self.__parent__.get_elastic_write_index_names()
+
     def get_elastic_doctype(self):
         """ Return the ElasticSearch document type for this collection.
 
@@ -237,12 +339,46 @@ class Collection(object):
             return None
 
     def __getitem__(self, name):
-        child = self.get_child_by_name(name)
+        child = None
+        if _is_conditional_write(self.request):
+            # The view will check the preconditions as part of its write,
+            # so don't bother loading the child.
+            child = self.construct_child_stub(name)
+        if child is None:
+            child = self.get_child_by_name(name)
         if child is None:
             raise KeyError
         return child
 
-    def get_children_and_total(self, spec=None, sort=None, skip=0, limit=0, fields=None):
+    def construct_child_stub(self, name):
+        """ Construct and return an Object with the given ``name``
+        without loading it from MongoDB.
+        The "stub" has no schema values, but can be deleted
+        or saved conditionally (see the ``if_match`` and
+        ``if_unmodified_since`` params of :meth:`delete_child` and
+        :meth:`audrey.resources.object.Object.save`).
+
+        Returns ``None`` if the name is invalid or if the collection
+        has more than one Object class (since the class of the child
+        isn't known).
+
+        :param name: an object name
+        :type name: string
+        :rtype: :class:`audrey.resources.object.Object` or ``None``
+        """
+        classes = self.get_object_classes()
+        if len(classes) != 1:
+            return None
+        obj = classes[0](self.request)
+        if self._NAME_FIELD == self._ID_FIELD:
+            obj._id = self._str_to_id(name)
+            if obj._id is None:
+                return None
+        obj.__name__ = name
+        obj.__parent__ = self
+        return obj
+
+    def get_children_and_total(self, spec=None, sort=None, skip=0, limit=0, fields=None, lazy=False):
         """ Query for children and return the total number of matching children
         and a list of the children (or a batch of children if the ``limit``
         parameter is non-zero).
@@ -257,6 +393,8 @@ class Collection(object):
         :type limit: integer
         :param fields: a list of field names to retrieve or ``None`` for all fields.  May also be a dict to exclude fields (example: ``fields={'body':False}``).
         :type fields: list of strings or dict with boolean values or ``None``
+        :param lazy: If ``True``, "items" will be a generator that constructs the children as it's iterated over (like :meth:`get_children_lazily`) instead of a list.
+        :type lazy: boolean
         :rtype: dictionary with the keys:
 
                 * "total" - an integer indicating the total number of children matching the query ``spec``
@@ -264,10 +402,9 @@ class Collection(object):
         """
         cursor = self.get_mongo_collection().find(spec=spec, sort=sort, skip=skip, limit=limit, fields=fields)
         total = cursor.count()
-        items = []
-        for doc in cursor:
-            obj = self.construct_child_from_mongo_doc(doc)
-            items.append(obj)
+        items = (self.construct_child_from_mongo_doc(doc) for doc in cursor)
+        if not lazy:
+            items = list(items)
         return dict(total=total, items=items)
 
     def get_children(self, spec=None, sort=None, skip=0, limit=0, fields=None):
@@ -361,7 +498,7 @@ class Collection(object):
             obj = self.construct_child_from_mongo_doc(doc)
             yield obj
 
-    def veto_add_child(self, child):
+    def veto_add_child(self, child, unique=True):
         """ Check whether the collection will allow the given ``child``
         to be added.
         If there is some objection, return a string describing the objection.
@@ -369,6 +506,8 @@ class Collection(object):
 
         :param child: a child to be added to this collection
         :type child: :class:`audrey.resources.object.Object`
+        :param unique: Should we check that the child's name isn't already in use?  (Only meaningful for collections such as :class:`NamingCollection` that let children be named.)
+        :type unique: boolean
         :rtype: string or ``None``
         """
         type_ok = False
@@ -385,83 +524,740 @@ class Collection(object):
             collection_type = str(self.__class__)
         return "Cannot add %s to %s." % (child_type, collection_type)
 
-    def add_child(self, child, validate_schema=True):
+    def add_child(self, child, validate_schema=True, write_concern=None):
         """ Add a child object to this collection.
         Note that this will ultimately call the child's :meth:`audrey.resources.object.Object.save` method, persisting it in Mongo (and indexing in Elastic).
         If ``validate_schema`` is ``True``, a :class:`colander.Invalid` exception may be raised if schema validation fails.
+        A :class:`audrey.exceptions.Veto` exception is raised if the collection objects to the child (see :meth:`veto_add_child`) or if MongoDB reports a duplicate key error (see :meth:`get_duplicate_key_error`).
+        If a unit of work is active, the child is only written when it's committed, so a duplicate key (such as a name that's already in use) raises :class:`audrey.exceptions.CommitError` then instead (which :func:`audrey.views.commit_error` turns into a 409 response).
 
         :param child: a child to be added to this collection
         :type child: :class:`audrey.resources.object.Object`
         :param validate_schema: Should we validate the schema before adding the child?
         :type validate_schema: boolean
+        :param write_concern: overrides the collection's write concern (see :meth:`get_write_concern`)
+        :type write_concern: dictionary or ``None``
         """
-        error = self.veto_add_child(child)
+        # Rather than querying for a name that's already in use,
+        # leave uniqueness to the collection's unique indexes.
+        error = self.veto_add_child(child, unique=False)
         if error: raise Veto(error)
         child.__parent__ = self
-        child.save(validate_schema=validate_schema)
+        try:
+            child.save(validate_schema=validate_schema, write_concern=write_concern)
+        except OperationFailure, e:
+            if not _is_duplicate_key_error(e): raise
+            raise Veto(self.get_duplicate_key_error(child))
         if self._NAME_FIELD == self._ID_FIELD:
             # We assume Object.save() set the _id attribute.
             child.__name__ = str(child._id)
 
-    def delete_child(self, child_obj):
+    def add_children(self, children, validate_schema=True, index=True, write_concern=None):
+        """ Add several child objects to this collection using bulk writes.
+
+        This is like calling :meth:`add_child` for each child, but takes
+        a constant number of round trips: one MongoDB bulk insert, one
+        bulk update of the GridFS files referred to by the children,
+        and one ElasticSearch bulk request.
+        Uniqueness of names is left to the collection's unique index
+        (a child whose name is already in use is simply not added).
+
+        :param children: children to be added to this collection
+        :type children: list of :class:`audrey.resources.object.Object`
+        :param validate_schema: Should we validate each child's schema before adding it?
+        :type validate_schema: boolean
+        :param index: Should the new children be indexed in ElasticSearch?
+        :type index: boolean
+        :param write_concern: overrides the collection's write concern (see :meth:`get_write_concern`)
+        :type write_concern: dictionary or ``None``
+        :rtype: a list with one item per child: ``None`` if the child was added, otherwise a string describing why it wasn't
+        """
+        wc = self.get_write_concern(write_concern)
+        errors = [None] * len(children)
+        docs = [None] * len(children)
+        bulk = self.get_mongo_collection().initialize_unordered_bulk_op()
+        inserted = [] # indexes into children, in order of insertion
+        for (i, child) in enumerate(children):
+            error = self.veto_add_child(child, unique=False)
+            if error:
+                errors[i] = error
+                continue
+            child.__parent__ = self
+            try:
+                child._pre_save(validate_schema=validate_schema)
+            except colander.Invalid, e:
+                errors[i] = 'Validation failed.'
+                continue
+            if child._id is None:
+                child._id = ObjectId()
+            docs[i] = child.get_mongo_save_doc()
+            bulk.insert(docs[i])
+            inserted.append(i)
+        if not inserted:
+            return errors
+
+        if index:
+            self._write_ahead_to_outbox([children[i]._id for i in inserted], indexqueue.INDEX)
+        try:
+            bulk.execute(write_concern=wc)
+        except BulkWriteError, e:
+            for write_error in e.details['writeErrors']:
+                i = inserted[write_error['index']]
+                if write_error['code'] in DUPLICATE_KEY_ERRORS:
+                    errors[i] = self.get_duplicate_key_error(children[i])
+                else:
+                    errors[i] = write_error['errmsg']
+        added = [children[i] for i in inserted if errors[i] is None]
+        for i in inserted:
+            if errors[i] is None:
+                children[i]._saved_doc = docs[i]
+                children[i]._index_hash = None
+
+        # Add the new children to the "parents" of their GridFS files.
+        root = find_root(self)
+        fs_bulk = None
+        for child in added:
+            file_ids = [f._id for f in child.get_all_files()]
+            if file_ids:
+                if fs_bulk is None:
+                    fs_bulk = root.get_gridfs()._GridFS__files.initialize_unordered_bulk_op()
+                fs_bulk.find({'_id':{'$in':file_ids}}).update({"$addToSet":{"parents":child.get_dbref()}, "$set":{"lastmodDate": dateutil.utcnow()}})
+        if fs_bulk is not None:
+            fs_bulk.execute(write_concern=wc)
+
+        for child in added:
+            if self._NAME_FIELD == self._ID_FIELD:
+                child.__name__ = str(child._id)
+        if index and added and self.get_elastic_connection() is not None:
+            queue = root.get_index_queue()
+            if queue is not None:
+                queue.put_many([(self._collection_name, child._id, indexqueue.INDEX) for child in added])
+            else:
+                for child in added:
+                    child.index(bulk=True)
+                root.flush_elastic_bulk()
+        return errors
+
+    def get_duplicate_key_error(self, child):
+        """ Return a string describing why ``child`` couldn't be saved
+        after MongoDB reported a duplicate key error for it.
+
+        :param child: a child of this collection
+        :type child: :class:`audrey.resources.object.Object`
+        :rtype: string
+        """
+        return "Duplicate key."
+
+    def delete_child(self, child_obj, if_match=None, if_unmodified_since=None, write_concern=None):
         """ Remove a child object from this collection.
 
         :param child: a child to be added to this collection
         :type child: :class:`audrey.resources.object.Object`
+        :param if_match: If not ``None``, only remove the child if its stored Etag is still this value.
+        :type if_match: string or ``None``
+        :param if_unmodified_since: If not ``None``, only remove the child if its stored last modified timestamp is still this value (to the second, like an HTTP date).
+        :type if_unmodified_since: datetime.datetime or ``None``
+        :param write_concern: overrides the collection's write concern (see :meth:`get_write_concern`)
+        :type write_concern: dictionary or ``None``
+
+        If a unit of work is active (see :meth:`audrey.resources.root.Root.begin_unit_of_work`) the child is only removed when the unit of work is committed.
+
+        When ``if_match`` or ``if_unmodified_since`` is given, the check
+        and the removal are atomic (bypassing any active unit of work)
+        and :class:`audrey.exceptions.PreconditionFailed` is raised if
+        the stored child doesn't match (or doesn't exist).
         """
-        child_obj._pre_delete()
-        self.get_mongo_collection().remove(dict(_id=child_obj._id), safe=True)
-
-    def delete_child_by_name(self, name):
+        if if_match is not None or if_unmodified_since is not None:
+            spec = child_obj._get_precondition_spec(if_match, if_unmodified_since)
+            child_obj._write_ahead_to_outbox()
+            doc = self.get_mongo_collection().find_and_modify(spec, remove=True, fields=[])
+            if doc is None:
+                raise PreconditionFailed("The object has been changed or removed.")
+            child_obj._id = doc['_id']
+            child_obj._pre_delete(write_concern=write_concern)
+            return
+        uow = find_root(self).get_unit_of_work()
+        if uow is not None:
+            uow.delete(child_obj)
+            return
+        child_obj._pre_delete(write_concern=write_concern)
+        self.get_mongo_collection().remove(dict(_id=child_obj._id), **self.get_write_concern(write_concern))
+
+    def delete_child_by_name(self, name, write_concern=None):
         """ Remove a child object (identified by the given ``name``) from this collection.
 
         :param name: name of the child to remove
         :type name: string
+        :param write_concern: overrides the collection's write concern (see :meth:`get_write_concern`)
+        :type write_concern: dictionary or ``None``
         :rtype: integer indicating number of children removed.  Should be 1 normally, but may be 0 if no child was found with the given ``name``.
         """
         child = self.get_child_by_name(name)
         if child:
-            self.delete_child(child)
+            self.delete_child(child, write_concern=write_concern)
             return 1
         else:
             return 0
 
-    def delete_child_by_id(self, id):
+    def delete_child_by_id(self, id, write_concern=None):
         """ Remove a child object (identified by the given ``id``) from this collection.
 
         :param name: ID of the child to remove
         :type name: :class:`bson.objectid.ObjectId`
+        :param write_concern: overrides the collection's write concern (see :meth:`get_write_concern`)
+        :type write_concern: dictionary or ``None``
         :rtype: integer indicating number of children removed.  Should be 1 normally, but may be 0 if no child was found with the given ``id``.
         """
         child = self.get_child_by_id(id)
         if child:
-            self.delete_child(child)
+            self.delete_child(child, write_concern=write_concern)
             return 1
         else:
             return 0
 
+    def delete_children(self, spec=None, chunk_size=DELETE_CHUNK_SIZE, rate_limit=None, write_concern=None):
+        """ Remove all the children matching a query from this collection.
+
+        Unlike calling :meth:`delete_child` for each child, this doesn't
+        load the children.  Matching ``_id``\s are walked in chunks and each
+        chunk takes a constant number of round trips: one MongoDB
+        ``remove``, one multi-update of the GridFS files referring to
+        the children, and one ElasticSearch bulk delete.
+
+        :param spec: a MongoDB query spec (as used by :meth:`pymongo.collection.Collection.find`); ``None`` matches all children
+        :type spec: dictionary or ``None``
+        :param chunk_size: maximum number of children to remove per chunk
+        :type chunk_size: integer
+        :param rate_limit: If not ``None``, the maximum average number of children to remove per second; we'll sleep between chunks as needed to protect other traffic.
+        :type rate_limit: number or ``None``
+        :param write_concern: overrides the collection's write concern (see :meth:`get_write_concern`)
+        :type write_concern: dictionary or ``None``
+        :rtype: dictionary with the keys:
+
+                * "deleted" - an integer indicating the number of children removed (with unacknowledged writes, the number of matching children found)
+                * "files" - an integer indicating the number of GridFS files that were updated (no longer referring to a removed child; always 0 with unacknowledged writes)
+                * "chunks" - an integer indicating the number of chunks
+        """
+        mongo_coll = self.get_mongo_collection()
+        root = find_root(self)
+        fs_files_coll = root.get_gridfs()._GridFS__files
+        econn = self.get_elastic_connection()
+        wc = self.get_write_concern(write_concern)
+        counts = dict(deleted=0, files=0, chunks=0)
+        start = time.time()
+        for ids in self._iter_id_chunks(spec, chunk_size):
+            self._write_ahead_to_outbox(ids, indexqueue.UNINDEX)
+            result = mongo_coll.remove({'_id':{'$in':ids}}, **wc)
+            counts['deleted'] += get_affected_count(result, len(ids))
+            dbrefs = [DBRef(mongo_coll.name, id) for id in ids]
+            result = fs_files_coll.update({'parents':{'$in':dbrefs}}, {"$pull":{"parents":{'$in':dbrefs}}, "$set":{"lastmodDate": dateutil.utcnow()}}, multi=True, **wc)
+            counts['files'] += get_affected_count(result, 0)
+            if econn is not None:
+                queue = root.get_index_queue()
+                if queue is not None:
+                    queue.put_many([(self._collection_name, id, indexqueue.UNINDEX) for id in ids])
+                else:
+                    for id in ids:
+                        for name in self.get_elastic_write_index_names():
+                            econn.delete(name, self.get_elastic_doctype(), str(id), bulk=True)
+                    root.flush_elastic_bulk()
+            counts['chunks'] += 1
+
+            if rate_limit:
+                delay = counts['deleted'] / float(rate_limit) - (time.time() - start)
+                if delay > 0:
+                    time.sleep(delay)
+        return counts
+
+    def update_children(self, spec, changes, reindex=None, chunk_size=UPDATE_CHUNK_SIZE, write_concern=None):
+        """ Change the values of some top-level schema attributes for
+        all the children matching a query, without loading them.
+
+        Only children of the Object classes whose schemas have all the
+        changed attributes are updated.  ``changes`` is validated against
+        the corresponding nodes of each of those schemas and may raise
+        :class:`colander.Invalid`.  It's then applied with a MongoDB
+        multi-update per class (or per group of classes whose
+        deserialized values are the same) that also sets a new
+        ``_modified`` and ``_etag`` for each child.
+        (Note that ETags set this way are random rather than hashes of
+        the children's values.)
+
+        The updated children are only reindexed in ElasticSearch (in bulk)
+        if the changed attributes affect their index documents
+        (see :meth:`audrey.resources.object.Object.affects_elastic_index`).
+        When they aren't, the ``_modified`` date in ElasticSearch is left as it was.
+
+        Attributes that may refer to GridFS files can't be changed this
+        way (that raises :class:`ValueError`) since the files' "parents"
+        wouldn't be kept up to date.
+
+        :param spec: a MongoDB query spec (as used by :meth:`pymongo.collection.Collection.find`); ``None`` matches all children
+        :type spec: dictionary or ``None``
+        :param changes: new values (of the same types as Object attributes) keyed by schema attribute name
+        :type changes: dictionary
+        :param reindex: Should the updated children be reindexed?  If ``None``, only reindex when needed.
+        :type reindex: boolean or ``None``
+        :param chunk_size: when reindexing, the maximum number of children updated and reindexed per chunk
+        :type chunk_size: integer
+        :param write_concern: overrides the collection's write concern (see :meth:`get_write_concern`)
+        :type write_concern: dictionary or ``None``
+        :rtype: dictionary with the keys "updated" and "reindexed" (integer counts of children; with unacknowledged writes "updated" is only known when reindexing)
+        """
+        names = changes.keys()
+        fragments = []
+        for cls in self.get_object_classes():
+            schema = cls.get_class_schema(self.request)
+            nodes = [schema.get(name) for name in names]
+            if None in nodes: continue
+            fragment = colander.SchemaNode(colander.Mapping())
+            for node in nodes:
+                if _node_may_have_files(node):
+                    raise ValueError("Can't update \"%s\" since it may refer to files." % node.name)
+                fragment.add(node.clone())
+            fragments.append((cls, fragment))
+        if not fragments:
+            raise ValueError("No object type in %s has all the attributes %s." % (self._collection_name, ', '.join(names)))
+        # Each class deserializes the changes with its own nodes, so
+        # the children of each class get their own update (classes
+        # whose values come out the same share one).
+        modified = dateutil.utcnow()
+        etag = uuid.uuid4().hex
+        updates = [] # list of (object types, update)
+        for (cls, fragment) in fragments:
+            values = _mongify_values(fragment.deserialize(fragment.serialize(changes)))
+            values['_modified'] = modified
+            values['_etag'] = etag
+            for (types, update) in updates:
+                if update['$set'] == values:
+                    types.append(cls._object_type)
+                    break
+            else:
+                updates.append(([cls._object_type], {'$set': values}))
+        # Children of the classes without all the attributes are left alone.
+        spec = {'$and': [spec or {}, {'_object_type':{'$in':[cls._object_type for (cls, fragment) in fragments]}}]}
+
+        if reindex is None:
+            reindex = False
+            for (cls, fragment) in fragments:
+                if cls(self.request).affects_elastic_index(names):
+                    reindex = True
+        mongo_coll = self.get_mongo_collection()
+        wc = self.get_write_concern(write_concern)
+        if not reindex or self.get_elastic_connection() is None:
+            updated = 0
+            for (types, update) in updates:
+                result = mongo_coll.update({'$and': [spec, {'_object_type':{'$in':types}}]}, update, multi=True, **wc)
+                updated += get_affected_count(result, 0)
+            return dict(updated=updated, reindexed=0)
+
+        # The children's saved index hashes (see Object.save) no longer apply.
+        for (types, update) in updates:
+            update['$unset'] = {INDEX_HASH_FIELD:1}
+        root = find_root(self)
+        counts = dict(updated=0, reindexed=0)
+        queue = root.get_index_queue()
+        for ids in self._iter_id_chunks(spec, chunk_size):
+            self._write_ahead_to_outbox(ids, indexqueue.INDEX)
+            results = [mongo_coll.update({'_id':{'$in':ids}, '_object_type':{'$in':types}}, update, multi=True, **wc) for (types, update) in updates]
+            if None in results:
+                # Unacknowledged; assume each child was updated.
+                counts['updated'] += len(ids)
+            else:
+                counts['updated'] += sum([get_affected_count(result, 0) for result in results])
+            if queue is not None:
+                queue.put_many([(self._collection_name, id, indexqueue.INDEX) for id in ids])
+                counts['reindexed'] += len(ids)
+                continue
+            for child in self.get_children_lazily({'_id':{'$in':ids}}):
+                child.index(bulk=True)
+                counts['reindexed'] += 1
+            root.flush_elastic_bulk()
+        return counts
+
+    def _write_ahead_to_outbox(self, ids, op):
+        # Like audrey.resources.object.Object._write_ahead_to_outbox,
+        # but for many children, with one insert.
+        if not ids or self.get_elastic_connection() is None: return
+        queue = find_root(self).get_index_queue()
+        if getattr(queue, 'write_ahead', False):
+            queue.put_many([(self._collection_name, id, op) for id in ids])
+
+    def _iter_id_chunks(self, spec, chunk_size):
+        # Yield lists of the _ids of the children matching spec,
+        # in _id order.  Walking by _id (rather than skipping)
+        # keeps working while children are removed or changed
+        # so that they no longer match.
+        mongo_coll = self.get_mongo_collection()
+        last_id = None
+        while True:
+            chunk_spec = spec or {}
+            if last_id is not None:
+                chunk_spec = {'$and': [chunk_spec, {'_id':{'$gt':last_id}}]}
+            ids = [doc['_id'] for doc in mongo_coll.find(spec=chunk_spec, fields=[], sort=[('_id', 1)], limit=chunk_size)]
+            if not ids:
+                return
+            last_id = ids[-1]
+            yield ids
+
+    def update_elastic_doc(self, id, values):
+        """ Change some values of a child's ElasticSearch document in place
+        (using ElasticSearch's update API with a script), without
+        reindexing the whole child.
+        If the document isn't found, the child is reindexed instead.
+        If the app has an index queue (see :meth:`audrey.resources.root.Root.get_index_queue`),
+        the child's reindexing is left to it.
+
+        :param id: the child's ObjectId
+        :type id: :class:`bson.objectid.ObjectId`
+        :param values: new values keyed by index document field name
+        :type values: dictionary
+        """
+        econn = self.get_elastic_connection()
+        if econn is None: return
+        queue = find_root(self).get_index_queue()
+        if queue is not None:
+            queue.put(self._collection_name, id, indexqueue.INDEX)
+            return
+        script = []
+        params = {}
+        for (i, (key, value)) in enumerate(values.items()):
+            script.append("ctx._source['%s'] = p%d" % (key, i))
+            params['p%d' % i] = value
+        try:
+            for name in self.get_elastic_write_index_names():
+                _post_elastic_update(econn, name, self.get_elastic_doctype(), id, dict(script='; '.join(script), params=params))
+        except ElasticSearchException, e:
+            child = self.get_child_by_id(id)
+            if child is not None:
+                child.index()
+
     def clear_elastic(self):
         """ Delete all documents from Elastic for this Collection's doctype.
         """
         self.get_elastic_connection().delete(self.get_elastic_index_name(), self.get_elastic_doctype(), None)
 
-    def reindex_all(self, clear=False):
+    def reindex_all(self, clear=False, bulk_size=REINDEX_BULK_SIZE, rate_limit=None, start_after=None, up_to=None, progress=None, processes=None, index_name=None):
         """ Reindex all this collection's objects in Elastic.
         Returns a count of the objects reindexed.
 
+        Children are read in ``_id`` order, in large cursor batches and
+        with only the fields returned by :meth:`get_elastic_index_fields`,
+        and are indexed with ElasticSearch bulk requests.
+
         :param clear: Should we clear the index first?
         :type clear: boolean
+        :param bulk_size: the number of children read per cursor batch and indexed per bulk request
+        :type bulk_size: integer
+        :param rate_limit: If not ``None``, the maximum number of children to reindex per second.
+        :type rate_limit: number or ``None``
+        :param start_after: If not ``None``, only reindex the children with greater IDs (to resume an interrupted reindex).
+        :type start_after: :class:`bson.objectid.ObjectId` or ``None``
+        :param up_to: If not ``None``, only reindex the children with IDs up to (and including) this one.
+        :type up_to: :class:`bson.objectid.ObjectId` or ``None``
+        :param progress: If not ``None``, a function called after each bulk request with the collection, the number of children reindexed so far and the ID of the last one.
+        :type progress: callable or ``None``
+        :param processes: If not ``None``, reindex ranges of children in parallel with this many worker processes (see :func:`audrey.parallel.reindex_collections`; ``up_to`` isn't supported and ``progress`` is only called after each range).
+        :type processes: integer or ``None``
+        :param index_name: If not ``None``, index into this index only (see :func:`audrey.elasticindex.rebuild_index`).
+        :type index_name: string or ``None``
         :rtype: integer
         """
+        if processes:
+            from audrey import parallel
+            root = find_root(self)
+            start_after = start_after is not None and (self._collection_name, start_after) or None
+            return parallel.reindex_collections(root, [self._collection_name], processes=processes, clear=clear, start_after=start_after, progress=progress, rate_limit=rate_limit, bulk_size=bulk_size, index_name=index_name)
         if clear:
             self.clear_elastic()
+        if self.get_elastic_connection() is None:
+            return 0
+        spec = _make_id_range_spec(start_after, up_to)
+        return self._bulk_index(spec, [('_id', 1)], bulk_size, rate_limit, progress, index_name)
+
+    def _bulk_index(self, spec, sort, bulk_size, rate_limit, progress, index_name):
+        # Index the children matching spec (in sort order), sending the
+        # bulk request after every bulk_size children, and return the count.
+        # The bulk queue is flushed explicitly at each checkpoint (pyes
+        # may also send it sooner, when its own bulk_size is reached),
+        # so everything up to last_id has been sent when progress is called.
+        econn = self.get_elastic_connection()
+        cursor = self.get_mongo_collection().find(spec=spec, fields=self.get_elastic_index_fields(), sort=sort).batch_size(bulk_size)
         count = 0
-        if self._use_elastic:
-            for child in self.get_children_lazily():
-                child.index()
-                count += 1
+        last_id = None
+        start = time.time()
+        for doc in cursor:
+            child = self.construct_child_from_mongo_doc(doc)
+            child.index(bulk=True, defer=False, index_name=index_name)
+            count += 1
+            last_id = child._id
+            if count % bulk_size == 0:
+                econn.force_bulk()
+                self._reindex_bulk_done(count, last_id, start, rate_limit, progress)
+        if count % bulk_size:
+            econn.force_bulk()
+            self._reindex_bulk_done(count, last_id, start, rate_limit, progress)
+        return count
+
+    def _reindex_bulk_done(self, count, last_id, start, rate_limit, progress):
+        if progress is not None:
+            progress(self, count, last_id)
+        if rate_limit:
+            delay = count / float(rate_limit) - (time.time() - start)
+            if delay > 0:
+                time.sleep(delay)
+
+    def reindex_modified(self, since=None, bulk_size=REINDEX_BULK_SIZE, rate_limit=None, progress=None, unindex_missing=True, save_checkpoint=True, index_name=None):
+        """ Catch up ElasticSearch with the changes made to this collection
+        since a point in time (after an ElasticSearch outage or restore,
+        for example): reindex the children modified since then
+        (found with the index on ``_modified``; see :meth:`get_mongo_indexes`)
+        and unindex the documents of children that no longer exist
+        (see :meth:`unindex_missing`).
+
+        :param since: Reindex the children modified at or after this time.  If ``None``, use the checkpoint saved by the last call (see :meth:`get_reindex_checkpoint`), or reindex all children if there isn't one.
+        :type since: datetime.datetime or ``None``
+        :param bulk_size: like the param to :meth:`reindex_all`
+        :type bulk_size: integer
+        :param rate_limit: like the param to :meth:`reindex_all`
+        :type rate_limit: number or ``None``
+        :param progress: like the param to :meth:`reindex_all`
+        :type progress: callable or ``None``
+        :param unindex_missing: Should documents of children that no longer exist be unindexed?
+        :type unindex_missing: boolean
+        :param save_checkpoint: Should the time this call started be saved as the checkpoint for the next call?
+        :type save_checkpoint: boolean
+        :param index_name: like the param to :meth:`reindex_all` (also passed to :meth:`unindex_missing`)
+        :type index_name: string or ``None``
+        :rtype: dictionary with the keys "reindexed" and "unindexed" (integer counts) and "checkpoint" (the time this call started, less :data:`REINDEX_CHECKPOINT_MARGIN`)
+        """
+        checkpoint = dateutil.utcnow() - REINDEX_CHECKPOINT_MARGIN
+        # MongoDB stores times to the millisecond, so truncate the
+        # checkpoint likewise (rounding down is safe) to return what's saved.
+        checkpoint = checkpoint.replace(microsecond=checkpoint.microsecond // 1000 * 1000)
+        result = dict(reindexed=0, unindexed=0, checkpoint=checkpoint)
+        if self.get_elastic_connection() is None:
+            return result
+        if since is None:
+            since = self.get_reindex_checkpoint()
+        spec = since is not None and {'_modified':{'$gte':since}} or None
+        result['reindexed'] = self._bulk_index(spec, [('_modified', 1)], bulk_size, rate_limit, progress, index_name)
+        if unindex_missing:
+            result['unindexed'] = self.unindex_missing(chunk_size=bulk_size, index_name=index_name)
+        if save_checkpoint:
+            self.set_reindex_checkpoint(checkpoint)
+        return result
+
+    def unindex_missing(self, chunk_size=REINDEX_BULK_SIZE, index_name=None):
+        """ Unindex the ElasticSearch documents of this collection's
+        children that no longer exist in MongoDB.
+        This scans the IDs of all the collection's documents in
+        ElasticSearch (without their sources).
+
+        :param chunk_size: the number of IDs checked at a time
+        :type chunk_size: integer
+        :param index_name: If not ``None``, scan and unindex from this index only (instead of scanning the app's index and unindexing from those returned by :meth:`get_elastic_write_index_names`).
+        :type index_name: string or ``None``
+        :rtype: integer (the number of documents unindexed)
+        """
+        econn = self.get_elastic_connection()
+        if econn is None:
+            return 0
+        mongo_coll = self.get_mongo_collection()
+        count = 0
+        index_names = index_name and [index_name] or self.get_elastic_write_index_names()
+        for ids in self._iter_elastic_id_chunks(chunk_size, index_name):
+            existing = set([doc['_id'] for doc in mongo_coll.find({'_id':{'$in':ids}}, fields=[])])
+            for id in ids:
+                if id not in existing:
+                    for name in index_names:
+                        econn.delete(name, self.get_elastic_doctype(), str(id), bulk=True)
+                    count += 1
+        find_root(self).flush_elastic_bulk()
         return count
 
+    def _iter_elastic_id_chunks(self, chunk_size, index_name=None):
+        # Yield lists of the ObjectIds of this collection's documents
+        # in ElasticSearch (in index_name, if given), using a scan search.
+        econn = self.get_elastic_connection()
+        results = econn.search_raw(dict(query=dict(match_all={}), fields=[]),
+            indices=[index_name or self.get_elastic_index_name()], doc_types=[self.get_elastic_doctype()],
+            search_type='scan', scroll=REINDEX_SCROLL_TIMEOUT, size=chunk_size)
+        while True:
+            results = econn.search_scroll(results['_scroll_id'], REINDEX_SCROLL_TIMEOUT)
+            hits = results['hits']['hits']
+            if not hits:
+                return
+            yield [ObjectId(hit['_id']) for hit in hits if ObjectId.is_valid(hit['_id'])]
+
+    def get_reindex_checkpoint(self):
+        """ Return the checkpoint saved by the last call to
+        :meth:`reindex_modified`, or ``None``.
+
+        :rtype: datetime.datetime or ``None``
+        """
+        doc = find_root(self).get_mongo_collection(REINDEX_CHECKPOINTS_COLLECTION).find_one(dict(_id=self._collection_name))
+        return doc and doc['checkpoint'] or None
+
+    def set_reindex_checkpoint(self, checkpoint):
+        """ Save a checkpoint for :meth:`reindex_modified`.
+
+        :param checkpoint: a time
+        :type checkpoint: datetime.datetime
+        """
+        find_root(self).get_mongo_collection(REINDEX_CHECKPOINTS_COLLECTION).save(dict(_id=self._collection_name, checkpoint=checkpoint), **self.get_write_concern())
+
+    def get_id_ranges(self, count, start_after=None):
+        """ Split this collection's children into at most ``count`` ranges of
+        IDs with about the same number of children in each.
+        Used to partition a parallel reindex.
+
+        :param count: the number of ranges wanted
+        :type count: integer
+        :param start_after: If not ``None``, only include the children with greater IDs.
+        :type start_after: :class:`bson.objectid.ObjectId` or ``None``
+        :rtype: list of ``(start_after, up_to)`` tuples like the params to :meth:`reindex_all` (``None`` meaning unbounded)
+        """
+        mongo_coll = self.get_mongo_collection()
+        spec = _make_id_range_spec(start_after, None)
+        total = mongo_coll.find(spec=spec, fields=[]).count()
+        bounds = []
+        for i in range(1, count):
+            skip = total * i // count
+            if skip == 0 or (bounds and skip == bounds[-1][0]):
+                continue
+            # The last ID of each range.
+            for doc in mongo_coll.find(spec=spec, fields=[], sort=[('_id', 1)], skip=skip - 1, limit=1):
+                bounds.append((skip, doc['_id']))
+        ranges = []
+        for (skip, up_to) in bounds:
+            ranges.append((start_after, up_to))
+            start_after = up_to
+        ranges.append((start_after, None))
+        return ranges
+
+    def get_elastic_index_fields(self):
+        """ Return the names of the MongoDB document fields needed
+        to index this collection's children (used by :meth:`reindex_all`),
+        or ``None`` for all fields.
+
+        The default implementation returns the non-schema fields,
+        ``_object_type`` and the top-level schema names for which
+        :meth:`audrey.resources.object.Object.affects_elastic_index`
+        returns ``True`` (for any of the collection's object classes).
+
+        :rtype: list of strings or ``None``
+        """
+        fields = set(['_object_type'])
+        for obj_cls in self.get_object_classes():
+            obj = obj_cls(self.request)
+            fields.update(obj.get_nonschema_values().keys())
+            fields.update([name for name in obj.get_schema_names() if obj.affects_elastic_index([name])])
+        return sorted(fields)
+
+    def search(self, search_string='', filters=None, skip=0, limit=10, sort=None, highlight_fields=None, object_fields=None, facets=None, **kwargs):
+        """ Search this collection's children in ElasticSearch.
+        Takes the same params as
+        :meth:`audrey.resources.root.Root.basic_fulltext_search`
+        (except ``collection_names``) and returns the same kind of
+        dictionary.
+
+        :param filters: constraints on the values of mapped fields, as described for :meth:`get_elastic_filter`
+        :type filters: dictionary, or ``None``
+
+        Raises :exc:`ValueError` for invalid filters and for ``facets``
+        that aren't ``"_type"`` or mapped fields that are indexed but not
+        analyzed (such as ``text``; the terms of analyzed strings would
+        be counted instead of whole values).
+        """
+        if facets:
+            _check_facets(facets, _flatten_elastic_mapping(self.get_elastic_mapping()))
+        return find_root(self).basic_fulltext_search(search_string=search_string, collection_names=[self._collection_name], skip=skip, limit=limit, sort=sort, highlight_fields=highlight_fields, object_fields=object_fields, filter=self.get_elastic_filter(filters), facets=facets, **kwargs)
+
+    def export_search(self, search_string='', filters=None, object_fields=None, **kwargs):
+        """ Like :meth:`search`, but for all the matching children
+        (in no particular order); see
+        :meth:`audrey.resources.root.Root.export_search`, which is passed
+        the other keyword arguments (such as ``page_size``) and whose
+        kind of dictionary is returned.
+
+        Raises :exc:`ValueError` for invalid filters.
+        """
+        return find_root(self).export_search(search_string=search_string, collection_names=[self._collection_name], object_fields=object_fields, filter=self.get_elastic_filter(filters), **kwargs)
+
+    def get_elastic_filter(self, filters):
+        """ Return an ElasticSearch filter that only matches children
+        satisfying all the constraints in ``filters``, or ``None`` if
+        there aren't any.
+
+        Each key of ``filters`` is the name of a field in
+        :meth:`get_elastic_mapping` (with dots between the names of
+        nested fields, such as ``"location.city"``), optionally followed
+        by ``__gt``, ``__gte``, ``__lt`` or ``__lte`` for a range constraint.
+        Without a suffix, the value may be a list of values, any of which
+        may match (like MongoDB's ``$in``).
+
+        Values may be strings (such as request params); they're converted
+        according to the field's type.  Dates and datetimes are in
+        ISO 8601 format, booleans are "true" or "false" and
+        reference fields take object IDs.
+
+        Raises :exc:`ValueError` for unmapped (or unindexed) fields,
+        analyzed string fields (whose terms wouldn't match whole values;
+        map them with ``elastic_index="not_analyzed"`` to filter on them)
+        and invalid values.
+
+        :param filters: a dictionary of field names and values (or lists of values)
+        :type filters: dictionary, or ``None``
+        :rtype: :class:`pyes.filters.Filter` or ``None``
+        """
+        if not filters:
+            return None
+        field_types = _flatten_elastic_mapping(self.get_elastic_mapping())
+        reference_fields = set()
+        for obj_cls in self.get_object_classes():
+            for (name, typ) in obj_cls.get_elastic_field_types().items():
+                if typ == audrey.types.Reference:
+                    reference_fields.add(name)
+        clauses = []
+        ranges = OrderedDict()
+        for key in sorted(filters):
+            name = key
+            op = None
+            if key not in field_types and '__' in key:
+                (name, op) = key.rsplit('__', 1)
+                if op not in FILTER_RANGE_OPERATORS:
+                    raise ValueError("Unknown filter: %s" % key)
+            mapping = field_types.get(name)
+            if mapping is None:
+                raise ValueError("Unknown filter field: %s" % name)
+            if mapping.get('index') == 'no':
+                raise ValueError("Field isn't indexed: %s" % name)
+            if _is_analyzed(mapping):
+                raise ValueError("Field is analyzed: %s" % name)
+            values = filters[key]
+            if not isinstance(values, (list, tuple, set)):
+                values = [values]
+            if not values:
+                raise ValueError("No values for filter: %s" % key)
+            values = [_convert_filter_value(name, mapping['type'], name in reference_fields, value) for value in values]
+            if op is not None:
+                if len(values) > 1:
+                    raise ValueError("Multiple values for range filter: %s" % key)
+                (value_arg, include_arg, include) = FILTER_RANGE_OPERATORS[op]
+                range_args = ranges.setdefault(name, {})
+                range_args[value_arg] = values[0]
+                range_args[include_arg] = include
+            elif len(values) == 1:
+                clauses.append(pyes.TermFilter(name, values[0]))
+            else:
+                clauses.append(pyes.TermsFilter(name, values))
+        for (name, range_args) in ranges.items():
+            clauses.append(pyes.RangeFilter(pyes.ESRange(name, **range_args)))
+        if len(clauses) == 1:
+            return clauses[0]
+        return pyes.BoolFilter(must=clauses)
+
 class NamingCollection(Collection):
     """ A subclass of :class:`Collection` that allows control over the
     ``__name__`` attribute.
@@ -480,7 +1276,7 @@ class NamingCollection(Collection):
 
     @classmethod
     def get_elastic_mapping(cls):
-        mapping = Collection.get_elastic_mapping()
+        mapping = super(NamingCollection, cls).get_elastic_mapping()
         # Add "__name__", unanalyzed and not in "_all"
         mapping[cls._NAME_FIELD] = dict(type='string', include_in_all=False, index='not_analyzed')
         return mapping
@@ -531,13 +1327,19 @@ class NamingCollection(Collection):
         if not name: return "Name may not be empty."
         err = self.validate_name_format(name)
         if err: return err
-        if unique and self.has_child_with_name(name): return "The name \"%s\" is already in use." % name
+        if unique and self.has_child_with_name(name): return self._get_name_in_use_error(name)
         return None
 
-    def veto_add_child(self, child):
+    def veto_add_child(self, child, unique=True):
         err = Collection.veto_add_child(self, child)
         if err: return err
-        return self.veto_child_name(child.__name__)
+        return self.veto_child_name(child.__name__, unique=unique)
+
+    def get_duplicate_key_error(self, child):
+        return self._get_name_in_use_error(child.__name__)
+
+    def _get_name_in_use_error(self, name):
+        return "The name \"%s\" is already in use." % name
 
     def rename_child(self, name, newname, validate=True):
         """ Rename a child of this collection.
@@ -551,14 +1353,117 @@ class NamingCollection(Collection):
         :param validate: Should we validate the new name first?
         :type validate: boolean
         :rtype: integer indicating number of children renamed.  Should be 1 normally, but may be 0 if ``newname`` == ``name``.
+
+        The child isn't loaded; its ``__name__`` (and ``_modified``)
+        are simply updated in MongoDB and ElasticSearch, right away
+        even if a unit of work is active.
+        A :class:`audrey.exceptions.Veto` exception is raised if
+        ``newname`` is already in use (regardless of ``validate``).
         """
         if name == newname: return 0
         if validate:
-            error = self.veto_child_name(newname)
+            error = self.veto_child_name(newname, unique=False)
             if error: raise Veto(error)
-        child = self.get_child_by_name(name)
-        if child is None:
+        values = {self._NAME_FIELD:newname, '_modified':dateutil.utcnow()}
+        queue = find_root(self).get_index_queue()
+        if getattr(queue, 'write_ahead', False) and self.get_elastic_connection() is not None:
+            # Record the change in the outbox before writing it.
+            doc = self.get_mongo_collection().find_one({self._NAME_FIELD:name}, fields=['_object_type'])
+            if doc is not None and self._get_child_class_from_mongo_doc(doc)._use_elastic:
+                queue.put(self._collection_name, doc['_id'], indexqueue.INDEX)
+        try:
+            doc = self.get_mongo_collection().find_and_modify({self._NAME_FIELD:name}, {'$set':values, '$unset':{INDEX_HASH_FIELD:1}}, fields=['_object_type'])
+        except OperationFailure, e:
+            if not _is_duplicate_key_error(e): raise
+            raise Veto(self._get_name_in_use_error(newname))
+        if doc is None:
             raise KeyError, "No such child %r" % name
-        child.__name__ = newname
-        child.save()
+        if self._get_child_class_from_mongo_doc(doc)._use_elastic:
+            self.update_elastic_doc(doc['_id'], values)
         return 1
+
+def _post_elastic_update(econn, index_name, doctype, id, body):
+    # Send a request to ElasticSearch's update API (new in ES 0.19).
+    # pyes 0.19.1 has no wrapper for it (its ES.update() gets the whole
+    # document and reindexes it client side), so this relies on the
+    # private ES._send_request(); revisit when upgrading pyes.
+    path = make_path([index_name, doctype, str(id), '_update'])
+    return econn._send_request('POST', path, body)
+
+def _is_conditional_write(request):
+    # Is the request a PUT or DELETE with the precondition headers
+    # required by audrey.views.object_put and object_delete?
+    if request is None or getattr(request, 'method', None) not in ('PUT', 'DELETE'):
+        return False
+    headers = request.headers
+    return bool(headers.get('If-Match') and headers.get('If-Unmodified-Since'))
+
+def _is_duplicate_key_error(e):
+    # Is the pymongo OperationFailure e due to a unique index?
+    return isinstance(e, DuplicateKeyError) or getattr(e, 'code', None) in DUPLICATE_KEY_ERRORS
+
+def _flatten_elastic_mapping(properties, prefix=''):
+    # Return the leaf fields of ElasticSearch mapping properties
+    # by dotted name.
+    fields = {}
+    for (name, mapping) in properties.items():
+        if mapping.get('type') == 'object':
+            fields.update(_flatten_elastic_mapping(mapping.get('properties', {}), prefix + name + '.'))
+        else:
+            fields[prefix + name] = mapping
+    return fields
+
+def _is_analyzed(mapping):
+    # Is the field with these ElasticSearch mapping properties an
+    # analyzed string (the default for strings)?
+    return mapping.get('type') == 'string' and mapping.get('index', 'analyzed') == 'analyzed'
+
+def _check_facets(facets, field_types):
+    # Raise ValueError unless each of facets is "_type" or a field in
+    # field_types (from _flatten_elastic_mapping()) that is indexed and
+    # not analyzed.
+    for name in facets:
+        if name == '_type': continue
+        mapping = field_types.get(name)
+        if mapping is None:
+            raise ValueError("Unknown facet field: %s" % name)
+        if mapping.get('index') == 'no':
+            raise ValueError("Field isn't indexed: %s" % name)
+        if _is_analyzed(mapping):
+            raise ValueError("Field is analyzed: %s" % name)
+
+def _convert_filter_value(name, elastic_type, is_reference, value):
+    # Convert a get_elastic_filter() value (possibly a string) for
+    # the field with the given ElasticSearch type.
+    try:
+        if is_reference:
+            value = str(value)
+            if not ObjectId.is_valid(value):
+                raise ValueError
+        elif elastic_type == 'long':
+            value = int(value)
+        elif elastic_type == 'double':
+            value = float(value)
+        elif elastic_type == 'boolean':
+            if isinstance(value, basestring):
+                value = dict(true=True, false=False)[value.lower()]
+            value = bool(value)
+        elif elastic_type == 'date':
+            if isinstance(value, basestring):
+                value = colander.DateTime().deserialize(colander.SchemaNode(colander.DateTime()), value)
+            value = value.isoformat()
+        elif elastic_type == 'string' and not isinstance(value, basestring):
+            value = unicode(value)
+    except (ValueError, TypeError, KeyError, AttributeError, colander.Invalid):
+        raise ValueError("Invalid value for %s: %r" % (name, value))
+    return value
+
+def _make_id_range_spec(start_after, up_to):
+    # A MongoDB query spec for the IDs greater than start_after
+    # and up to (and including) up_to, or None for all IDs.
+    id_spec = {}
+    if start_after is not None:
+        id_spec['$gt'] = start_after
+    if up_to is not None:
+        id_spec['$lte'] = up_to
+    return id_spec and {'_id':id_spec} or None
@@ -1,13 +1,19 @@
 import datetime
 import hashlib
+import json
+import weakref
 from pprint import pformat
 import colander
 from bson.dbref import DBRef
 from bson.objectid import ObjectId
 from pyramid.traversal import find_root
 import pyes
+from pyes.es import ESJsonEncoder
 from audrey import dateutil
-from audrey.htmlutil import html_to_text
+from audrey.exceptions import PreconditionFailed
+from audrey.mongoutil import get_affected_count
+from audrey import indexqueue
+from audrey.htmlutil import cached_html_to_text
 from audrey.resources.file import File
 from audrey.resources.reference import Reference
 from audrey.resources.generic import make_traversable
@@ -15,6 +21,10 @@ import audrey.types
 
 GRIDFS_COLLECTION = "fs"
 
+# Name of the MongoDB field holding a hash of the document last
+# written to ElasticSearch by Object.save().
+INDEX_HASH_FIELD = "_index_hash"
+
 class Object(object):
     """ Base class for objects that can be stored in MongoDB and
     indexed in ElasticSearch.
@@ -68,6 +78,11 @@ class Object(object):
         * ``include_in_text``: boolean, defaults to True; if True, the value will be included in Elastic's full text index.
         * ``is_html``: boolean, defaults to False; if True, the value will be stripped of html markup before being indexed in Elastic.
 
+        and the following kwargs for nodes of any type:
+
+        * ``elastic_index``: "analyzed", "not_analyzed" or "no"; if given, the value will also be indexed in Elastic as a field of its own (see :meth:`get_elastic_mapping`).
+        * ``elastic_store``: boolean, defaults to False; if True, the value will be indexed in Elastic as a stored field (even without ``elastic_index``).
+
         The default implementation of this method simply returns the
         class attribute ``_schema``.
 
@@ -78,9 +93,71 @@ class Object(object):
         be sure to start by creating a deepcopy of ``_schema``, or
         ditch the use of that class attribute altogether and construct
         the schema inside this method.
+        What Audrey compiles from the schema (such as the full text
+        extraction plan) is cached per Object class, so if the
+        *structure* of the schema (its nodes and the kwargs above) varies
+        by request, also set ``_cache_schema_plans`` to ``False``.
         """
         return cls._schema
 
+    # Cache what's compiled from the schema (the full text plan and
+    # ElasticSearch fields) per Object class?  Otherwise it's cached per
+    # schema instance, which only helps if get_class_schema() returns
+    # the same instance each time (unlike a bound or deepcopied schema).
+    _cache_schema_plans = True
+
+    @classmethod
+    def _get_schema_cache_key(cls, schema):
+        return cls._cache_schema_plans and cls or schema
+
+    @classmethod
+    def get_elastic_mapping(cls, request=None):
+        """ Return a dictionary of ElasticSearch mapping properties for
+        the schema values that are indexed as fields of their own (those
+        whose schema nodes have an ``elastic_index`` or ``elastic_store``
+        kwarg; see :meth:`get_class_schema`).
+
+        Fields are mapped for :class:`colander.String`,
+        :class:`colander.Integer`, :class:`colander.Float`,
+        :class:`colander.Decimal`, :class:`colander.Boolean`,
+        :class:`colander.DateTime`, :class:`colander.Date` and
+        :class:`audrey.types.Reference` nodes (whose ObjectIds are
+        indexed as strings).  The kwargs of a :class:`colander.Mapping`
+        or :class:`colander.Sequence` node apply to the nodes within
+        (unless they have their own).  Mappings are mapped as objects
+        and sequences as arrays.
+
+        Strings are analyzed by default; for sorting, use
+        ``elastic_index="not_analyzed"``.  Reference ids aren't analyzed
+        unless ``elastic_index`` says so, and the other types are never
+        analyzed.
+
+        :param request: the current request, possibly ``None``
+        :type request: :class:`pyramid.request.Request`
+        :rtype: dictionary
+        """
+        schema = cls.get_class_schema(request)
+        return _get_elastic_fields(schema, cls._get_schema_cache_key(schema))[0]
+
+    @classmethod
+    def get_elastic_field_types(cls, request=None):
+        """ Return the colander types of the fields in
+        :meth:`get_elastic_mapping` by name (with dots between the names
+        of fields within mappings, such as ``"location.city"``).
+
+        :param request: the current request, possibly ``None``
+        :type request: :class:`pyramid.request.Request`
+        :rtype: dictionary of colander type classes
+        """
+        schema = cls.get_class_schema(request)
+        return _get_elastic_field_types(schema, _get_elastic_fields(schema, cls._get_schema_cache_key(schema))[0])
+
+    # Should a save that doesn't need to reindex this Object still update
+    # the _modified date of its ElasticSearch document in place (costing
+    # an ElasticSearch write)?  Otherwise the indexed _modified is left
+    # as it was until the next reindex.
+    _index_modified_in_place = False
+
     # Should this Object use Elastic?
     # Note that this setting only matters if the Collection's _use_elastic=True.
     _use_elastic = True
@@ -211,6 +288,17 @@ class Object(object):
         assert getattr(self, '__parent__', None), "parentless child!"
         return self.__parent__.get_elastic_index_name()
 
+    def get_elastic_write_index_names(self):
+        """ Return the names of the ElasticSearch indices that this object
+        should be written to (normally just the one returned by
+        :meth:`get_elastic_index_name`).
+        This is just a convenience method that returns the names from the root.
+
+        :rtype: list of strings
+        """
+        assert getattr(self, '__parent__', None), "parentless child!"
+        return self.__parent__.get_elastic_write_index_names()
+
     def get_elastic_doctype(self):
         """ Return the ElasticSearch document type for this object.
 
@@ -285,7 +373,7 @@ class Object(object):
                 ret.append(obj)
         return ret
 
-    def save(self, validate_schema=True, index=True, set_modified=True, set_etag=True):
+    def save(self, validate_schema=True, index=True, set_modified=True, set_etag=True, if_match=None, if_unmodified_since=None, write_concern=None):
         """
         Save this object in MongoDB (and optionally ElasticSearch).
 
@@ -297,42 +385,190 @@ class Object(object):
         :type set_modified: boolean
         :param set_etag: Should the object's Etag be updated?
         :type set_etag: boolean
+        :param if_match: If not ``None``, only save if the stored object's Etag is still this value.
+        :type if_match: string or ``None``
+        :param if_unmodified_since: If not ``None``, only save if the stored object's last modified timestamp is still this value (to the second, like an HTTP date).
+        :type if_unmodified_since: datetime.datetime or ``None``
+        :param write_concern: overrides the collection's MongoDB write concern (see :meth:`audrey.resources.collection.Collection.get_write_concern`)
+        :type write_concern: dictionary or ``None``
+
+        If a unit of work is active (see :meth:`audrey.resources.root.Root.begin_unit_of_work`) the object is validated, but only written when the unit of work is committed.
+
+        If the object was loaded from (or already saved to) MongoDB, only
+        the attributes that changed since then are written (with a
+        ``$set``/``$unset`` update), and the object is only reindexed
+        if any of them affect its ElasticSearch document (see
+        :meth:`affects_elastic_index`; the ``_modified`` and ``_etag``
+        metadata don't count).  Otherwise ElasticSearch isn't written to
+        at all, so the indexed ``_modified`` date is left as it was (as
+        with :meth:`audrey.resources.collection.Collection.update_children`),
+        unless the class sets ``_index_modified_in_place`` to have it
+        updated in place (see
+        :meth:`audrey.resources.collection.Collection.update_elastic_doc`).
+        A hash of the ElasticSearch document (see
+        :meth:`get_elastic_index_hash`) is saved with the object, and
+        the object isn't reindexed if the document hasn't changed since
+        it was last indexed by a save.  Reindexing clears the saved hash,
+        and the new hash is only saved (with a separate update) once
+        ElasticSearch has acknowledged the write, so it isn't saved for
+        bulk writes or writes left to the app's index queue.
+        If the app has an outbox (see :class:`audrey.outbox.Outbox`), a
+        change record is added before the object is written to MongoDB
+        (so a new object is given its ``_id`` first).
+
+        When ``if_match`` or ``if_unmodified_since`` is given, the check and
+        the write are one atomic compare-and-swap (bypassing any active
+        unit of work), and :class:`audrey.exceptions.PreconditionFailed`
+        is raised if the stored object doesn't match (or doesn't exist).
+        The object needn't have been loaded: one that only has an ``_id``
+        or ``__name__`` (such as from :meth:`audrey.resources.collection.Collection.construct_child_stub`)
+        gets its other non-schema values from the stored object.
         """
-        if validate_schema:
-            self.validate_schema() # May raise a colander.Invalid exception
-        if set_modified:
-            self._modified = dateutil.utcnow()
-            if not getattr(self, '_created', None): self._created = self._modified
-        if set_etag:
-            self._etag = self.generate_etag()
+        self._pre_save(validate_schema=validate_schema, set_modified=set_modified, set_etag=set_etag)
 
-        # Determine all the GridFS file ids that this object
-        # now refers to and used to refer to.
+        conditional = if_match is not None or if_unmodified_since is not None
         root = find_root(self)
+        uow = root.get_unit_of_work()
+        if uow is not None and not conditional:
+            uow.save(self, index=index)
+            return
+
+        wc = self.__parent__.get_write_concern(write_concern)
         fs_files_coll = root.get_gridfs()._GridFS__files
         new_file_ids = set([x._id for x in self.get_all_files()])
-        old_file_ids = set()
-        if self._id:
-            dbref = self.get_dbref()
-            for item in fs_files_coll.find({'parents':dbref}, fields=[]):
-                old_file_ids.add(item['_id'])
-
-        # Persist the object in Mongo.
         doc = self.get_mongo_save_doc()
-        id = self.get_mongo_collection().save(doc, safe=True)
-        if not self._id:
-            self._id = id
+        saved_doc = getattr(self, '_saved_doc', None)
+        diff = None
+        if saved_doc is not None:
+            diff = _diff_mongo_docs(saved_doc, doc)
+
+        # Decide whether to reindex.  Skip it if the changes can't affect
+        # the ElasticSearch document or if the document is the same as
+        # the one last indexed (which is only known when indexing now).
+        # When the document isn't reindexed but _modified changed,
+        # only _modified is updated in ElasticSearch, if the class
+        # opts in with _index_modified_in_place.
+        reindex = index
+        modified_changed = diff is not None and '_modified' in diff[0]
+        if reindex and diff is not None:
+            changed_names = set(diff[0].keys() + diff[1]) - set(['_modified', '_etag'])
+            reindex = self.affects_elastic_index(list(changed_names))
+        index_doc = index_hash = None
+        if reindex and (saved_doc is not None or not conditional) and \
+           self.get_elastic_connection() is not None and root.get_index_queue() is None:
+            index_doc = self.get_elastic_index_doc()
+            index_hash = self.get_elastic_index_hash(index_doc)
+            if index_hash == getattr(self, '_index_hash', None):
+                reindex = False
+        update_modified = index and not reindex and modified_changed and self._index_modified_in_place
+        assigned_id = False
+        if reindex or update_modified:
+            assigned_id = self._write_ahead_to_outbox(assign_id=not conditional)
+            if assigned_id:
+                doc['_id'] = self._id
+
+        written = False
+        if conditional:
+            if saved_doc is not None:
+                (set_values, unset_names) = diff
+            else:
+                # We don't know what's stored, so write everything
+                # except the (possibly unknown) _id and _created.
+                set_values = dict(doc)
+                set_values.pop('_id', None)
+                set_values.pop('_created', None)
+                unset_names = []
+            if reindex:
+                unset_names.append(INDEX_HASH_FIELD)
+            update = _make_mongo_update(set_values, unset_names) or {'$set':{'_etag':self._etag}}
+            spec = self._get_precondition_spec(if_match, if_unmodified_since)
+            old_doc = self.get_mongo_collection().find_and_modify(spec, update)
+            if old_doc is None:
+                raise PreconditionFailed("The object has been changed or removed.")
+            if saved_doc is None:
+                self._id = old_doc['_id']
+                self._created = _demongify_values(old_doc.get('_created'))
+                doc = self.get_mongo_save_doc()
+            old_file_ids = set(_find_files(_demongify_values(old_doc)).keys())
             dbref = self.get_dbref()
+            written = True
+        elif self._id and saved_doc is not None:
+            # Only write the values that changed.
+            (set_values, unset_names) = diff
+            if reindex:
+                unset_names.append(INDEX_HASH_FIELD)
+            update = _make_mongo_update(set_values, unset_names)
+            if update:
+                result = self.get_mongo_collection().update({'_id':self._id}, update, **wc)
+                # If the document has vanished, fall back to a full save.
+                written = bool(get_affected_count(result, 1))
+            else:
+                written = True
+            old_file_ids = set(_find_files(_demongify_values(saved_doc)).keys())
+            dbref = self.get_dbref()
+
+        if not written:
+            # Whatever was indexed for the object, index it anew.
+            reindex = index
+            update_modified = False
+            # Determine all the GridFS file ids that this object
+            # used to refer to.
+            old_file_ids = set()
+            if self._id and not assigned_id:
+                dbref = self.get_dbref()
+                for item in fs_files_coll.find({'parents':dbref}, fields=[]):
+                    old_file_ids.add(item['_id'])
+
+            # Persist the whole object in Mongo (without any index hash).
+            id = self.get_mongo_collection().save(doc, **wc)
+            if not self._id or assigned_id:
+                self._id = id
+                dbref = self.get_dbref()
+        self._saved_doc = doc
+        if reindex or not written:
+            self._index_hash = None
 
         # Update GridFS file "parents".
         ids_to_remove = old_file_ids - new_file_ids
         ids_to_add = new_file_ids - old_file_ids
         if ids_to_remove:
-            fs_files_coll.update({'_id':{'$in':list(ids_to_remove)}}, {"$pull":{"parents":dbref}, "$set":{"lastmodDate": dateutil.utcnow()}}, multi=True)
+            fs_files_coll.update({'_id':{'$in':list(ids_to_remove)}}, {"$pull":{"parents":dbref}, "$set":{"lastmodDate": dateutil.utcnow()}}, multi=True, **wc)
         if ids_to_add:
-            fs_files_coll.update({'_id':{'$in':list(ids_to_add)}}, {"$addToSet":{"parents":dbref}, "$set":{"lastmodDate": dateutil.utcnow()}}, multi=True)
-
-        if index: self.index()
+            fs_files_coll.update({'_id':{'$in':list(ids_to_add)}}, {"$addToSet":{"parents":dbref}, "$set":{"lastmodDate": dateutil.utcnow()}}, multi=True, **wc)
+
+        if reindex:
+            self.index(doc=index_doc)
+            if index_hash is not None and not root.use_elastic_bulk():
+                # ElasticSearch has acknowledged the write, so save the
+                # hash (unless the object has been saved again since).
+                self.get_mongo_collection().update({'_id':self._id, '_etag':self._etag}, {'$set':{INDEX_HASH_FIELD:index_hash}}, **wc)
+                self._index_hash = index_hash
+        elif update_modified:
+            self.__parent__.update_elastic_doc(self._id, dict(_modified=self._modified))
+
+    def _get_precondition_spec(self, if_match=None, if_unmodified_since=None):
+        # Return a MongoDB query spec matching this object's document
+        # only if it satisfies the given preconditions.
+        if self._id is not None:
+            spec = {'_id':self._id}
+        else:
+            spec = {self.__parent__._NAME_FIELD:self.__name__}
+        if if_match is not None:
+            spec['_etag'] = if_match
+        if if_unmodified_since is not None:
+            # HTTP dates only have a resolution of one second.
+            since = if_unmodified_since.replace(microsecond=0)
+            spec['_modified'] = {'$gte':since, '$lt':since + datetime.timedelta(seconds=1)}
+        return spec
+
+    def _pre_save(self, validate_schema=True, set_modified=True, set_etag=True):
+        if validate_schema:
+            self.validate_schema() # May raise a colander.Invalid exception
+        if set_modified:
+            self._modified = dateutil.utcnow()
+            if not getattr(self, '_created', None): self._created = self._modified
+        if set_etag:
+            self._etag = self.generate_etag()
 
     def generate_etag(self):
         """ Compute an Etag based on the object's schema values.
@@ -365,9 +601,12 @@ class Object(object):
         :type doc: dictionary
         """
         clean = _demongify_values(doc)
+        self._index_hash = clean.pop(INDEX_HASH_FIELD, None)
         self.set_nonschema_values(**clean)
         clean = _apply_schema_to_values(self.get_schema(), clean)
         self.set_schema_values(**clean)
+        # Remember what was loaded so that save() can tell what changed.
+        self._saved_doc = self.get_mongo_save_doc()
 
     def get_dbref(self, include_database=False):
         """ Return a DBRef for this object.
@@ -382,42 +621,101 @@ class Object(object):
             dbname = coll.database.name 
         return DBRef(coll.name, self._id, dbname)
 
-    def _pre_delete(self):
+    def _pre_delete(self, write_concern=None):
         # Remove from ElasticSearch
         self.unindex()
         # Update parents attribute of related GridFS files
         dbref = self.get_dbref()
         root = find_root(self)
         fs_files_coll = root.get_gridfs()._GridFS__files
-        fs_files_coll.update({'parents':dbref}, {"$pull":{"parents":dbref}, "$set":{"lastmodDate": dateutil.utcnow()}}, multi=True)
+        fs_files_coll.update({'parents':dbref}, {"$pull":{"parents":dbref}, "$set":{"lastmodDate": dateutil.utcnow()}}, multi=True, **self.__parent__.get_write_concern(write_concern))
 
-    def index(self):
+    def index(self, bulk=None, defer=None, index_name=None, doc=None):
         """ Index (or reindex) this object in ElasticSearch.
 
         Note that this is a no-op when use of ElasticSearch is disabled
         (for this Object, its collection or the app).
+
+        :param bulk: Should the write be queued for a bulk request (sent by :meth:`audrey.resources.root.Root.flush_elastic_bulk`)?  If ``None``, defer to :meth:`audrey.resources.root.Root.use_elastic_bulk`.
+        :type bulk: boolean or ``None``
+        :param defer: Should the write be left to the app's index queue (see :meth:`audrey.resources.root.Root.get_index_queue`)?  If ``None``, defer whenever the app has an index queue.
+        :type defer: boolean or ``None``
+        :param index_name: If not ``None``, write to this index only (instead of those returned by :meth:`get_elastic_write_index_names`).
+        :type index_name: string or ``None``
+        :param doc: the document to write, if already returned by :meth:`get_elastic_index_doc`
+        :type doc: dictionary or ``None``
+        :rtype: list
+
+        Returns the ElasticSearch responses (for bulk writes, those of
+        any bulk requests that were sent because the bulk queue filled up).
         """
         econn = self.get_elastic_connection()
-        if econn is None: return
-        doc = self.get_elastic_index_doc()
-        econn.index(doc, self.get_elastic_index_name(), self.get_elastic_doctype(), str(self._id))
-
-    def unindex(self):
+        if econn is None: return []
+        if self._defer_to_index_queue(indexqueue.INDEX, defer): return []
+        if bulk is None:
+            bulk = find_root(self).use_elastic_bulk()
+        if doc is None:
+            doc = self.get_elastic_index_doc()
+        index_names = index_name and [index_name] or self.get_elastic_write_index_names()
+        responses = []
+        for name in index_names:
+            response = econn.index(doc, name, self.get_elastic_doctype(), str(self._id), bulk=bulk)
+            if response is not None:
+                responses.append(response)
+        return responses
+
+    def unindex(self, bulk=None, defer=None):
         """ Unindex this object in ElasticSearch.
 
+        :param bulk: like the ``bulk`` param to :meth:`index`
+        :type bulk: boolean or ``None``
+        :param defer: like the ``defer`` param to :meth:`index`
+        :type defer: boolean or ``None``
         :rtype: integer
 
         Returns the number of items affected (normally this will
         be 1, but it may be 0 if use of ElasticSearch is disabled or
         if the object wasn't indexed to begin with).
+        Bulk and deferred deletes are assumed to affect 1 item.
         """
         econn = self.get_elastic_connection()
         if econn is None: return 0
-        try:
-            econn.delete(self.get_elastic_index_name(), self.get_elastic_doctype(), str(self._id))
-            return 1
-        except pyes.exceptions.NotFoundException, e:
-            return 0
+        if self._defer_to_index_queue(indexqueue.UNINDEX, defer): return 1
+        if bulk is None:
+            bulk = find_root(self).use_elastic_bulk()
+        count = 0
+        for name in self.get_elastic_write_index_names():
+            try:
+                econn.delete(name, self.get_elastic_doctype(), str(self._id), bulk=bulk)
+                count = 1
+            except pyes.exceptions.NotFoundException, e:
+                pass
+        return count
+
+    def _defer_to_index_queue(self, op, defer):
+        # Put op on the app's index queue (if deferring) and return
+        # True, or return False to write now.
+        if defer is False: return False
+        queue = find_root(self).get_index_queue()
+        if queue is None: return False
+        queue.put(self.__parent__._collection_name, self._id, op)
+        return True
+
+    def _write_ahead_to_outbox(self, assign_id=False):
+        # If the app's index queue wants records before MongoDB writes
+        # (see audrey.outbox.Outbox.write_ahead), add a record to
+        # (re)index this object.  If assign_id, a new object is first
+        # given its _id.  Returns True if the _id was assigned.
+        if self.get_elastic_connection() is None: return False
+        queue = find_root(self).get_index_queue()
+        if not getattr(queue, 'write_ahead', False): return False
+        assigned = False
+        if not self._id and assign_id:
+            self._id = ObjectId()
+            assigned = True
+        if self._id:
+            queue.put(self.__parent__._collection_name, self._id, indexqueue.INDEX)
+        return assigned
 
     def get_elastic_index_doc(self):
         """ Returns a dictionary representing this object suitable
@@ -425,11 +723,70 @@ class Object(object):
 
         :rtype: dictionary
         """
-        return dict(
+        result = self.get_elastic_field_values()
+        result.update(
             _created = self._created,
             _modified = self._modified,
             text = self.get_fulltext_to_index(),
         )
+        return result
+
+    def get_elastic_field_values(self):
+        """ Returns the values of the fields in :meth:`get_elastic_mapping`
+        (for :meth:`get_elastic_index_doc`), converted for ElasticSearch.
+        Missing values are ``None``.
+
+        :rtype: dictionary
+        """
+        values = self.get_schema_values()
+        return dict((name, convert(values.get(name))) for (name, convert) in self._get_elastic_fields()[1])
+
+    def get_elastic_index_hash(self, doc=None):
+        """ Return a hash of this object's ElasticSearch document,
+        ignoring ``_modified`` (like :meth:`save`, which uses the hash to
+        tell whether the object needs reindexing).
+        ``_modified`` is left out so that saves which only change the
+        metadata don't reindex, so the indexed ``_modified`` is only as
+        current as the last reindex (or in-place update; see
+        ``_index_modified_in_place`` and :meth:`save`).
+
+        :param doc: the document, if already returned by :meth:`get_elastic_index_doc`
+        :type doc: dictionary or ``None``
+        :rtype: string
+        """
+        if doc is None:
+            doc = self.get_elastic_index_doc()
+        doc = dict(doc)
+        doc.pop('_modified', None)
+        h = hashlib.new('md5')
+        h.update(json.dumps(doc, sort_keys=True, cls=ESJsonEncoder))
+        return h.hexdigest()
+
+    def affects_elastic_index(self, names):
+        """ Could changing the named top-level schema attributes change
+        this object's ElasticSearch document?
+        Used by :meth:`audrey.resources.collection.Collection.update_children` to decide whether to reindex.
+
+        The default implementation returns ``True`` if any of the attributes
+        contribute to the full text (see :meth:`get_fulltext_to_index`) or
+        are fields of :meth:`get_elastic_mapping` (so it doesn't have to
+        build the index document).  Override this if your index documents
+        are derived from schema values in other ways.
+
+        :param names: attribute names
+        :type names: list of strings
+        :rtype: boolean
+        """
+        schema = self.get_schema()
+        index_keys = set(self._get_elastic_fields()[0])
+        index_keys.update(['_created', '_modified', 'text'])
+        for name in names:
+            if name in index_keys:
+                return True
+            node = schema.get(name)
+            if node is not None and _node_has_text(node):
+                return True
+        return False
 
     def get_fulltext_to_index(self):
         """ Returns a string containing the "full text" for this object.
@@ -443,36 +800,25 @@ class Object(object):
         the text value will be stripped of HTML markup.  (If the attribute
         is missing, it defaults to ``False``.)
 
+        The walk over the schema is only done once per Object class
+        (see :meth:`get_class_schema`); it's compiled into a list of the
+        paths to the text values, which is reused for other objects.
+
         :rtype: string
         """
-        return '\n'.join(self._get_text_values_for_schema_node(self.get_schema(), self.get_schema_values()))
+        schema = self.get_schema()
+        return '\n'.join(self._get_text_values_for_schema_node(schema, self.get_schema_values(), self._get_schema_cache_key(schema)))
 
-    def _get_text_values_for_schema_node(self, node, value):
+    def _get_text_values_for_schema_node(self, node, value, cache_key=None):
         result = []
-        if not value: return result
-        if type(node.typ) == colander.Mapping:
-            for cnode in node.children:
-                name = cnode.name
-                val = value.get(name, None)
-                if val:
-                    result += self._get_text_values_for_schema_node(cnode, val)
-        elif type(node.typ) == colander.Sequence:
-            if node.children:
-                cnode = node.children[0]
-                for val in value:
-                    result += self._get_text_values_for_schema_node(cnode, val)
-        elif type(node.typ) == colander.Tuple:
-            for (idx, cnode) in enumerate(node.children):
-                result += self._get_text_values_for_schema_node(cnode, value[idx])
-        elif type(node.typ) == colander.String:
-            if getattr(node, 'include_in_text', True):
-                if getattr(node, 'is_html', False):
-                    value = html_to_text(value, 0)
-                if value: result.append(value)
-        #elif type(node.typ) == deform.FileData:
-        #    pass # FIXME: handle PDF, Word, etc?
+        if value:
+            _extract_text(_get_text_plan(node, cache_key), value, result)
         return result
 
+    def _get_elastic_fields(self):
+        schema = self.get_schema()
+        return _get_elastic_fields(schema, self._get_schema_cache_key(schema))
+
     # Allow traversal to File attributes
     def __getitem__(self, name):
         if hasattr(self, name):
@@ -533,6 +879,9 @@ class NamedObject(Object):
         result['__name__'] = self.__name__
         return result
 
+    def affects_elastic_index(self, names):
+        return '__name__' in names or Object.affects_elastic_index(self, names)
+
 # Crawl over node and make sure all types are compatible with pymongo.
 def _mongify_values(node):
 
@@ -586,6 +935,34 @@ def _demongify_values(node):
     else:
         return node
 
+# Return a MongoDB update document for _diff_mongo_docs() results,
+# or None if there's nothing to update.
+def _make_mongo_update(set_values, unset_names):
+    update = {}
+    if set_values: update['$set'] = set_values
+    if unset_names: update['$unset'] = dict([(name, 1) for name in unset_names])
+    return update or None
+
+# Compare two documents (as returned by Object.get_mongo_save_doc).
+# Return a tuple (set_values, unset_names) where set_values is a dict
+# of the top-level values in new_doc that are new or different, and
+# unset_names is a list of the top-level names missing from new_doc.
+def _diff_mongo_docs(old_doc, new_doc):
+    set_values = {}
+    for (name, value) in new_doc.items():
+        if name not in old_doc:
+            set_values[name] = value
+            continue
+        try:
+            same = (value == old_doc[name]) and (type(value) == type(old_doc[name]))
+        except TypeError:
+            # Such as comparing naive and aware datetimes.
+            same = False
+        if not same:
+            set_values[name] = value
+    unset_names = [name for name in old_doc if name not in new_doc]
+    return (set_values, unset_names)
+
 # Crawl over node looking for File instances.
 # Return a dict of all File instances keyed by ObjectId.
 def _find_files(node):
@@ -614,6 +991,201 @@ def _find_references(node):
             ret.update(_find_references(value))
     return ret
 
+# Full text extraction plans (see _compile_text_plan) by cache key:
+# an Object class (see Object._cache_schema_plans) or the schema node.
+_text_plans = weakref.WeakKeyDictionary()
+
+def _get_text_plan(node, cache_key=None):
+    if cache_key is None: cache_key = node
+    plan = _text_plans.get(cache_key)
+    if plan is None:
+        plan = _text_plans[cache_key] = _compile_text_plan(node)
+    return plan
+
+# Compile the walk over node done by Object.get_fulltext_to_index()
+# into a list of (path, is_html, item_plan) tuples, one for each String
+# node that contributes to the full text (when item_plan is None) or
+# Sequence node that may contain some (when item_plan is the plan for
+# its items), in schema order.  The path is a tuple of the Mapping
+# keys and Tuple indexes leading to the node's value.
+def _compile_text_plan(node, path=()):
+    plan = []
+    if type(node.typ) == colander.Mapping:
+        for cnode in node.children:
+            plan += _compile_text_plan(cnode, path + (cnode.name,))
+    elif type(node.typ) == colander.Sequence:
+        if node.children:
+            item_plan = _compile_text_plan(node.children[0])
+            if item_plan:
+                plan.append((path, False, item_plan))
+    elif type(node.typ) == colander.Tuple:
+        for (idx, cnode) in enumerate(node.children):
+            plan += _compile_text_plan(cnode, path + (idx,))
+    elif type(node.typ) == colander.String:
+        if getattr(node, 'include_in_text', True):
+            plan.append((path, getattr(node, 'is_html', False), None))
+    #elif type(node.typ) == deform.FileData:
+    #    pass # FIXME: handle PDF, Word, etc?
+    return plan
+
+# Append the text values found by following plan in value to result.
+def _extract_text(plan, value, result):
+    for (path, is_html, item_plan) in plan:
+        val = value
+        for key in path:
+            # Missing and empty values have no text.
+            if type(key) is int:
+                val = val[key]
+            else:
+                val = val.get(key)
+            if not val: break
+        if not val: continue
+        if item_plan is not None:
+            for item in val:
+                if item:
+                    _extract_text(item_plan, item, result)
+        else:
+            if is_html:
+                val = cached_html_to_text(val, 0)
+                if not val: continue
+            result.append(val)
+
+# ElasticSearch field types by colander type.
+_ELASTIC_FIELD_TYPES = {
+    colander.String: 'string',
+    colander.Integer: 'long',
+    colander.Float: 'double',
+    colander.Decimal: 'double',
+    colander.Boolean: 'boolean',
+    colander.DateTime: 'date',
+    colander.Date: 'date',
+    audrey.types.Reference: 'string',
+}
+
+# ElasticSearch fields (see _compile_elastic_properties) by cache key,
+# like _text_plans.
+_elastic_fields = weakref.WeakKeyDictionary()
+
+def _get_elastic_fields(node, cache_key=None):
+    if cache_key is None: cache_key = node
+    fields = _elastic_fields.get(cache_key)
+    if fields is None:
+        fields = _elastic_fields[cache_key] = _compile_elastic_properties(node, {})
+    return fields
+
+# Compile the ElasticSearch fields for the children of a Mapping node
+# (see Object.get_elastic_mapping) into a tuple (properties, converters)
+# where properties is a dict of field mappings and converters is a list
+# of (name, function) tuples; each function converts the child's value
+# to its field value.  options has the elastic_* kwargs inherited from
+# the node and its ancestors.
+def _compile_elastic_properties(node, options):
+    properties = {}
+    converters = []
+    if type(node.typ) == colander.Mapping:
+        options = _get_elastic_options(node, options)
+        for cnode in node.children:
+            field = _compile_elastic_field(cnode, options)
+            if field is not None:
+                properties[cnode.name] = field[0]
+                converters.append((cnode.name, field[1]))
+    return (properties, converters)
+
+# Compile the ElasticSearch field for a node into a tuple
+# (field mapping, converter function), or return None if the node
+# has no field.
+def _compile_elastic_field(node, options):
+    typ = type(node.typ)
+    if typ == colander.Mapping:
+        (properties, converters) = _compile_elastic_properties(node, options)
+        if not properties: return None
+        return (dict(type='object', properties=properties), _make_mapping_converter(converters))
+    options = _get_elastic_options(node, options)
+    if typ == colander.Sequence:
+        # Arrays are mapped like their items.
+        if not node.children: return None
+        field = _compile_elastic_field(node.children[0], options)
+        if field is None: return None
+        return (field[0], _make_sequence_converter(field[1]))
+    if typ not in _ELASTIC_FIELD_TYPES: return None
+    if not (options.get('elastic_index') or options.get('elastic_store')): return None
+    mapping = dict(type=_ELASTIC_FIELD_TYPES[typ], include_in_all=False)
+    index = options.get('elastic_index')
+    if typ == audrey.types.Reference:
+        # Reference ids are only useful as whole terms.
+        mapping['index'] = index or 'not_analyzed'
+    elif mapping['type'] == 'string':
+        mapping['index'] = index or 'analyzed'
+    else:
+        mapping['index'] = index == 'no' and 'no' or 'not_analyzed'
+    if mapping['type'] == 'date':
+        mapping['format'] = 'dateOptionalTime'
+    if options.get('elastic_store'):
+        mapping['store'] = 'yes'
+    if typ == audrey.types.Reference:
+        return (mapping, _convert_reference)
+    return (mapping, _convert_value)
+
+# Return the colander types of the fields in properties (as compiled
+# for the Mapping node) by dotted name.
+def _get_elastic_field_types(node, properties, prefix=''):
+    types = {}
+    for (name, mapping) in properties.items():
+        cnode = node.get(name)
+        while type(cnode.typ) == colander.Sequence:
+            cnode = cnode.children[0]
+        if mapping['type'] == 'object':
+            types.update(_get_elastic_field_types(cnode, mapping['properties'], prefix + name + '.'))
+        else:
+            types[prefix + name] = type(cnode.typ)
+    return types
+
+def _get_elastic_options(node, options):
+    # Return options updated with the node's own elastic_* kwargs.
+    options = dict(options)
+    for name in ('elastic_index', 'elastic_store'):
+        if getattr(node, name, None) is not None:
+            options[name] = getattr(node, name)
+    return options
+
+def _convert_value(value):
+    if value is colander.null: return None
+    return value
+
+def _convert_reference(value):
+    if value is None or value is colander.null: return None
+    return str(getattr(value, 'id', value))
+
+def _make_mapping_converter(converters):
+    def convert(value):
+        if not value: return None
+        return dict((name, conv(value.get(name))) for (name, conv) in converters)
+    return convert
+
+def _make_sequence_converter(convert_item):
+    def convert(value):
+        if value is None or value is colander.null: return None
+        return [convert_item(item) for item in value]
+    return convert
+
+# Does node (or any of its descendants) contribute to the full text?
+def _node_has_text(node):
+    if type(node.typ) == colander.String:
+        return getattr(node, 'include_in_text', True)
+    for cnode in node.children:
+        if _node_has_text(cnode):
+            return True
+    return False
+
+# Could values for node (or any of its descendants) refer to GridFS files?
+def _node_may_have_files(node):
+    if type(node.typ) == audrey.types.File:
+        return True
+    for cnode in node.children:
+        if _node_may_have_files(cnode):
+            return True
+    return False
+
 def _apply_schema_to_values(node, value):
     if value is None: return None
     if type(node.typ) == colander.Mapping:
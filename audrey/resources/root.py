@@ -5,7 +5,21 @@ from bson.objectid import ObjectId
 import pyes
 from audrey import dateutil
 from audrey import sortutil
+from audrey import mongoutil
+from audrey import unitofwork
+from audrey import elasticindex
 from audrey.resources.file import File
+from audrey.resources.collection import _check_facets, _flatten_elastic_mapping, _is_analyzed
+
+# Default maximum number of terms counted by each search facet.
+DEFAULT_FACET_SIZE = 10
+
+# Default time ElasticSearch keeps a scrolling search's context alive
+# between requests for pages.
+DEFAULT_SCROLL = '5m'
+
+# Default number of hits per shard in each page of export_search().
+DEFAULT_EXPORT_PAGE_SIZE = 100
 
 class Root(object):
     """
@@ -107,6 +121,34 @@ class Root(object):
         """
         return self.get_mongo_db()[coll_name]
 
+    def get_write_concern(self):
+        """ Return the app's default MongoDB write concern
+        (see :meth:`audrey.resources.collection.Collection.get_write_concern`).
+        This is the ``write_concern`` setting if there is one,
+        otherwise ``{'w': 1}`` (acknowledged writes).
+
+        :rtype: dictionary of :mod:`pymongo` write concern options
+        """
+        wc = self.get_write_concern_setting('write_concern')
+        if wc is None:
+            wc = dict(mongoutil.DEFAULT_WRITE_CONCERN)
+        return wc
+
+    def get_write_concern_setting(self, name):
+        """ Return the write concern from the setting ``name``
+        (such as ``w=majority j=true``; see
+        :func:`audrey.mongoutil.parse_write_concern`),
+        or ``None`` if there's no such setting.
+
+        :param name: a setting name
+        :type name: string
+        :rtype: dictionary of :mod:`pymongo` write concern options or ``None``
+        """
+        wc = self.request.registry.settings.get(name)
+        if isinstance(wc, basestring):
+            wc = mongoutil.parse_write_concern(wc)
+        return wc
+
     def get_gridfs(self):
         """ Return the MongoDB GridFS for the app.
 
@@ -133,6 +175,67 @@ class Root(object):
         """
         return self.request.registry.settings['elastic_name']
 
+    def get_elastic_write_index_names(self):
+        """ Return the names of the ElasticSearch indices that writes
+        should go to: the one returned by :meth:`get_elastic_index_name`
+        (an alias) plus, while :meth:`rebuild_elastic` is running,
+        the new version of the index.
+
+        :rtype: list of strings
+        """
+        return elasticindex.get_write_index_names(self.get_elastic_connection(), self.get_elastic_index_name())
+
+    def use_elastic_bulk(self):
+        """ Should ElasticSearch writes (by :meth:`audrey.resources.object.Object.index` and :meth:`audrey.resources.object.Object.unindex`) be queued for a bulk request instead of being sent immediately?
+
+        This is the case during a batch request (see
+        :func:`audrey.views.root_batch`), which sets the WSGI environ key
+        ``audrey.elastic_bulk``.  Queued writes are sent by
+        :meth:`flush_elastic_bulk`.
+
+        :rtype: boolean
+        """
+        return bool(self.request.environ.get('audrey.elastic_bulk'))
+
+    def flush_elastic_bulk(self):
+        """ Send any queued bulk ElasticSearch writes.
+
+        :rtype: dictionary (the bulk response) or ``None`` if nothing was sent
+        """
+        econn = self.get_elastic_connection()
+        if econn is not None:
+            return econn.force_bulk()
+        return None
+
+    def get_index_queue(self):
+        """ Return the app's ElasticSearch index queue, or ``None``
+        if ElasticSearch writes are made immediately.
+        The queue is configured by the ``elastic_index_queue`` setting,
+        or is a durable outbox if the ``elastic_outbox`` setting is true.
+
+        :rtype: :class:`audrey.indexqueue.IndexQueue`, :class:`audrey.outbox.Outbox` or ``None``
+        """
+        return self.request.registry.settings.get('index_queue')
+
+    def get_unit_of_work(self):
+        """ Return the active unit of work for the current request, or ``None``.
+        While one is active, saves and deletes of Objects are recorded
+        by it instead of being written immediately.
+
+        :rtype: :class:`audrey.unitofwork.UnitOfWork` or ``None``
+        """
+        return unitofwork.get_unit_of_work(self.request.environ)
+
+    def begin_unit_of_work(self):
+        """ Begin a unit of work for the current request (or join the
+        active one) and return it.
+        Call its ``commit`` method (or use it as a context manager) to
+        write the saves and deletes made in the meantime in bulk.
+
+        :rtype: :class:`audrey.unitofwork.UnitOfWork`
+        """
+        return unitofwork.begin_unit_of_work(self.request.environ)
+
     def get_object_for_collection_and_id(self, collection_name, id, fields=None):
         """ Return the Object identified by the given ``collection_name``
         and ``id``.
@@ -261,6 +364,8 @@ class Root(object):
         * "total": total number of matching hits
         * "took": search time in ms
         * "items": a list of dictionaries, each with the keys "object" and highlight"
+        * "facets": a dictionary of the term facets in the results (if any) by name, each a dictionary with the keys "terms" (a list of dictionaries with the keys "term" and "count"), "total", "missing" and "other"
+        * "scroll_id": the ID for :meth:`continue_search` if the search is scrolling, otherwise ``None``
 
         :param object_fields: like ``fields`` param to :meth:`audrey.resources.collection.Collection.get_children`)
         """
@@ -275,6 +380,8 @@ class Root(object):
             items = items,
             total = results['hits']['total'],
             took = results['took'],
+            facets = _get_facet_counts(results),
+            scroll_id = results.get('_scroll_id'),
         )
 
     def get_objects_for_raw_search_results(self, results, object_fields=None):
@@ -284,6 +391,7 @@ class Root(object):
         * "total": total number of matching hits
         * "took": search time in ms
         * "items": a list of :class:`audrey.resources.object.Object` instances
+        * "facets" and "scroll_id": as for :meth:`get_objects_and_highlights_for_raw_search_results`
 
         :param object_fields: like ``fields`` param to :meth:`audrey.resources.collection.Collection.get_children`)
         """
@@ -305,7 +413,7 @@ class Root(object):
         """
         return self.get_objects_for_raw_search_results(self.search_raw(query=query, doc_types=doc_types, **query_parms), object_fields=object_fields)
 
-    def basic_fulltext_search(self, search_string='', collection_names=None, skip=0, limit=10, sort=None, highlight_fields=None, object_fields=None):
+    def basic_fulltext_search(self, search_string='', collection_names=None, skip=0, limit=10, sort=None, highlight_fields=None, object_fields=None, filter=None, facets=None, facet_size=DEFAULT_FACET_SIZE, scroll=None):
         """ A functional basic full text search.
         Also a good example of using the other search methods.
 
@@ -325,15 +433,19 @@ class Root(object):
         :param highlight_fields: a list of Elastic mapping fields in which to highlight ``search_string`` matches. For example, to highlight matches in Audrey's default full "text" field: ``['text']``
         :type highlight_fields: list of strings, or ``None``
         :param object_fields: like ``fields`` param to :meth:`audrey.resources.collection.Collection.get_children`)
+        :param filter: restrict results to documents matching an Elastic filter (such as one made by :meth:`audrey.resources.collection.Collection.get_elastic_filter`); filters don't affect relevance scores and are cached by Elastic
+        :type filter: :class:`pyes.filters.Filter`, or ``None``
+        :param facets: names of Elastic mapping fields for which to count the matching documents with each value (the top ``facet_size`` values), computed by the same Elastic request as the results. Use ``"_type"`` to count matches by collection name.
+        :type facets: list of strings, or ``None``
+        :param facet_size: maximum number of terms counted for each facet
+        :type facet_size: integer
+        :param scroll: If not ``None``, start a scrolling search whose context ElasticSearch keeps for this long (such as ``"5m"``), so that the following pages of ``limit`` results can be got with :meth:`continue_search` (at a constant cost per page, unlike ``skip``).
+        :type scroll: string or ``None``
         :rtype: dictionary
 
         Returns a dictionary like :meth:`get_objects_and_highlights_for_raw_search_results` when ``highlight_fields``.  Otherwise returns a dictionary like :meth:`get_objects_for_raw_search_results`.
         """
-        search_string = search_string.strip()
-        if search_string:
-            query = pyes.StringQuery(search_string)
-        else:
-            query = pyes.MatchAllQuery()
+        query = self.get_fulltext_query(search_string, filter)
         # Set fields=[] since we only need _id and _type (which are always
         # in Elastic results) to get the objects out of MongoDB.
         # Retrieving _source would just waste resources.
@@ -341,9 +453,116 @@ class Root(object):
         if highlight_fields:
             for hf in highlight_fields:
                 search.add_highlight(hf)
+        if facets:
+            for name in facets:
+                search.facet.add_term_facet(name, size=facet_size)
         elastic_sort = sort and sortutil.sort_string_to_elastic(sort) or None
         method = highlight_fields and self.get_objects_and_highlights_for_query or self.get_objects_for_query
-        return method(query=search, doc_types=collection_names, sort=elastic_sort, object_fields=object_fields)
+        return method(query=search, doc_types=collection_names, sort=elastic_sort, object_fields=object_fields, scroll=scroll)
+
+    def check_facets(self, facets, collection_names=None):
+        """ Raise :exc:`ValueError` unless each of ``facets`` may be passed
+        to :meth:`basic_fulltext_search` for a search of the named
+        collections: it must be ``"_type"`` or a field mapped by at least
+        one of them (see :meth:`audrey.resources.collection.Collection.get_elastic_mapping`)
+        that none of them leave unindexed or analyzed.
+
+        :param facets: facet field names
+        :type facets: list of strings
+        :param collection_names: names of the collections searched, or ``None`` for all
+        :type collection_names: list of strings or ``None``
+        """
+        field_types = {}
+        for name in collection_names or self.get_collection_names():
+            coll = self.get_collection(name)
+            if coll is None: continue
+            for (field, mapping) in _flatten_elastic_mapping(coll.get_elastic_mapping()).items():
+                if field not in field_types or mapping.get('index') == 'no' or _is_analyzed(mapping):
+                    field_types[field] = mapping
+        _check_facets(facets, field_types)
+
+    def get_fulltext_query(self, search_string='', filter=None):
+        """ Return the Elastic query used by :meth:`basic_fulltext_search`.
+
+        :param search_string: a query string that may contain wildcards or boolean operators
+        :type search_string: string
+        :param filter: like the param to :meth:`basic_fulltext_search`
+        :type filter: :class:`pyes.filters.Filter`, or ``None``
+        :rtype: :class:`pyes.query.Query`
+        """
+        search_string = (search_string or '').strip()
+        if search_string:
+            query = pyes.StringQuery(search_string)
+        else:
+            query = pyes.MatchAllQuery()
+        if filter is not None:
+            query = pyes.FilteredQuery(query, filter)
+        return query
+
+    def continue_search(self, scroll_id, scroll=DEFAULT_SCROLL, highlights=False, object_fields=None):
+        """ Return the next page of results of a scrolling search
+        (see the ``scroll`` param to :meth:`basic_fulltext_search`),
+        in a dictionary like that returned by
+        :meth:`get_objects_and_highlights_for_raw_search_results` if
+        ``highlights`` or else by :meth:`get_objects_for_raw_search_results`.
+        Its "scroll_id" is the ID for the page after that.
+
+        Raises a :class:`pyes.exceptions.ElasticSearchException` if the
+        search's context has expired.
+
+        :param scroll_id: the "scroll_id" of the previous page of results
+        :type scroll_id: string
+        :param scroll: how long ElasticSearch should keep the search's context for the next page
+        :type scroll: string
+        :param highlights: Does the search have highlight fields?
+        :type highlights: boolean
+        :param object_fields: like ``fields`` param to :meth:`audrey.resources.collection.Collection.get_children`)
+        :rtype: dictionary
+        """
+        econn = self.get_elastic_connection()
+        if econn is None:
+            raise RuntimeError("Use of ElasticSearch is disabled.")
+        results = econn.search_scroll(scroll_id, scroll)
+        method = highlights and self.get_objects_and_highlights_for_raw_search_results or self.get_objects_for_raw_search_results
+        return method(results, object_fields=object_fields)
+
+    def export_search(self, search_string='', collection_names=None, object_fields=None, filter=None, page_size=DEFAULT_EXPORT_PAGE_SIZE, scroll=DEFAULT_SCROLL):
+        """ Like :meth:`basic_fulltext_search`, but for all the matching
+        objects (in no particular order).
+        ElasticSearch's scan search type is used to get the hits a page
+        at a time (of up to ``page_size`` hits per shard), at a constant
+        cost per page however many there are.
+
+        Returns a dictionary with the keys:
+
+        * "total": total number of matching hits
+        * "took": time in ms for ElasticSearch to start the scan
+        * "items": an iterator of :class:`audrey.resources.object.Object` instances, which gets each page as needed
+
+        :param page_size: number of hits per shard in each page
+        :type page_size: integer
+        :param scroll: how long ElasticSearch should keep the scan's context between pages
+        :type scroll: string
+        :rtype: dictionary
+        """
+        search = pyes.Search(query=self.get_fulltext_query(search_string, filter), fields=[], size=page_size)
+        results = self.search_raw(query=search, doc_types=collection_names, search_type='scan', scroll=scroll)
+        return dict(
+            total = results['hits']['total'],
+            took = results['took'],
+            items = self._iter_scan_objects(results['_scroll_id'], scroll, object_fields),
+        )
+
+    def _iter_scan_objects(self, scroll_id, scroll, object_fields):
+        econn = self.get_elastic_connection()
+        while True:
+            results = econn.search_scroll(scroll_id, scroll)
+            # The scan is over when a page has no hits.
+            if not results['hits']['hits']:
+                return
+            scroll_id = results['_scroll_id']
+            for obj in self.get_objects_for_raw_search_results(results, object_fields=object_fields)['items']:
+                yield obj
 
     def clear_elastic(self):
         """ Delete all documents from Elastic for all Collections.
@@ -351,19 +570,88 @@ class Root(object):
         for coll in self.get_collections():
             coll.clear_elastic()
 
-    def reindex_all(self, clear=False):
+    def reindex_all(self, clear=False, collection_names=None, start_after=None, processes=None, **kwargs):
         """ Reindex all documents in Elastic for all Collections.
         Returns a count of the objects reindexed.
 
+        Other keyword arguments (such as ``bulk_size``, ``rate_limit``
+        and ``progress``) are passed to
+        :meth:`audrey.resources.collection.Collection.reindex_all`.
+
         :param clear: Should we clear the index first?
         :type clear: boolean
+        :param collection_names: names of the collections to reindex, or ``None`` for all
+        :type collection_names: list of strings or ``None``
+        :param start_after: If not ``None``, resume an interrupted reindex after this collection name and object ID (skipping earlier collections and not clearing this one).  Raises :class:`ValueError` if the collection isn't one of those to reindex.
+        :type start_after: tuple of (string, :class:`bson.objectid.ObjectId`) or ``None``
+        :param processes: If not ``None``, reindex ranges of objects in parallel with this many worker processes (see :func:`audrey.parallel.reindex_collections`).
+        :type processes: integer or ``None``
         :rtype: integer
         """
+        if processes:
+            from audrey import parallel
+            return parallel.reindex_collections(self, collection_names, processes=processes, clear=clear, start_after=start_after, **kwargs)
         count = 0
-        for coll in self.get_collections():
-            count += coll.reindex_all(clear=clear)
+        for name in self._get_collection_names_to_reindex(collection_names, start_after):
+            coll = self.get_collection(name)
+            coll_start_after = None
+            if start_after is not None and name == start_after[0]:
+                coll_start_after = start_after[1]
+            count += coll.reindex_all(clear=clear and coll_start_after is None, start_after=coll_start_after, **kwargs)
         return count
 
+    def _get_collection_names_to_reindex(self, collection_names=None, start_after=None):
+        # Return the names of the collections to reindex, skipping
+        # those before start_after's collection.
+        names = list(collection_names or self.get_collection_names())
+        if start_after is not None:
+            if start_after[0] not in names:
+                raise ValueError("Can't resume reindexing after unknown collection \"%s\"; expected one of %s." % (start_after[0], ', '.join(names)))
+            names = names[names.index(start_after[0]):]
+        return names
+
+    def reindex_modified(self, since=None, collection_names=None, **kwargs):
+        """ Catch up ElasticSearch with the changes made to all Collections
+        since a point in time.
+        See :meth:`audrey.resources.collection.Collection.reindex_modified`
+        (which is passed the other keyword arguments).
+
+        :param since: If not ``None``, reindex the objects modified at or after this time (instead of since each collection's saved checkpoint).
+        :type since: datetime.datetime or ``None``
+        :param collection_names: names of the collections to catch up, or ``None`` for all
+        :type collection_names: list of strings or ``None``
+        :rtype: dictionary with the keys "reindexed" and "unindexed" (integer counts)
+        """
+        counts = dict(reindexed=0, unindexed=0)
+        for name in collection_names or self.get_collection_names():
+            result = self.get_collection(name).reindex_modified(since=since, **kwargs)
+            counts['reindexed'] += result['reindexed']
+            counts['unindexed'] += result['unindexed']
+        return counts
+
+    def rebuild_elastic(self, **kwargs):
+        """ Rebuild the ElasticSearch index (with the current mappings)
+        without interrupting searches, and return the number of objects
+        indexed.  See :func:`audrey.elasticindex.rebuild_index` (which
+        is passed the keyword arguments).
+
+        :rtype: integer
+        """
+        return elasticindex.rebuild_index(self, **kwargs)['count']
+
     def refresh_elastic(self):
         econn = self.get_elastic_connection()
         econn.indices.refresh(self.get_elastic_index_name())
+
+def _get_facet_counts(results):
+    # Return the term facets in pyes search results by name
+    # (without ES's "_type" keys).
+    facets = {}
+    for (name, facet) in results.get('facets', {}).items():
+        facets[name] = dict(
+            terms = facet.get('terms', []),
+            total = facet.get('total', 0),
+            missing = facet.get('missing', 0),
+            other = facet.get('other', 0),
+        )
+    return facets
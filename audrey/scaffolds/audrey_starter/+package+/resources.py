@@ -40,12 +40,13 @@ class Post(audrey.resources.object.Object):
     _schema = colander.SchemaNode(colander.Mapping())
     _schema.add(colander.SchemaNode(colander.String(), name='title'))
     _schema.add(colander.SchemaNode(colander.DateTime(), name='dateline',
-                missing=deferred_datetime_now))
+                missing=deferred_datetime_now, elastic_index='not_analyzed'))
     _schema.add(colander.SchemaNode(colander.String(), name='body',
                 is_html=True))
     _schema.add(colander.SchemaNode(
                 audrey.types.Reference(collection='people'),
-                name='author', default=None, missing=None))
+                name='author', default=None, missing=None,
+                elastic_index='not_analyzed'))
 
     @classmethod
     def get_class_schema(cls, request=None):
@@ -0,0 +1,56 @@
+import optparse
+import os
+import sys
+import timeit
+from audrey import htmlutil
+
+# The sample used when no files are given: a typical blog post body,
+# repeated.
+SAMPLE_HTML = '''<h2>Heading &amp; more</h2>
+<p>Some <b>bold</b> and <em>emphasized</em> text with a
+<a href="http://example.com/?a=1&amp;b=2">link</a>, entities like
+&eacute;, &#8212; and&nbsp;non-breaking spaces.<br/>Next line.</p>
+<ul><li>One</li><li>Two</li><li>Three</li></ul>
+<script>var x = 1;</script>
+'''
+
+def main(argv=sys.argv):
+    """ The ``audrey_htmlbench`` console script, which compares the speed
+    (and output) of :func:`audrey.htmlutil.html_to_text` and the
+    original htmllib-based implementation::
+
+        audrey_htmlbench page1.html page2.html
+
+    Without files, a generated sample document is used.
+    """
+    parser = optparse.OptionParser(
+        usage='%prog [options] [file ...]',
+        description="Benchmark Audrey's HTML to text conversion.")
+    parser.add_option('-n', '--number', type='int', default=20,
+        help='Number of conversions per timing (default %default).')
+    parser.add_option('-r', '--repeat', type='int', default=3,
+        help='Number of timings; the best is reported (default %default).')
+    parser.add_option('--size', type='int', default=200,
+        help='Number of copies of the sample in the generated document (default %default).')
+    parser.add_option('-u', '--unicode', action='store_true', default=False,
+        help='Convert unicode strings instead of UTF-8 encoded strings.')
+    parser.add_option('--show-link-urls', action='store_true', default=False,
+        help='Write the URLs of links.')
+    (options, args) = parser.parse_args(argv[1:])
+
+    if args:
+        docs = [(os.path.basename(path), open(path, 'rb').read()) for path in args]
+    else:
+        docs = [('sample x %d' % options.size, SAMPLE_HTML * options.size)]
+    print '%-30s %10s %12s %12s %8s  %s' % ('document', 'bytes', 'legacy (ms)', 'new (ms)', 'speedup', 'same text')
+    for (name, html) in docs:
+        if options.unicode:
+            html = html.decode('utf-8')
+        times = []
+        texts = []
+        for func in (htmlutil.legacy_html_to_text, htmlutil.html_to_text):
+            convert = lambda: func(html, show_link_urls=options.show_link_urls)
+            texts.append(convert())
+            best = min(timeit.repeat(convert, number=options.number, repeat=options.repeat))
+            times.append(best / options.number * 1000)
+        print '%-30s %10d %12.2f %12.2f %7.1fx  %s' % (name[:30], len(html), times[0], times[1], times[0] / (times[1] or 1e-9), texts[0] == texts[1] and 'yes' or 'NO')
@@ -0,0 +1,43 @@
+import optparse
+import sys
+from pyramid.paster import bootstrap, setup_logging
+from audrey import outbox
+
+def main(argv=sys.argv):
+    """ The ``audrey_outbox`` console script, which applies the change
+    records in an app's outbox to ElasticSearch
+    (see :class:`audrey.outbox.Outbox`)::
+
+        audrey_outbox development.ini
+
+    Unless ``--once`` is given, it keeps polling for new records
+    until interrupted.
+    """
+    parser = optparse.OptionParser(
+        usage='%prog config_uri [options]',
+        description="Apply the change records in an Audrey app's outbox to ElasticSearch.")
+    parser.add_option('--once', action='store_true', default=False,
+        help='Exit when the outbox is empty instead of polling for new records.')
+    parser.add_option('--batch-size', type='int', default=outbox.DEFAULT_BATCH_SIZE,
+        help='Maximum number of records applied at a time (default %default).')
+    parser.add_option('--poll-interval', type='float', default=1.0,
+        help='Seconds to wait between polls of an empty outbox (default %default).')
+    (options, args) = parser.parse_args(argv[1:])
+    if len(args) != 1:
+        parser.error('You must provide one config_uri.')
+    config_uri = args[0]
+    setup_logging(config_uri)
+    env = bootstrap(config_uri)
+    try:
+        root = env['root']
+        box = root.get_index_queue()
+        if not isinstance(box, outbox.Outbox):
+            sys.exit('This app has no outbox (see the "elastic_outbox" setting).')
+        count = 0
+        try:
+            count = box.run(root, batch_size=options.batch_size, poll_interval=options.poll_interval, forever=not options.once)
+        except KeyboardInterrupt:
+            pass
+        print '%d change records applied.' % count
+    finally:
+        env['closer']()
@@ -0,0 +1,117 @@
+import datetime
+import json
+import multiprocessing
+import optparse
+import os
+import sys
+import time
+from bson.objectid import ObjectId
+from pyramid.paster import bootstrap, setup_logging
+from audrey.exceptions import ReindexError
+from audrey.resources.collection import REINDEX_BULK_SIZE
+
+def main(argv=sys.argv):
+    """ The ``audrey_reindex`` console script, which reindexes an app's
+    collections in ElasticSearch
+    (see :meth:`audrey.resources.root.Root.reindex_all`)::
+
+        audrey_reindex development.ini --checkpoint=reindex.json
+
+    With ``--checkpoint``, the collection name and ID of the last
+    object reindexed are saved to a file after each bulk request, and
+    a later run with the same file resumes from there.  The file is
+    removed when the reindex is complete.
+    """
+    parser = optparse.OptionParser(
+        usage='%prog config_uri [options]',
+        description="Reindex an Audrey app's collections in ElasticSearch.")
+    parser.add_option('-c', '--collection', action='append', dest='collection_names', metavar='NAME',
+        help='Reindex the named collection (may be repeated; default all collections).')
+    parser.add_option('--clear', action='store_true', default=False,
+        help='Clear each collection from the index first.')
+    parser.add_option('--incremental', action='store_true', default=False,
+        help='Only reindex objects modified since the last incremental reindex (and unindex deleted objects).')
+    parser.add_option('--since', metavar='TIME',
+        help='Like --incremental, but reindex objects modified since TIME (UTC, like 2012-12-24T01:52:45).')
+    parser.add_option('--rebuild', action='store_true', default=False,
+        help='Build a new version of the whole index (with the current mappings) and switch to it when done, without interrupting searches.')
+    parser.add_option('--bulk-size', type='int', default=REINDEX_BULK_SIZE,
+        help='Number of objects per bulk request (default %default).')
+    parser.add_option('--rate-limit', type='float', default=None,
+        help='Maximum number of objects reindexed per second.')
+    parser.add_option('--checkpoint', metavar='FILE',
+        help='Save progress to FILE, and resume from it if it exists.')
+    parser.add_option('-j', '--processes', type='int', default=None,
+        help='Reindex in parallel with this many worker processes (0 for one per CPU).')
+    parser.add_option('-q', '--quiet', action='store_true', default=False,
+        help="Don't report progress.")
+    (options, args) = parser.parse_args(argv[1:])
+    if len(args) != 1:
+        parser.error('You must provide one config_uri.')
+    if options.checkpoint and (options.processes is not None or options.rebuild):
+        parser.error('--checkpoint can\'t be used with --processes or --rebuild.')
+    if options.rebuild and (options.clear or options.collection_names):
+        parser.error('--rebuild can\'t be used with --clear or --collection.')
+    since = None
+    if options.since:
+        try:
+            since = datetime.datetime.strptime(options.since, '%Y-%m-%dT%H:%M:%S')
+        except ValueError:
+            parser.error('--since must be like 2012-12-24T01:52:45')
+        options.incremental = True
+    if options.incremental and (options.clear or options.rebuild or options.checkpoint or options.processes is not None):
+        parser.error('--incremental can\'t be used with --clear, --rebuild, --checkpoint or --processes.')
+    if options.processes == 0:
+        options.processes = multiprocessing.cpu_count()
+    config_uri = args[0]
+    setup_logging(config_uri)
+
+    start_after = None
+    if options.checkpoint and os.path.exists(options.checkpoint):
+        with open(options.checkpoint) as f:
+            checkpoint = json.load(f)
+        start_after = (checkpoint['collection'], ObjectId(checkpoint['last_id']))
+        if not options.quiet:
+            print 'Resuming after %s %s.' % start_after
+
+    start = time.time()
+    def progress(coll, count, last_id):
+        if options.checkpoint and last_id is not None:
+            write_checkpoint(options.checkpoint, coll.__name__, last_id)
+        if not options.quiet:
+            print '%s: %d reindexed (%.1f per second overall)' % (coll.__name__, count, count / max(time.time() - start, 0.001))
+
+    env = bootstrap(config_uri)
+    try:
+        if start_after is not None and start_after[0] not in (options.collection_names or env['root'].get_collection_names()):
+            parser.error('The checkpoint\'s collection "%s" isn\'t being reindexed; remove %s to start over.' % (start_after[0], options.checkpoint))
+        try:
+            if options.incremental:
+                result = env['root'].reindex_modified(since=since, collection_names=options.collection_names,
+                    bulk_size=options.bulk_size, rate_limit=options.rate_limit, progress=progress)
+                print '%d objects unindexed.' % result['unindexed']
+                count = result['reindexed']
+            elif options.rebuild:
+                count = env['root'].rebuild_elastic(bulk_size=options.bulk_size, rate_limit=options.rate_limit,
+                    progress=progress, processes=options.processes)
+            else:
+                count = env['root'].reindex_all(clear=options.clear, collection_names=options.collection_names,
+                    start_after=start_after, bulk_size=options.bulk_size, rate_limit=options.rate_limit,
+                    progress=progress, processes=options.processes)
+        except ReindexError, e:
+            for (name, range_start_after, range_up_to, error) in e.failures:
+                print 'Failed to reindex %s after %s up to %s:\n%s' % (name, range_start_after, range_up_to, error)
+            sys.exit('%d objects reindexed; %d ranges failed.' % (e.count, len(e.failures)))
+        if options.checkpoint and os.path.exists(options.checkpoint):
+            os.remove(options.checkpoint)
+        print '%d objects reindexed in %.1f seconds.' % (count, time.time() - start)
+    finally:
+        env['closer']()
+
+def write_checkpoint(path, collection_name, last_id):
+    """ Save reindex progress to the file at ``path`` (replacing it atomically).
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(dict(collection=collection_name, last_id=str(last_id)), f)
+    os.rename(tmp_path, path)
@@ -171,6 +171,35 @@ class UtilTests(unittest.TestCase):
         self.assertEqual(htmlutil.html_to_text('''<a href="http://python.org">Ooh, a link!</a>''', show_link_urls=True), '''Ooh, a link! [http://python.org]''')
         self.assertEqual(htmlutil.html_to_text('''Foo &meh; Bar''', unknown_entity_replacement='?'), 'Foo ? Bar')
 
+    def test_htmlutil_corpus(self):
+        # html_to_text() should give the same text as the original
+        # htmllib-based implementation.
+        import os
+        from audrey import htmlutil
+        corpus_dir = os.path.join(os.path.dirname(__file__), 'testdata', 'html')
+        names = sorted(os.listdir(corpus_dir))
+        self.assertTrue(names)
+        options = [{}, dict(show_link_urls=True), dict(unknown_entity_replacement='?'), dict(skip_tags=('head', 'script', 'style'))]
+        for name in names:
+            html = open(os.path.join(corpus_dir, name), 'rb').read()
+            for kwargs in options:
+                for value in (html, html.decode('utf-8')):
+                    expected = htmlutil.legacy_html_to_text(value, **kwargs)
+                    text = htmlutil.html_to_text(value, **kwargs)
+                    self.assertEqual(text, expected, '%s %r' % (name, kwargs))
+                    self.assertEqual(type(text), type(expected))
+                    parts = []
+                    htmlutil.write_html_text(value, parts.append, **kwargs)
+                    self.assertEqual(type(value)().join(parts).strip(), expected)
+
+    def test_htmlutil_cached_html_to_text(self):
+        from audrey import htmlutil
+        html = u'''<p>Hello <b>world</b> &amp; bye</p>'''
+        text = htmlutil.cached_html_to_text(html, 0)
+        self.assertEqual(text, htmlutil.html_to_text(html, 0))
+        self.assertTrue(htmlutil.cached_html_to_text(html, 0) is text)
+        self.assertEqual(type(htmlutil.cached_html_to_text(html.encode('utf-8'), 0)), str)
+
     def test_sortutil(self):
         from audrey import sortutil
         self.assertTrue(sortutil.sort_string_to_mongo('foo,-bar,+baz'), [('foo', 1), ('bar', -1), ('baz', 1)])
@@ -178,6 +207,14 @@ class UtilTests(unittest.TestCase):
         self.assertTrue(sortutil.SortSpec('foo,-bar,+baz').to_string(pluses=True), '+foo,-bar,+baz')
         self.assertTrue(str(sortutil.SortSpec('foo,-bar,+baz')), 'foo,-bar,baz')
 
+    def test_mongoutil(self):
+        from audrey import mongoutil
+        self.assertEqual(mongoutil.parse_write_concern('w=majority j=true, wtimeout=5000'), dict(w='majority', j=True, wtimeout=5000))
+        self.assertEqual(mongoutil.parse_write_concern('w=0 fsync=false'), dict(w=0, fsync=False))
+        self.assertEqual(mongoutil.parse_write_concern(''), {})
+        self.assertEqual(mongoutil.get_affected_count(dict(n=3), 1), 3)
+        self.assertEqual(mongoutil.get_affected_count(None, 1), 1)
+
 class RootTests(unittest.TestCase):
 
     def test_constructor(self):
@@ -205,6 +242,32 @@ class RootTests(unittest.TestCase):
         self.assertEqual(root['example_naming_collection'].__class__, _getExampleNamingCollectionClass())
         self.assertEqual([x.__class__ for x in root.get_collections()], [_getExampleCollectionClass(), _getExampleNamingCollectionClass()])
 
+    def test_get_objects_for_raw_search_results_facets(self):
+        request = testing.DummyRequest()
+        root = _makeOneRoot(request)
+        results = dict(took=3, hits=dict(total=5, hits=[]), facets=dict(
+            _type=dict(_type='terms', missing=0, total=5, other=0, terms=[dict(term='example_collection', count=5)])))
+        ret = root.get_objects_for_raw_search_results(results)
+        self.assertEqual(ret['facets'], dict(
+            _type=dict(missing=0, total=5, other=0, terms=[dict(term='example_collection', count=5)])))
+        del results['facets']
+        self.assertEqual(root.get_objects_for_raw_search_results(results)['facets'], {})
+
+    def test_reindex_start_after_unknown_collection(self):
+        from bson.objectid import ObjectId
+        from audrey import parallel
+        request = testing.DummyRequest()
+        root = _makeOneRoot(request)
+        self.assertEqual(root._get_collection_names_to_reindex(start_after=('example_naming_collection', ObjectId())), ['example_naming_collection'])
+        start_after = ('removed_collection', ObjectId())
+        with self.assertRaises(ValueError) as cm:
+            root.reindex_all(start_after=start_after)
+        self.assertTrue('removed_collection' in cm.exception.args[0])
+        with self.assertRaises(ValueError):
+            parallel.reindex_collections(root, start_after=start_after, processes=1)
+        with self.assertRaises(ValueError):
+            root.reindex_all(collection_names=['example_collection'], start_after=('example_naming_collection', ObjectId()))
+
 class CollectionTests(unittest.TestCase):
 
     def test_dupe_types(self):
@@ -226,6 +289,138 @@ class CollectionTests(unittest.TestCase):
         coll = BadCollection(request)
         self.assertEqual(coll._get_child_class_from_mongo_doc({}), None)
 
+    def test_construct_child_stub(self):
+        import datetime
+        from bson.objectid import ObjectId
+        request = testing.DummyRequest()
+        id = ObjectId()
+        coll = _makeOneCollection(request)
+        self.assertEqual(coll.construct_child_stub('nope'), None)
+        stub = coll.construct_child_stub(str(id))
+        self.assertEqual((stub._id, stub.__name__, stub.__parent__), (id, str(id), coll))
+        since = datetime.datetime(2012, 12, 24, 1, 52, 45, 281000)
+        self.assertEqual(stub._get_precondition_spec('abc', since), {
+            '_id': id,
+            '_etag': 'abc',
+            '_modified': {'$gte': datetime.datetime(2012, 12, 24, 1, 52, 45), '$lt': datetime.datetime(2012, 12, 24, 1, 52, 46)},
+        })
+        # Traversal doesn't load the child for conditional writes.
+        request = testing.DummyRequest(method='DELETE', headers={'If-Match':'"abc"', 'If-Unmodified-Since':'Mon, 24 Dec 2012 01:52:45 GMT'})
+        self.assertEqual(_makeOneCollection(request)[str(id)]._id, id)
+
+    def test_get_mongo_indexes(self):
+        self.assertEqual(_getExampleCollectionClass().get_mongo_indexes(), [([('_modified', 1)], {})])
+        self.assertEqual(_getExampleNamingCollectionClass().get_mongo_indexes(), [([('_modified', 1)], {}), ([('__name__', 1)], dict(unique=True))])
+
+    def test_get_elastic_index_fields(self):
+        request = testing.DummyRequest()
+        coll = _makeOneCollection(request)
+        # "dateline" doesn't contribute to the index document.
+        self.assertEqual(coll.get_elastic_index_fields(), ['_created', '_etag', '_id', '_modified', '_object_type', 'body', 'tags', 'title'])
+
+    def test_update_children_invalid(self):
+        import colander
+        request = testing.DummyRequest()
+        coll = _makeOneCollection(request)
+        with self.assertRaises(ValueError):
+            coll.update_children(None, dict(nonesuch='x'))
+        with self.assertRaises(colander.Invalid) as cm:
+            coll.update_children(None, dict(title='x', dateline='not a date'))
+        self.assertEqual(cm.exception.asdict().keys(), ['dateline'])
+
+    def test_update_children_per_class(self):
+        import colander
+        from audrey.resources.collection import Collection
+        from audrey.resources.object import Object
+        class Event(Object):
+            _object_type = 'event'
+            _schema = colander.SchemaNode(colander.Mapping())
+            _schema.add(colander.SchemaNode(colander.Integer(), name='seats'))
+        class Talk(Object):
+            _object_type = 'talk'
+            _schema = colander.SchemaNode(colander.Mapping())
+            _schema.add(colander.SchemaNode(colander.String(), name='seats'))
+        class Party(Event):
+            _object_type = 'party'
+        class Note(Object):
+            _object_type = 'note'
+            _schema = colander.SchemaNode(colander.Mapping())
+        class Things(Collection):
+            _collection_name = 'things'
+            _object_classes = (Event, Talk, Party, Note)
+        updates = []
+        class DummyMongoCollection(object):
+            def update(self, spec, document, **kw):
+                updates.append((spec, document))
+                return dict(n=1)
+        request = testing.DummyRequest()
+        request.registry.settings = {}
+        coll = Things(request)
+        coll.get_mongo_collection = lambda: DummyMongoCollection()
+        coll.get_elastic_connection = lambda: None
+        coll.get_write_concern = lambda write_concern=None: {}
+        self.assertEqual(coll.update_children(dict(x=1), dict(seats=5)), dict(updated=2, reindexed=0))
+        spec = {'$and': [dict(x=1), {'_object_type':{'$in':['event', 'talk', 'party']}}]}
+        self.assertEqual([u[0] for u in updates], [
+            {'$and': [spec, {'_object_type':{'$in':['event', 'party']}}]},
+            {'$and': [spec, {'_object_type':{'$in':['talk']}}]}])
+        self.assertEqual([u[1]['$set']['seats'] for u in updates], [5, '5'])
+        self.assertEqual(updates[0][1]['$set']['_etag'], updates[1][1]['$set']['_etag'])
+
+    def test_get_elastic_mapping(self):
+        mapping = _getExampleNamingCollectionClass().get_elastic_mapping()
+        self.assertEqual(sorted(mapping.keys()), ['__name__', '_created', '_modified', 'text'])
+
+    def test_get_elastic_filter(self):
+        import colander
+        import audrey.types
+        from audrey.resources.collection import Collection
+        from audrey.resources.object import Object
+        class Event(Object):
+            _object_type = 'event'
+            _schema = colander.SchemaNode(colander.Mapping())
+            _schema.add(colander.SchemaNode(colander.String(), name='title'))
+            _schema.add(colander.SchemaNode(colander.String(), name='summary', elastic_index='analyzed'))
+            _schema.add(colander.SchemaNode(colander.Integer(), name='seats', elastic_index='not_analyzed'))
+            _schema.add(colander.SchemaNode(colander.Integer(), name='secret', elastic_index='no'))
+            _schema.add(colander.SchemaNode(audrey.types.Reference(), name='host', elastic_index='not_analyzed'))
+            _location = colander.SchemaNode(colander.Mapping(), name='location', elastic_index='not_analyzed')
+            _location.add(colander.SchemaNode(colander.String(), name='city'))
+            _location.add(colander.SchemaNode(colander.Boolean(), name='indoors'))
+            _schema.add(_location)
+        class Events(Collection):
+            _collection_name = 'events'
+            _object_classes = (Event,)
+        coll = Events(testing.DummyRequest())
+        self.assertEqual(coll.get_elastic_filter({}), None)
+        self.assertEqual(coll.get_elastic_filter({'location.city': ['Paris']}).serialize(),
+            {'term': {'location.city': 'Paris'}})
+        self.assertEqual(coll.get_elastic_filter({'location.indoors': 'true', 'seats': ['1', '2']}).serialize(),
+            {'bool': {'must': [{'term': {'location.indoors': True}}, {'terms': {'seats': [1, 2]}}]}})
+        self.assertEqual(coll.get_elastic_filter({'_created__gte': '2012-12-24', '_created__lt': '2013-01-01T00:00:00Z'}).serialize(),
+            {'range': {'_created': {'from': '2012-12-24T00:00:00+00:00', 'include_lower': True, 'to': '2013-01-01T00:00:00+00:00', 'include_upper': False}}})
+        # Terms wouldn't match analyzed strings.
+        for filters in ({'title': 'x'}, {'summary': 'x'}, {'text': 'x'}, {'summary__gt': 'x'}, {'nonesuch': 'x'}, {'secret': '1'}, {'seats': 'x'}, {'seats__near': '1'}, {'host': 'x'}, {'seats__gt': ['1', '2']}):
+            with self.assertRaises(ValueError):
+                coll.get_elastic_filter(filters)
+        for facets in (['title'], ['summary'], ['text'], ['secret']):
+            with self.assertRaises(ValueError):
+                coll.search(facets=facets)
+
+    def test_get_write_concern(self):
+        request = testing.DummyRequest()
+        request.registry.settings = {}
+        coll = _makeOneRoot(request)['example_collection']
+        self.assertEqual(coll.get_write_concern(), dict(w=1))
+        self.assertEqual(coll.get_write_concern(dict(w=0)), dict(w=0))
+        request.registry.settings = {'write_concern': 'w=majority'}
+        self.assertEqual(coll.get_write_concern(), dict(w='majority'))
+        coll._write_concern = dict(w=2, j=True)
+        self.assertEqual(coll.get_write_concern(), dict(w=2, j=True))
+        request.registry.settings['write_concern.example_collection'] = dict(w=0)
+        self.assertEqual(coll.get_write_concern(), dict(w=0))
+        self.assertEqual(coll.get_write_concern(dict(w=3)), dict(w=3))
+
 class ObjectTests(unittest.TestCase):
 
     def test_get_schema(self):
@@ -278,12 +473,801 @@ class ObjectTests(unittest.TestCase):
         doc = instance.get_elastic_index_doc()
         self.assertEqual(doc, {'text': 'A Title\nSome body.\nfoo\nbar', '_modified': None, '_created': None})
 
+    def test_text_plan(self):
+        import colander
+        from audrey.resources.object import _get_text_plan
+        request = testing.DummyRequest()
+        instance = _makeOneObject(request)
+        schema = instance.get_schema()
+        plan = _get_text_plan(schema)
+        self.assertEqual(plan, [(('title',), False, None), (('body',), True, None), (('tags',), False, [((), False, None)])])
+        self.assertTrue(_get_text_plan(schema) is plan)
+        node = colander.SchemaNode(colander.Mapping())
+        pair = colander.SchemaNode(colander.Tuple(), name='pair')
+        pair.add(colander.SchemaNode(colander.Int(), name='n'))
+        pair.add(colander.SchemaNode(colander.String(), name='s', is_html=True))
+        node.add(pair)
+        node.add(colander.SchemaNode(colander.String(), name='hidden', include_in_text=False))
+        self.assertEqual(_get_text_plan(node), [(('pair', 1), True, None)])
+        self.assertEqual(instance._get_text_values_for_schema_node(node, dict(pair=(1, '<b>x</b>'), hidden='y')), ['x'])
+
+    def test_schema_plans_shared(self):
+        from audrey.resources.object import _text_plans, _elastic_fields
+        request = testing.DummyRequest()
+        class BoundObject(_getExampleObjectClass()):
+            @classmethod
+            def get_class_schema(cls, request=None):
+                return cls._schema.bind()
+        (one, two) = (BoundObject(request, title='One'), BoundObject(request, title='Two'))
+        self.assertFalse(one.get_schema() is two.get_schema())
+        self.assertEqual(one.get_fulltext_to_index(), 'One')
+        plan = _text_plans[BoundObject]
+        self.assertEqual(two.get_fulltext_to_index(), 'Two')
+        self.assertTrue(_text_plans[BoundObject] is plan)
+        fields = one._get_elastic_fields()
+        self.assertTrue(two._get_elastic_fields() is fields)
+        self.assertTrue(_elastic_fields[BoundObject] is fields)
+        # Without the per-class cache, plans are cached per schema instance.
+        BoundObject._cache_schema_plans = False
+        three = BoundObject(request, title='Three')
+        self.assertEqual(three.get_fulltext_to_index(), 'Three')
+        self.assertTrue(three.get_schema() in _text_plans)
+
+    def test_get_elastic_mapping(self):
+        import colander
+        from bson.objectid import ObjectId
+        import audrey.types
+        from audrey.resources.object import Object
+        from audrey.resources.reference import Reference
+        class Event(Object):
+            _schema = colander.SchemaNode(colander.Mapping())
+            _schema.add(colander.SchemaNode(colander.String(), name='title', elastic_index='not_analyzed'))
+            _schema.add(colander.SchemaNode(colander.String(), name='body', is_html=True))
+            _schema.add(colander.SchemaNode(colander.DateTime(), name='start', elastic_store=True))
+            _schema.add(colander.SchemaNode(colander.Integer(), name='seats', elastic_index='no'))
+            _schema.add(colander.SchemaNode(audrey.types.Reference(collection='people'), name='host', elastic_index='not_analyzed'))
+            _schema.add(colander.SchemaNode(audrey.types.Reference(collection='people'), name='organizer', elastic_store=True))
+            _schema.add(colander.SchemaNode(colander.Sequence(), colander.SchemaNode(colander.String()), name='tags', elastic_index='not_analyzed'))
+            _location = colander.SchemaNode(colander.Mapping(), name='location', elastic_index='analyzed')
+            _location.add(colander.SchemaNode(colander.String(), name='city'))
+            _location.add(colander.SchemaNode(colander.Boolean(), name='indoors'))
+            _location.add(colander.SchemaNode(audrey.types.File(), name='map'))
+            _schema.add(_location)
+        self.assertEqual(Event.get_elastic_mapping(), dict(
+            title=dict(type='string', index='not_analyzed', include_in_all=False),
+            start=dict(type='date', format='dateOptionalTime', index='not_analyzed', store='yes', include_in_all=False),
+            seats=dict(type='long', index='no', include_in_all=False),
+            host=dict(type='string', index='not_analyzed', include_in_all=False),
+            organizer=dict(type='string', index='not_analyzed', store='yes', include_in_all=False),
+            tags=dict(type='string', index='not_analyzed', include_in_all=False),
+            location=dict(type='object', properties=dict(
+                city=dict(type='string', index='analyzed', include_in_all=False),
+                indoors=dict(type='boolean', index='not_analyzed', include_in_all=False))),
+        ))
+        request = testing.DummyRequest()
+        id = ObjectId()
+        event = Event(request, title='Party', body='<p>Fun</p>', seats=10, host=Reference('people', id), tags=set(['x']), location=dict(city='Paris'))
+        doc = event.get_elastic_index_doc()
+        self.assertEqual(doc, dict(title='Party', start=None, seats=10, host=str(id), organizer=None, tags=['x'], location=dict(city='Paris', indoors=None),
+            text='Party\nFun\nx\nParis', _created=None, _modified=None))
+        self.assertTrue(event.affects_elastic_index(['seats']))
+
+    def test_get_elastic_index_hash(self):
+        from audrey import dateutil
+        request = testing.DummyRequest()
+        instance = _makeOneObject(request)
+        h = instance.get_elastic_index_hash()
+        self.assertEqual(h, instance.get_elastic_index_hash(instance.get_elastic_index_doc()))
+        instance._modified = dateutil.utcnow()
+        self.assertEqual(instance.get_elastic_index_hash(), h)
+        instance.body = '<p>Some <em>body</em>.</p>'
+        self.assertEqual(instance.get_elastic_index_hash(), h)
+        instance.title = 'Another Title'
+        self.assertNotEqual(instance.get_elastic_index_hash(), h)
+
+    def test_affects_elastic_index(self):
+        request = testing.DummyRequest()
+        instance = _makeOneObject(request)
+        self.assertTrue(instance.affects_elastic_index(['dateline', 'tags']))
+        self.assertFalse(instance.affects_elastic_index(['dateline']))
+        self.assertTrue(_makeOneNamedObject(request, 'x').affects_elastic_index(['__name__']))
+        # The index document (and its full text) isn't needed.
+        def fail():
+            raise AssertionError("get_elastic_index_doc called")
+        instance.get_elastic_index_doc = fail
+        self.assertTrue(instance.affects_elastic_index(['_modified']))
+
+    def test_diff_mongo_docs(self):
+        import pytz
+        from audrey.resources.object import _diff_mongo_docs
+        old = dict(a=1, b=[1, 2], c=datetime.datetime(2012, 1, 1), d='gone')
+        new = dict(a=1, b=[1, 2, 3], c=datetime.datetime(2012, 1, 1, tzinfo=pytz.utc), e=None)
+        self.assertEqual(_diff_mongo_docs(old, new), (dict(b=[1, 2, 3], c=new['c'], e=None), ['d']))
+        self.assertEqual(_diff_mongo_docs(old, old), ({}, []))
+
     def test_str(self):
         request = testing.DummyRequest()
         instance = _makeOneObject(request)
         s = str(instance)
         self.assertEqual(s, "{'_created': None,\n '_etag': None,\n '_id': None,\n '_modified': None,\n 'body': '<p>Some body.</p>',\n 'dateline': %s,\n 'tags': set(['bar', 'foo']),\n 'title': 'A Title'}" % repr(today))
         
+class RendererTests(unittest.TestCase):
+
+    def _render(self, value):
+        from audrey.renderers import StreamingJSON
+        request = testing.DummyRequest()
+        render = StreamingJSON()(None)
+        body = render(value, dict(request=request))
+        return (body, request.response)
+
+    def test_plain_value(self):
+        (body, response) = self._render(dict(a=1, b=[1, 2]))
+        import json
+        self.assertEqual(json.loads(body), dict(a=1, b=[1, 2]))
+
+    def test_streamed_items(self):
+        import json
+        items = (dict(n=n) for n in range(3))
+        (body, response) = self._render(dict(total=3, _embedded=dict(item=items)))
+        self.assertEqual(body, None)
+        self.assertEqual(response.content_type, 'application/json')
+        self.assertEqual(json.loads(''.join(response.app_iter)), dict(total=3, _embedded=dict(item=[dict(n=0), dict(n=1), dict(n=2)])))
+
+    def test_streamed_empty_items(self):
+        import json
+        (body, response) = self._render(dict(item=(x for x in [])))
+        self.assertEqual(json.loads(''.join(response.app_iter)), dict(item=[]))
+
+class CompressionTweenTests(unittest.TestCase):
+
+    def _makeTween(self, body, content_type='application/hal+json', app_iter=None, etag=None, **settings):
+        from pyramid.response import Response
+        from audrey.tweens import compression_tween_factory
+        def handler(request):
+            response = Response(body, content_type=content_type)
+            response.etag = etag
+            if app_iter is not None:
+                response.app_iter = app_iter
+            return response
+        registry = testing.DummyRequest().registry
+        registry.settings = settings
+        return compression_tween_factory(handler, registry)
+
+    def _makeRequest(self, accept_encoding=None):
+        from pyramid.request import Request
+        request = Request.blank('/')
+        if accept_encoding:
+            request.headers['Accept-Encoding'] = accept_encoding
+        return request
+
+    def test_gzip(self):
+        import zlib
+        body = '{"foo": "bar"}' * 100
+        response = self._makeTween(body)(self._makeRequest('gzip, deflate'))
+        self.assertEqual(response.content_encoding, 'gzip')
+        self.assertTrue('Accept-Encoding' in response.vary)
+        self.assertEqual(zlib.decompress(response.body, 16 + zlib.MAX_WBITS), body)
+
+    def test_deflate(self):
+        import zlib
+        body = '{"foo": "bar"}' * 100
+        response = self._makeTween(body)(self._makeRequest('deflate'))
+        self.assertEqual(response.content_encoding, 'deflate')
+        self.assertEqual(zlib.decompress(response.body), body)
+
+    def test_etag(self):
+        from audrey.httputil import strip_etag_suffixes
+        body = '{"foo": "bar"}' * 100
+        response = self._makeTween(body, etag='abc')(self._makeRequest('gzip'))
+        self.assertEqual(response.headers['ETag'], '"abc-gzip"')
+        self.assertEqual(strip_etag_suffixes(response.headers['ETag']), '"abc"')
+        response = self._makeTween(body, etag='abc')(self._makeRequest())
+        self.assertEqual(response.headers['ETag'], '"abc"')
+
+    def test_not_compressed(self):
+        body = '{"foo": "bar"}' * 100
+        # Client doesn't accept compression.
+        response = self._makeTween(body)(self._makeRequest())
+        self.assertEqual(response.content_encoding, None)
+        self.assertEqual(response.body, body)
+        # Body too short.
+        response = self._makeTween('{}')(self._makeRequest('gzip'))
+        self.assertEqual(response.content_encoding, None)
+        # Content type not configured for compression.
+        response = self._makeTween(body, content_type='image/png')(self._makeRequest('gzip'))
+        self.assertEqual(response.content_encoding, None)
+        # Compression disabled.
+        response = self._makeTween(body, compress_responses='false')(self._makeRequest('gzip'))
+        self.assertEqual(response.content_encoding, None)
+
+    def test_streamed(self):
+        import zlib
+        chunks = ['[', '1, ', '2', ']']
+        response = self._makeTween('', app_iter=iter(chunks))(self._makeRequest('gzip'))
+        self.assertEqual(response.content_encoding, 'gzip')
+        self.assertEqual(zlib.decompress(''.join(response.app_iter), 16 + zlib.MAX_WBITS), '[1, 2]')
+
+class HALRendererTests(unittest.TestCase):
+
+    def setUp(self):
+        self.config = testing.setUp()
+
+    def tearDown(self):
+        testing.tearDown()
+
+    def _render(self, value, accept=None, etag=None):
+        from pyramid.request import Request
+        from audrey.renderers import HALRenderer
+        request = Request.blank('/')
+        request.registry = self.config.registry
+        if accept:
+            request.headers['Accept'] = accept
+        request.response.content_type = 'application/hal+json'
+        request.response.etag = etag
+        body = HALRenderer()(None)(value, dict(request=request))
+        return (body, request.response)
+
+    def _value(self):
+        import datetime, pytz
+        from bson.objectid import ObjectId
+        from audrey.resources.reference import Reference
+        return dict(
+            _id = ObjectId('50ab2e7b8dc0c2a0f1a8e3f1'),
+            _created = datetime.datetime(2012, 11, 20, 7, 30, tzinfo=pytz.utc),
+            author = Reference('people', ObjectId('50ab2e7b8dc0c2a0f1a8e3f2'), serialize_id_only=True),
+            tags = set(['foo']),
+        )
+
+    def test_default_is_hal_json(self):
+        import json
+        for accept in (None, '*/*', 'application/hal+json, application/x-msgpack'):
+            (body, response) = self._render(dict(a=1), accept)
+            self.assertEqual(response.content_type, 'application/hal+json')
+            self.assertEqual(json.loads(body), dict(a=1))
+
+    def test_vary_and_etag(self):
+        for (accept, etag) in ((None, '"abc"'), ('application/x-msgpack', '"abc-msgpack"'), ('application/bson', '"abc-bson"')):
+            (body, response) = self._render(dict(a=1), accept, etag='abc')
+            self.assertEqual(response.headers['ETag'], etag)
+            self.assertEqual(response.vary, ('Accept',))
+
+    def test_msgpack(self):
+        import datetime, msgpack
+        from bson.objectid import ObjectId
+        from audrey.renderers import msgpack_ext_hook
+        (body, response) = self._render(self._value(), 'application/x-msgpack')
+        self.assertEqual(response.content_type, 'application/x-msgpack')
+        self.assertEqual(msgpack.unpackb(body, ext_hook=msgpack_ext_hook), dict(
+            _id = ObjectId('50ab2e7b8dc0c2a0f1a8e3f1'),
+            _created = datetime.datetime(2012, 11, 20, 7, 30),
+            author = dict(ObjectId=ObjectId('50ab2e7b8dc0c2a0f1a8e3f2')),
+            tags = ['foo'],
+        ))
+
+    def test_bson(self):
+        import bson
+        (body, response) = self._render(self._value(), 'application/bson')
+        self.assertEqual(response.content_type, 'application/bson')
+        doc = bson.BSON(body).decode(tz_aware=True)
+        value = self._value()
+        self.assertEqual(doc['_id'], value['_id'])
+        self.assertEqual(doc['_created'], value['_created'])
+        self.assertEqual(doc['author'], dict(ObjectId=value['author'].id))
+
+    def test_not_hal(self):
+        import json
+        from pyramid.request import Request
+        from audrey.renderers import HALRenderer
+        request = Request.blank('/', headers={'Accept': 'application/x-msgpack'})
+        request.registry = self.config.registry
+        body = HALRenderer()(None)(dict(ok=True), dict(request=request))
+        self.assertEqual(request.response.content_type, 'application/json')
+        self.assertEqual(json.loads(body), dict(ok=True))
+
+def _makeAppWithoutServers():
+    # An app for testing views that don't need Mongo or Elastic.
+    from pyramid.config import Configurator
+    from audrey.renderers import HALRenderer
+    root_cls = _getExampleRootClass()
+    config = Configurator(root_factory=root_cls, settings=dict(elastic_conn=None))
+    config.add_renderer('json', HALRenderer())
+    config.include('pyramid_zcml')
+    config.load_zcml('audrey:configure.zcml')
+    return config.make_wsgi_app()
+
+class BatchViewTests(unittest.TestCase):
+    # These tests only run operations that don't need Mongo or Elastic.
+
+    def setUp(self):
+        self.app = _makeAppWithoutServers()
+
+    def _post(self, body):
+        import json
+        from pyramid.request import Request
+        request = Request.blank('/@@batch', method='POST', content_type='application/json',
+                                headers={'Accept': 'application/json'})
+        request.body = json.dumps(body)
+        response = request.get_response(self.app)
+        return (response, json.loads(response.body))
+
+    def test_batch(self):
+        (response, result) = self._post([
+            dict(method='GET', path='/example_collection/@@schema/example_object'),
+            dict(method='GET', path='/no_such_collection/@@schema/example_object'),
+            dict(path='/'),
+            dict(method='GET', path='/'),
+        ])
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(result['ok'], True)
+        self.assertEqual([r['status'] for r in result['results']], [200, 404, 400, 200])
+        self.assertEqual(result['results'][0]['body']['properties']['_object_type']['enum'], ['example_object'])
+        self.assertEqual(result['results'][3]['body']['_links']['audrey:batch']['href'], '/@@batch')
+
+    def test_batch_odd_operations(self):
+        (response, result) = self._post([
+            dict(method='GET', path='/example_collection/@@schema/example_object', headers={'Accept-Encoding': 'gzip'}),
+            dict(method='GET', path='/', headers={'X-Note': u'caf\xe9'}),
+            dict(method=5, path='/'),
+            dict(method='GET', path='/', headers=['nope']),
+        ])
+        self.assertEqual([r['status'] for r in result['results']], [200, 200, 400, 400])
+        self.assertEqual(result['results'][0]['body']['properties']['_object_type']['enum'], ['example_object'])
+
+    def test_bad_batch(self):
+        (response, result) = self._post(dict(method='GET', path='/'))
+        self.assertEqual(response.status_int, 400)
+        from audrey.views import MAX_BATCH_OPERATIONS
+        (response, result) = self._post([dict(method='GET', path='/')] * (MAX_BATCH_OPERATIONS+1))
+        self.assertEqual(response.status_int, 400)
+
+class ImportViewTests(unittest.TestCase):
+
+    def test_iter_lines(self):
+        from StringIO import StringIO
+        from audrey.views import _iter_lines
+        self.assertEqual(list(_iter_lines(StringIO('a\nbb\n\nccc'), blocksize=2)), ['a', 'bb', '', 'ccc'])
+        self.assertEqual(list(_iter_lines(StringIO('a\n'), blocksize=2)), ['a'])
+        self.assertEqual(list(_iter_lines(StringIO(''))), [])
+
+    def test_invalid_lines(self):
+        # Lines that fail before reaching Mongo.
+        import json
+        from pyramid.request import Request
+        app = _makeAppWithoutServers()
+        body = '\n'.join([
+            '{"_object_type": "example_object", "title": "Missing dateline"}',
+            '',
+            'not json',
+            '{"title": "Missing type"}',
+        ])
+        request = Request.blank('/example_collection/@@import', method='POST',
+                                headers={'Accept': 'application/json'})
+        request.body = body
+        response = request.get_response(app)
+        self.assertEqual(response.content_type, 'application/x-ndjson')
+        results = [json.loads(line) for line in response.body.splitlines()]
+        self.assertEqual([r.get('line') for r in results], [1, 3, 4, None])
+        self.assertEqual([r.get('status') for r in results], [400, 400, 400, None])
+        self.assertEqual(results[0]['error'], 'Validation failed.')
+        self.assertTrue('dateline' in results[0]['errors'])
+        self.assertEqual(results[1]['error'], 'Invalid JSON.')
+        self.assertEqual(results[2]['error'], 'Request is missing _object_type.')
+        self.assertEqual(results[3], dict(summary=dict(created=0, failed=3)))
+
+    def test_invalid_names(self):
+        import json
+        from pyramid.request import Request
+        app = _makeAppWithoutServers()
+        body = '\n'.join([
+            '{"_object_type": "example_named_object", "title": "T", "__name__": 5}',
+            '{"_object_type": ["example_object"], "__name__": "x"}',
+        ])
+        request = Request.blank('/example_naming_collection/@@import', method='POST',
+                                headers={'Accept': 'application/json'})
+        request.body = body
+        results = [json.loads(line) for line in request.get_response(app).body.splitlines()]
+        self.assertEqual([r.get('error') for r in results], ['__name__ must be a string.', 'Unsupported _object_type.', None])
+        self.assertEqual(results[2], dict(summary=dict(created=0, failed=2)))
+
+class SearchViewTests(unittest.TestCase):
+
+    def _makeRoot(self):
+        class DummyRoot(object):
+            __name__ = ''
+            __parent__ = None
+            def get_elastic_connection(self):
+                return object()
+            def check_facets(self, facets, collection_names=None):
+                if 'text' in facets:
+                    raise ValueError("Field is analyzed: text")
+            def basic_fulltext_search(self, **kwargs):
+                self.search_kwargs = kwargs
+                return dict(total=45, items=[], facets={}, scroll_id=kwargs['scroll'] and 'scroll1' or None)
+            def continue_search(self, scroll_id, highlights=False):
+                self.scroll_id = scroll_id
+                return dict(total=45, items=[], facets={}, scroll_id='scroll2')
+        return DummyRoot()
+
+    def _makeRequest(self, **params):
+        import urllib
+        from pyramid.request import Request
+        request = Request.blank('/@@search?' + urllib.urlencode(params))
+        request.registry = testing.DummyRequest().registry
+        request.registry.settings = dict(search_cursor_secret='s3cret')
+        return request
+
+    def test_search_cursor(self):
+        from urlparse import parse_qs, urlparse
+        from audrey.views import root_search
+        root = self._makeRoot()
+        request = self._makeRequest(q='foo', scroll='true', per_batch='20', facets='_type')
+        result = root_search(root, request)
+        self.assertEqual(root.search_kwargs['scroll'], '5m')
+        self.assertEqual(root.search_kwargs['skip'], 0)
+        self.assertEqual(result['_summary']['facets'], {})
+        self.assertTrue('prev' not in result['_links'])
+        query = parse_qs(urlparse(result['_links']['next']['href']).query)
+        self.assertEqual(sorted(query.keys()), ['cursor', 'facets', 'per_batch', 'q'])
+        request = self._makeRequest(q='foo', per_batch='20', facets='_type', cursor=query['cursor'][0])
+        result = root_search(root, request)
+        self.assertEqual(root.scroll_id, 'scroll1')
+        self.assertEqual(result['_summary']['batch'], 2)
+        # Facets are only counted for the first batch.
+        self.assertTrue('facets' not in result['_summary'])
+        query = parse_qs(urlparse(result['_links']['next']['href']).query)
+        request = self._makeRequest(q='foo', per_batch='20', cursor=query['cursor'][0])
+        result = root_search(root, request)
+        self.assertEqual(root.scroll_id, 'scroll2')
+        self.assertEqual(result['_summary']['batch'], 3)
+        self.assertTrue('next' not in result['_links'])
+
+    def test_search_cursor_is_bound(self):
+        import base64
+        from urlparse import parse_qs, urlparse
+        from audrey.views import root_search
+        root = self._makeRoot()
+        result = root_search(root, self._makeRequest(q='foo', scroll='true', collections='a'))
+        cursor = parse_qs(urlparse(result['_links']['next']['href']).query)['cursor'][0]
+        (payload, signature) = cursor.split('.')
+        forged = base64.urlsafe_b64encode('20,20,other') + '.' + signature
+        requests = [
+            # Another search, or the same one with a forged scroll ID
+            self._makeRequest(q='foo', collections='b', cursor=cursor),
+            self._makeRequest(q='bar', collections='a', cursor=cursor),
+            self._makeRequest(q='foo', collections='a', cursor=forged),
+        ]
+        for request in requests:
+            result = root_search(root, request)
+            self.assertEqual(request.response.status_int, 400)
+        request = self._makeRequest(q='foo', collections='a', cursor=cursor)
+        request.registry.settings['search_cursor_secret'] = 'other'
+        root_search(root, request)
+        self.assertEqual(request.response.status_int, 400)
+        self.assertFalse(hasattr(root, 'scroll_id'))
+        root_search(root, self._makeRequest(q='foo', collections='a', cursor=cursor))
+        self.assertEqual(root.scroll_id, 'scroll1')
+
+    def test_search_batches(self):
+        from audrey.views import root_search
+        root = self._makeRoot()
+        result = root_search(root, self._makeRequest(batch='2', per_batch='20'))
+        self.assertEqual(root.search_kwargs['skip'], 20)
+        self.assertEqual(root.search_kwargs['scroll'], None)
+        self.assertEqual(result['_links']['next']['href'], '/@@search?per_batch=20&batch=3')
+
+    def test_invalid_search_cursor(self):
+        from audrey.views import root_search
+        request = self._makeRequest(cursor='nonsense')
+        result = root_search(self._makeRoot(), request)
+        self.assertEqual(request.response.status_int, 400)
+        self.assertEqual(result['error'], 'Invalid cursor.')
+
+    def test_invalid_facets(self):
+        from audrey.views import root_search
+        request = self._makeRequest(facets='_type,text')
+        result = root_search(self._makeRoot(), request)
+        self.assertEqual(request.response.status_int, 400)
+        self.assertEqual(result['error'], 'Field is analyzed: text')
+
+    def test_check_facets(self):
+        root = _makeOneRoot(testing.DummyRequest())
+        root.check_facets(['_type', '__name__'])
+        root.check_facets(['__name__'], collection_names=['example_naming_collection'])
+        for (facets, collection_names) in ((['text'], None), (['nonesuch'], None), (['__name__'], ['example_collection'])):
+            with self.assertRaises(ValueError):
+                root.check_facets(facets, collection_names)
+
+class UnitOfWorkTests(unittest.TestCase):
+
+    def test_begin_and_commit(self):
+        from audrey.unitofwork import begin_unit_of_work, get_unit_of_work
+        environ = {}
+        self.assertEqual(get_unit_of_work(environ), None)
+        uow = begin_unit_of_work(environ)
+        self.assertTrue(get_unit_of_work(environ) is uow)
+        # Beginning again joins the active unit of work.
+        self.assertTrue(begin_unit_of_work(environ) is uow)
+        self.assertEqual(uow.commit(), None)
+        self.assertTrue(get_unit_of_work(environ) is uow)
+        self.assertEqual(uow.commit(), dict(saved=0, deleted=0))
+        self.assertEqual(get_unit_of_work(environ), None)
+
+    def test_context_manager(self):
+        from audrey.unitofwork import begin_unit_of_work, get_unit_of_work
+        environ = {}
+        with begin_unit_of_work(environ):
+            self.assertNotEqual(get_unit_of_work(environ), None)
+        self.assertEqual(get_unit_of_work(environ), None)
+        try:
+            with begin_unit_of_work(environ):
+                with begin_unit_of_work(environ):
+                    raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual(get_unit_of_work(environ), None)
+
+    def test_only_new_objects_upserted(self):
+        from bson.objectid import ObjectId
+        from audrey.unitofwork import UnitOfWork
+        request = testing.DummyRequest()
+        coll = _makeOneRoot(request)['example_collection']
+        class DummyMongoCollection(object):
+            name = 'example_collection'
+        coll.get_mongo_collection = lambda: DummyMongoCollection()
+        uow = UnitOfWork({})
+        new = _makeOneObject(request)
+        new.__parent__ = coll
+        uow.save(new)
+        # Saving it again before the commit still upserts it.
+        uow.save(new)
+        loaded = _makeOneObject(request)
+        loaded.__parent__ = coll
+        loaded._id = ObjectId()
+        loaded.load_mongo_doc(loaded.get_mongo_save_doc())
+        uow.save(loaded)
+        self.assertEqual([op.new for op in uow._ops.values()], [True, False])
+
+    def test_tween(self):
+        from pyramid.response import Response
+        from pyramid.request import Request
+        from audrey.tweens import unit_of_work_tween_factory
+        from audrey.unitofwork import get_unit_of_work
+        seen = []
+        def handler(request):
+            uow = get_unit_of_work(request.environ)
+            seen.append(uow)
+            if request.path == '/error':
+                raise ValueError
+            return Response(status=int(request.path[1:]))
+        registry = testing.DummyRequest().registry
+        registry.settings = {}
+        self.assertTrue(unit_of_work_tween_factory(handler, registry) is handler)
+        registry.settings = dict(auto_unit_of_work='true')
+        tween = unit_of_work_tween_factory(handler, registry)
+        for path in ('/200', '/400'):
+            request = Request.blank(path)
+            tween(request)
+            self.assertNotEqual(seen[-1], None)
+            self.assertEqual(get_unit_of_work(request.environ), None)
+        request = Request.blank('/error')
+        self.assertRaises(ValueError, tween, request)
+        self.assertEqual(get_unit_of_work(request.environ), None)
+
+class PatchViewTests(unittest.TestCase):
+
+    def _makeRequest(self, instance, patch, content_type='application/merge-patch+json'):
+        import webob
+        request = testing.DummyRequest()
+        request.headers['If-Match'] = '"%s"' % instance._etag
+        request.headers['If-Unmodified-Since'] = webob.datetime_utils.serialize_date(instance._modified)
+        request.content_type = content_type
+        request.json_body = patch
+        return request
+
+    def _makeObject(self):
+        import datetime
+        instance = _makeOneObject(testing.DummyRequest())
+        instance._etag = instance.generate_etag()
+        instance._modified = datetime.datetime(2012, 12, 24, 1, 52, 45)
+        return instance
+
+    def test_json_merge_patch(self):
+        from audrey.views import json_merge_patch
+        target = dict(a='b', c=dict(d='e', f='g'))
+        self.assertEqual(json_merge_patch(target, dict(a='z', c=dict(f=None))), dict(a='z', c=dict(d='e')))
+        self.assertEqual(target, dict(a='b', c=dict(d='e', f='g')))
+        self.assertEqual(json_merge_patch(target, ['x']), ['x'])
+        self.assertEqual(json_merge_patch('x', dict(a=dict(b=None))), dict(a={}))
+
+    def test_preconditions(self):
+        from audrey.views import object_patch
+        instance = self._makeObject()
+        request = self._makeRequest(instance, dict(title='New'))
+        request.headers['If-Match'] = '"nope"'
+        self.assertEqual(object_patch(instance, request)['status'], 412)
+
+    def test_preconditions_checked_by_save(self):
+        from audrey.exceptions import PreconditionFailed
+        from audrey.views import object_patch
+        instance = self._makeObject()
+        request = self._makeRequest(instance, dict(title='New'))
+        saves = []
+        def save(**kwargs):
+            # The stored object has changed since it was loaded.
+            saves.append(kwargs)
+            raise PreconditionFailed("The object has been changed or removed.")
+        instance.save = save
+        self.assertEqual(object_patch(instance, request)['status'], 412)
+        self.assertEqual(saves[0]['if_match'], instance._etag)
+        self.assertEqual(saves[0]['if_unmodified_since'].replace(tzinfo=None), instance._modified)
+
+    def test_get_preconditions(self):
+        import pytz
+        from audrey.views import get_preconditions
+        request = testing.DummyRequest(headers={'If-Match':'"abc"', 'If-Unmodified-Since':'Mon, 24 Dec 2012 01:52:45 GMT'})
+        self.assertEqual(get_preconditions(request), (dict(if_match='abc', if_unmodified_since=datetime.datetime(2012, 12, 24, 1, 52, 45, tzinfo=pytz.utc)), None))
+        request = testing.DummyRequest(headers={'If-Match':'"abc"'})
+        self.assertEqual(get_preconditions(request)[1]['status'], 412)
+        request = testing.DummyRequest(headers={'If-Match':'abc', 'If-Unmodified-Since':'Mon, 24 Dec 2012 01:52:45 GMT'})
+        self.assertEqual(get_preconditions(request)[1]['status'], 412)
+
+    def test_content_type(self):
+        from audrey.views import object_patch
+        instance = self._makeObject()
+        request = self._makeRequest(instance, dict(title='New'), content_type='text/plain')
+        self.assertEqual(object_patch(instance, request)['status'], 415)
+
+    def test_validation(self):
+        from audrey.views import object_patch
+        instance = self._makeObject()
+        # Only the patched attributes are validated.
+        instance.body = None
+        request = self._makeRequest(instance, dict(_object_type='example_object', title=None, dateline='nope', nonesuch=1))
+        result = object_patch(instance, request)
+        self.assertEqual(result['status'], 400)
+        self.assertEqual(sorted(result['errors'].keys()), ['dateline', 'nonesuch', 'title'])
+        self.assertEqual(instance.title, 'A Title')
+
+def _makeDummyElasticRoot(written):
+    # A stand-in for an app root that records the ElasticSearch writes
+    # made by audrey.indexqueue.write_operations.
+    # Children with IDs starting with "gone" don't exist, those starting
+    # with "bad" fail to index and those starting with "err" get an
+    # error in a bulk response.
+    class DummyChild(object):
+        def __init__(self, coll, id):
+            (self.coll, self._id) = (coll, id)
+        def index(self, bulk=None, defer=None):
+            if self._id.startswith('bad'):
+                raise ValueError(self._id)
+            written.append((self.coll.name, self._id, 'index'))
+            if self._id.startswith('err'):
+                return [dict(items=[dict(index=dict(_type=self.coll.name, _id=self._id, error='MapperParsingException'))])]
+            return []
+    class DummyConn(object):
+        def delete(self, index, doctype, id, bulk=False):
+            written.append((doctype, id, 'unindex'))
+    class DummyCollection(object):
+        def __init__(self, name):
+            self.name = name
+        def get_elastic_connection(self):
+            return DummyConn()
+        def get_elastic_write_index_names(self):
+            return ['idx']
+        def get_elastic_doctype(self):
+            return self.name
+        def get_children_lazily(self, spec):
+            return [DummyChild(self, id) for id in spec['_id']['$in'] if not id.startswith('gone')]
+    class DummyRoot(object):
+        def get_collection(self, name):
+            return DummyCollection(name)
+        def flush_elastic_bulk(self):
+            written.append('flush')
+    return DummyRoot()
+
+class ElasticIndexTests(unittest.TestCase):
+
+    def test_get_write_index_names(self):
+        from pyes.exceptions import IndexMissingException
+        from audrey import elasticindex
+        aliases = {}
+        class DummyIndices(object):
+            def get_alias(self, alias):
+                if alias not in aliases:
+                    raise IndexMissingException(alias)
+                return aliases[alias]
+        class DummyConn(object):
+            indices = DummyIndices()
+        conn = DummyConn()
+        self.assertEqual(elasticindex.get_alias_indices(conn, 'foo'), [])
+        self.assertEqual(elasticindex.get_write_index_names(conn, 'foo'), ['foo'])
+        aliases['foo_rebuild'] = ['foo_2']
+        # Cached
+        self.assertEqual(elasticindex.get_write_index_names(conn, 'foo'), ['foo'])
+        elasticindex._write_index_names_cache.clear()
+        self.assertEqual(elasticindex.get_write_index_names(conn, 'foo'), ['foo', 'foo_2'])
+        elasticindex._write_index_names_cache.clear()
+        self.assertTrue(elasticindex.make_index_name('foo').startswith('foo_20'))
+
+class IndexQueueTests(unittest.TestCase):
+
+    def _makeQueue(self, maxsize=10):
+        from audrey.indexqueue import IndexQueue
+        written = []
+        class TestQueue(IndexQueue):
+            def make_root(self):
+                return _makeDummyElasticRoot(written)
+        return (TestQueue(None, None, None, maxsize=maxsize, batch_size=3), written)
+
+    def test_flush_coalesces(self):
+        (queue, written) = self._makeQueue()
+        queue.put('a', '1', 'index')
+        queue.put('b', '1', 'index')
+        queue.put('a', '1', 'unindex')
+        queue.put('a', '2', 'index')
+        self.assertEqual(len(queue), 4)
+        queue.flush()
+        self.assertEqual(len(queue), 0)
+        # The first batch of 3 ends with an unindex of a/1.
+        self.assertEqual(written, [('a', '1', 'unindex'), ('b', '1', 'index'), 'flush', ('a', '2', 'index'), 'flush'])
+        # Objects that no longer exist are unindexed.
+        self.assertEqual(queue.process([('a', '3', 'index'), ('a', '3', 'index'), ('a', 'gone', 'index')]), dict(indexed=1, unindexed=1, failed=[]))
+        # Errors in bulk responses are reported.
+        self.assertEqual(queue.process([('a', '4', 'index'), ('b', 'err', 'index')])['failed'], [('b', 'err')])
+
+    def test_backpressure(self):
+        import Queue
+        (queue, written) = self._makeQueue(maxsize=1)
+        queue.put('a', '1', 'index')
+        self.assertRaises(Queue.Full, queue.put, 'a', '2', 'index', timeout=0.01)
+        queue.start()
+        queue.put('a', '2', 'index', timeout=5)
+        queue.flush()
+        queue.stop()
+        # The worker may have taken both operations in one batch or two.
+        self.assertEqual([x for x in written if x != 'flush'], [('a', '1', 'index'), ('a', '2', 'index')])
+
+    def test_object_defers(self):
+        from bson.objectid import ObjectId
+        (queue, written) = self._makeQueue()
+        request = testing.DummyRequest()
+        request.registry.settings = dict(elastic_conn=object(), index_queue=queue)
+        obj = _makeOneObject(request)
+        obj.__parent__ = _makeOneRoot(request)['example_collection']
+        obj._id = ObjectId()
+        obj.index()
+        self.assertEqual(obj.unindex(), 1)
+        self.assertEqual(queue._queue.queue[0], ('example_collection', obj._id, 'index'))
+        self.assertEqual(queue._queue.queue[1], ('example_collection', obj._id, 'unindex'))
+
+    def test_object_write_ahead(self):
+        (queue, written) = self._makeQueue()
+        request = testing.DummyRequest()
+        request.registry.settings = dict(elastic_conn=object(), index_queue=queue)
+        obj = _makeOneObject(request)
+        obj.__parent__ = _makeOneRoot(request)['example_collection']
+        # An index queue only gets operations after the writes.
+        self.assertFalse(obj._write_ahead_to_outbox(assign_id=True))
+        self.assertEqual(len(queue), 0)
+        queue.write_ahead = True
+        self.assertTrue(obj._write_ahead_to_outbox(assign_id=True))
+        self.assertTrue(obj._id is not None)
+        self.assertFalse(obj._write_ahead_to_outbox(assign_id=True))
+        self.assertEqual(list(queue._queue.queue), [('example_collection', obj._id, 'index')] * 2)
+
+    def test_collection_write_ahead(self):
+        from bson.objectid import ObjectId
+        (queue, written) = self._makeQueue()
+        request = testing.DummyRequest()
+        request.registry.settings = dict(elastic_conn=object(), index_queue=queue)
+        coll = _makeOneRoot(request)['example_collection']
+        ids = [ObjectId(), ObjectId()]
+        coll._write_ahead_to_outbox(ids, 'unindex')
+        self.assertEqual(len(queue), 0)
+        queue.write_ahead = True
+        coll._write_ahead_to_outbox(ids, 'unindex')
+        self.assertEqual(list(queue._queue.queue), [('example_collection', id, 'unindex') for id in ids])
+
 # The following tests need access to Mongo and Elastic servers.
 class FunctionalTests(unittest.TestCase):
 
@@ -313,8 +1297,11 @@ class FunctionalTests(unittest.TestCase):
             db.drop_collection(name)
         self.mongo_conn.disconnect()
         
-        self.elastic_conn.close_index(self.settings['elastic_name'])
-        self.elastic_conn.delete_index(self.settings['elastic_name'])
+        # The index name is an alias for a versioned index.
+        from audrey.elasticindex import get_alias_indices
+        for name in get_alias_indices(self.elastic_conn, self.settings['elastic_name']):
+            self.elastic_conn.close_index(name)
+            self.elastic_conn.delete_index(name)
 
     def test_add_child(self):
         root = _makeOneRoot(self.request)
@@ -514,6 +1501,82 @@ class FunctionalTests(unittest.TestCase):
         self.assertEqual(result['total'], 1)
         self.assertEqual(result['items'][0]['object']._id, instance3._id)
 
+    def test_save_skips_unchanged_index(self):
+        root = _makeOneRoot(self.request)
+        coll = root['example_collection']
+        instance = _makeOneObject(self.request)
+        coll.add_child(instance)
+        doc = coll.get_mongo_collection().find_one(instance._id)
+        self.assertEqual(doc['_index_hash'], instance.get_elastic_index_hash())
+        econn = root.get_elastic_connection()
+        calls = []
+        def index(*args, **kwargs):
+            calls.append(args)
+            if args[0].get('title') == 'Unindexable':
+                raise ValueError
+            return econn.__class__.index(econn, *args, **kwargs)
+        econn.index = index
+        requests = []
+        def send_request(*args, **kwargs):
+            requests.append(args)
+            return econn.__class__._send_request(econn, *args, **kwargs)
+        econn._send_request = send_request
+        try:
+            instance = coll.get_child_by_id(instance._id)
+            old_modified = instance._modified
+            instance.body = '<p>Some <em>body</em>.</p>'
+            instance.save()
+            # Nothing was written to ElasticSearch.
+            self.assertEqual(calls, [])
+            self.assertEqual(requests, [])
+            root.refresh_elastic()
+            self.assertEqual(coll.search(filters=dict(_modified__gt=old_modified.isoformat()))['total'], 0)
+            # Unless the class opts in to updating _modified in place.
+            instance._index_modified_in_place = True
+            instance.body = '<p>Some <b>body</b>.</p>'
+            instance.save()
+            self.assertEqual(calls, [])
+            root.refresh_elastic()
+            self.assertEqual(coll.search(filters=dict(_modified__gt=old_modified.isoformat()))['total'], 1)
+            del instance._index_modified_in_place
+            instance.title = 'Another Title'
+            instance.save()
+            self.assertEqual(len(calls), 1)
+            self.assertEqual(coll.get_mongo_collection().find_one(instance._id)['_index_hash'], instance.get_elastic_index_hash())
+            # The hash is only saved after ElasticSearch acknowledges the write.
+            instance.title = 'Unindexable'
+            self.assertRaises(ValueError, instance.save)
+            self.assertFalse('_index_hash' in coll.get_mongo_collection().find_one(instance._id))
+            coll.update_children(None, dict(title='Third Title'))
+            self.assertFalse('_index_hash' in coll.get_mongo_collection().find_one(instance._id))
+        finally:
+            del econn.index
+            del econn._send_request
+
+    def test_collection_search(self):
+        import time
+        root = _makeOneRoot(self.request)
+        coll = root['example_collection']
+        first = _makeOneObject(self.request, title='First')
+        coll.add_child(first)
+        time.sleep(0.01)
+        second = _makeOneObject(self.request, title='Second')
+        coll.add_child(second)
+        root.refresh_elastic()
+        self.assertEqual(coll.search()['total'], 2)
+        result = coll.search(filters=dict(_created__gt=first._created.isoformat()))
+        self.assertEqual([obj._id for obj in result['items']], [second._id])
+        self.assertEqual(coll.search('first', filters=dict(_created__gt=first._created.isoformat()))['total'], 0)
+        result = root.basic_fulltext_search(facets=['_type'])
+        self.assertEqual(result['facets']['_type']['terms'], [dict(term='example_collection', count=2)])
+        result = coll.export_search(page_size=1)
+        self.assertEqual(result['total'], 2)
+        self.assertEqual(sorted(obj._id for obj in result['items']), sorted([first._id, second._id]))
+        result = root.basic_fulltext_search(limit=1, sort='title', scroll='1m')
+        self.assertEqual([obj._id for obj in result['items']], [first._id])
+        result = root.continue_search(result['scroll_id'], scroll='1m')
+        self.assertEqual([obj._id for obj in result['items']], [second._id])
+
     def test_naming_crud(self):
         root = _makeOneRoot(self.request)
         coll = root['example_naming_collection']
@@ -567,6 +1630,15 @@ class FunctionalTests(unittest.TestCase):
         self.assertEqual(coll.rename_child(name1, name2), 1)
         self.assertFalse(coll.has_child_with_name(name1))
         self.assertTrue(coll.has_child_with_name(name2))
+        self.assertTrue(coll.get_child_by_name(name2)._modified > instance._modified)
+        root.refresh_elastic()
+        self.assertEqual(root.basic_fulltext_search('__name__:%s' % name2)['total'], 1)
+
+        from audrey.exceptions import Veto
+        coll.add_child(_makeOneNamedObject(self.request, name1))
+        with self.assertRaises(Veto) as cm:
+            coll.rename_child(name1, name2)
+        self.assertEqual(cm.exception.args[0], '''The name "%s" is already in use.''' % name2)
 
     def test_file_bookkeeping(self):
         # FIXME: create an object with 2 files and save it
@@ -576,3 +1648,369 @@ class FunctionalTests(unittest.TestCase):
         # Delete the object.
         # Verify that the parents are correct (empty) for all 3 files.
         pass
+
+    def test_add_children(self):
+        root = _makeOneRoot(self.request)
+        coll = root['example_naming_collection']
+        coll.add_child(_makeOneNamedObject(self.request, 'taken'))
+        children = [
+            _makeOneNamedObject(self.request, 'one'),
+            _makeOneNamedObject(self.request, 'taken'),
+            _makeOneNamedObject(self.request, 'two'),
+            _makeOneNamedObject(self.request, ''),
+            _getExampleObjectClass()(self.request),
+        ]
+        errors = coll.add_children(children)
+        self.assertEqual(errors, [None, 'The name "taken" is already in use.', None, 'Name may not be empty.', 'Cannot add example_object to example_naming_collection.'])
+        self.assertTrue(coll.has_child_with_name('one'))
+        self.assertTrue(coll.has_child_with_name('two'))
+        self.assertNotEqual(children[0]._etag, None)
+        self.assertEqual(children[0].__parent__, coll)
+        root.refresh_elastic()
+        self.assertEqual(root.basic_fulltext_search()['total'], 3)
+
+    def test_unit_of_work(self):
+        root = _makeOneRoot(self.request)
+        coll = root['example_naming_collection']
+        coll.add_child(_makeOneNamedObject(self.request, 'doomed'))
+        uow = root.begin_unit_of_work()
+        one = _makeOneNamedObject(self.request, 'one')
+        coll.add_child(one)
+        self.assertNotEqual(one._id, None)
+        coll.add_child(_makeOneNamedObject(self.request, 'two'))
+        coll.delete_child_by_name('doomed')
+        # Nothing is written until the commit.
+        self.assertFalse(coll.has_child_with_name('one'))
+        self.assertTrue(coll.has_child_with_name('doomed'))
+        one.title = 'Changed'
+        one.save()
+        self.assertEqual(len(uow), 3)
+        self.assertEqual(uow.commit(), dict(saved=2, deleted=1))
+        self.assertEqual(root.get_unit_of_work(), None)
+        self.assertEqual(coll.get_child_names(sort=[('__name__', 1)]), ['one', 'two'])
+        self.assertEqual(coll['one'].title, 'Changed')
+        root.refresh_elastic()
+        self.assertEqual(root.basic_fulltext_search()['total'], 2)
+
+        from audrey.exceptions import CommitError
+        uow = root.begin_unit_of_work()
+        coll.add_child(_makeOneNamedObject(self.request, 'three'))
+        # Names that are already in use are only detected on commit.
+        coll.add_child(_makeOneNamedObject(self.request, 'three'))
+        try:
+            uow.commit()
+            self.fail('Expected a CommitError')
+        except CommitError, e:
+            self.assertEqual([msg for (obj, msg) in e.errors], ['The name "three" is already in use.'])
+        self.assertTrue(coll.has_child_with_name('three'))
+
+        # A save doesn't undo a concurrent delete.
+        uow = root.begin_unit_of_work()
+        two = coll['two']
+        two.title = 'Changed'
+        two.save()
+        coll.get_mongo_collection().remove({'_id':two._id}, safe=True)
+        try:
+            uow.commit()
+            self.fail('Expected a CommitError')
+        except CommitError, e:
+            self.assertEqual([msg for (obj, msg) in e.errors], ['The object has been removed.'])
+        self.assertFalse(coll.has_child_with_name('two'))
+
+    def test_delete_children(self):
+        root = _makeOneRoot(self.request)
+        coll = root['example_collection']
+        for i in range(6):
+            obj = _makeOneObject(self.request, title='Keep' if i == 0 else 'Doomed')
+            coll.add_child(obj)
+            if i > 3:
+                root.create_gridfs_file('data', 'data.txt', 'text/plain', parents=[obj.get_dbref()])
+        kept = coll.get_child(dict(title='Keep'))
+        result = coll.delete_children({'title':{'$ne':'Keep'}}, chunk_size=2, rate_limit=1000)
+        self.assertEqual(result, dict(deleted=5, files=2, chunks=3))
+        self.assertEqual(coll.get_child_names(), [kept.__name__])
+        gridfs = root.get_gridfs()
+        for item in gridfs._GridFS__files.find():
+            self.assertEqual(item['parents'], [])
+        root.refresh_elastic()
+        self.assertEqual(root.basic_fulltext_search()['total'], 1)
+        self.assertEqual(coll.delete_children(dict(title='Nothing')), dict(deleted=0, files=0, chunks=0))
+
+    def test_update_children(self):
+        root = _makeOneRoot(self.request)
+        coll = root['example_collection']
+        for title in ('One', 'Two', 'Three'):
+            coll.add_child(_makeOneObject(self.request, title=title))
+        two = coll.get_child(dict(title='Two'))
+        new_dateline = datetime.date(2001, 2, 3)
+        result = coll.update_children({'title':{'$ne':'One'}}, dict(dateline=new_dateline))
+        self.assertEqual(result, dict(updated=2, reindexed=0))
+        changed = coll.get_child(dict(title='Two'))
+        self.assertEqual(changed.dateline, datetime.datetime(2001, 2, 3, tzinfo=changed._modified.tzinfo))
+        self.assertNotEqual(changed._etag, two._etag)
+        self.assertTrue(changed._modified > two._modified)
+        self.assertEqual(coll.get_child(dict(title='One')).dateline.date(), today)
+
+        result = coll.update_children({'title':'Three'}, dict(title='Changed'), chunk_size=1)
+        self.assertEqual(result, dict(updated=1, reindexed=1))
+        root.refresh_elastic()
+        self.assertEqual(root.basic_fulltext_search('Changed')['total'], 1)
+        self.assertEqual(root.basic_fulltext_search('Three')['total'], 0)
+
+    def test_partial_save(self):
+        root = _makeOneRoot(self.request)
+        coll = root['example_collection']
+        coll.add_child(_makeOneObject(self.request))
+        instance = coll.get_child()
+        # Change the body behind the instance's back.
+        coll.get_mongo_collection().update({'_id':instance._id}, {'$set':{'body':'Changed elsewhere.'}}, safe=True)
+        indexed = []
+        instance.index = lambda: indexed.append(True)
+        instance.dateline = datetime.date(2001, 2, 3)
+        instance.save()
+        # The dateline doesn't feed the full text.
+        self.assertEqual(indexed, [])
+        instance.title = 'New Title'
+        instance.save()
+        self.assertEqual(indexed, [True])
+        instance.save(set_modified=False, set_etag=False)
+        self.assertEqual(indexed, [True])
+        doc = coll.get_mongo_collection().find_one(instance._id)
+        self.assertEqual(doc['title'], 'New Title')
+        self.assertEqual(doc['dateline'].date(), datetime.date(2001, 2, 3))
+        self.assertEqual(doc['body'], 'Changed elsewhere.')
+        self.assertEqual(doc['_etag'], instance._etag)
+
+    def test_patch(self):
+        import json
+        import webob
+        from pyramid.request import Request
+        root = _makeOneRoot(self.request)
+        coll = root['example_collection']
+        instance = _makeOneObject(self.request)
+        coll.add_child(instance)
+        request = Request.blank('/example_collection/%s/' % instance.__name__, method='PATCH', headers={
+            'Accept': 'application/json',
+            'Content-Type': 'application/merge-patch+json',
+            'If-Match': '"%s"' % instance._etag,
+            'If-Unmodified-Since': webob.datetime_utils.serialize_date(instance._modified),
+        })
+        request.body = json.dumps(dict(title='Patched', tags=['baz']))
+        response = request.get_response(self.app)
+        self.assertEqual(response.status_int, 200)
+        patched = coll.get_child_by_id(instance._id)
+        self.assertEqual(patched.title, 'Patched')
+        self.assertEqual(patched.tags, ['baz'])
+        self.assertEqual(patched.body, instance.body)
+        self.assertEqual(response.etag, patched._etag)
+
+    def test_patch_race(self):
+        import webob
+        from audrey.views import object_patch
+        root = _makeOneRoot(self.request)
+        coll = root['example_collection']
+        added = _makeOneObject(self.request)
+        coll.add_child(added)
+        instance = coll.get_child_by_id(added._id)
+        request = testing.DummyRequest()
+        request.headers['If-Match'] = '"%s"' % instance._etag
+        request.headers['If-Unmodified-Since'] = webob.datetime_utils.serialize_date(instance._modified)
+        request.content_type = 'application/merge-patch+json'
+        request.json_body = dict(title='Patched')
+        # Another request saves the object after it was loaded.
+        coll.get_mongo_collection().update({'_id':instance._id}, {'$set':{'_etag':'other', 'title':'Other'}})
+        self.assertEqual(object_patch(instance, request)['status'], 412)
+        self.assertEqual(coll.get_mongo_collection().find_one(instance._id)['title'], 'Other')
+
+    def test_conditional_writes(self):
+        import json
+        import webob
+        from pyramid.request import Request
+        from audrey.exceptions import PreconditionFailed
+        root = _makeOneRoot(self.request)
+        coll = root['example_collection']
+        instance = _makeOneObject(self.request)
+        coll.add_child(instance)
+        headers = {
+            'Accept': 'application/json',
+            'If-Match': '"%s"' % instance._etag,
+            'If-Unmodified-Since': webob.datetime_utils.serialize_date(instance._modified),
+        }
+        url = '/example_collection/%s/' % instance.__name__
+        body = json.dumps(dict(_object_type='example_object', title='Put', body='Body', dateline='2012-12-24', tags=[]))
+        request = Request.blank(url, method='PUT', headers=headers)
+        request.body = body
+        response = request.get_response(self.app)
+        self.assertEqual(response.status_int, 200)
+        saved = coll.get_child_by_id(instance._id)
+        self.assertEqual(saved.title, 'Put')
+        self.assertEqual(saved._created, instance._created)
+        self.assertEqual(response.etag, saved._etag)
+
+        # The old headers no longer match.
+        request = Request.blank(url, method='PUT', headers=headers)
+        request.body = body
+        self.assertEqual(request.get_response(self.app).status_int, 412)
+        request = Request.blank(url, method='DELETE', headers=headers)
+        self.assertEqual(request.get_response(self.app).status_int, 412)
+        self.assertRaises(PreconditionFailed, coll.delete_child, instance, if_match=instance._etag)
+
+        coll.delete_child(saved, if_match=saved._etag, if_unmodified_since=saved._modified)
+        self.assertFalse(coll.has_child_with_id(instance._id))
+
+
+    def test_reindex_pipeline(self):
+        root = _makeOneRoot(self.request)
+        coll = root['example_collection']
+        for i in range(5):
+            coll.add_child(_makeOneObject(self.request, title='Object %d' % i))
+        ids = [child._id for child in coll.get_children(sort=[('_id', 1)])]
+        seen = []
+        econn = coll.get_elastic_connection()
+        econn_bulk_size = econn.bulk_size
+        def progress(coll, count, last_id):
+            # Everything up to last_id has been sent.
+            self.assertEqual(econn.bulker.bulk_data, [])
+            seen.append((count, last_id))
+        self.assertEqual(coll.reindex_all(clear=True, bulk_size=2, progress=progress), 5)
+        self.assertEqual(seen, [(2, ids[1]), (4, ids[3]), (5, ids[4])])
+        # The shared connection's bulk size is left alone.
+        self.assertEqual(econn.bulk_size, econn_bulk_size)
+        root.refresh_elastic()
+        self.assertEqual(root.search_raw()['hits']['total'], 5)
+        self.assertEqual(coll.reindex_all(start_after=ids[2], rate_limit=1000), 2)
+        self.assertEqual(root.reindex_all(start_after=('example_collection', ids[3])), 1)
+        self.assertEqual(root.reindex_all(collection_names=['example_naming_collection']), 0)
+
+    def test_rebuild_elastic(self):
+        from audrey.elasticindex import get_alias_indices
+        root = _makeOneRoot(self.request)
+        alias = root.get_elastic_index_name()
+        [old_index] = get_alias_indices(self.elastic_conn, alias)
+        self.assertNotEqual(old_index, alias)
+        coll = root['example_collection']
+        for i in range(3):
+            coll.add_child(_makeOneObject(self.request, title='Object %d' % i))
+        self.assertEqual(root.get_elastic_write_index_names(), [alias])
+        self.assertEqual(root.rebuild_elastic(delay=0), 3)
+        [new_index] = get_alias_indices(self.elastic_conn, alias)
+        self.assertNotEqual(new_index, old_index)
+        self.assertFalse(self.elastic_conn.indices.exists_index(old_index))
+        root.refresh_elastic()
+        self.assertEqual(root.search_raw()['hits']['total'], 3)
+
+    def test_rebuild_elastic_catches_up(self):
+        from audrey.elasticindex import rebuild_index
+        root = _makeOneRoot(self.request)
+        coll = root['example_collection']
+        for i in range(3):
+            coll.add_child(_makeOneObject(self.request, title='Object %d' % i))
+        # Cache the write index names, so the delete below misses the new index.
+        root.get_elastic_write_index_names()
+        def progress(coll, count, last_id):
+            if count == 1:
+                coll.delete_child(coll.get_child_by_id(last_id))
+        result = rebuild_index(root, delay=0, bulk_size=1, progress=progress)
+        self.assertEqual(result['count'], 3)
+        self.assertEqual(result['caught_up']['unindexed'], 1)
+        root.refresh_elastic()
+        self.assertEqual(root.search_raw()['hits']['total'], 2)
+
+    def test_reindex_modified(self):
+        import datetime
+        from audrey import dateutil
+        root = _makeOneRoot(self.request)
+        coll = root['example_collection']
+        self.assertEqual(coll.get_reindex_checkpoint(), None)
+        instances = [_makeOneObject(self.request, title='Object %d' % i) for i in range(3)]
+        for instance in instances:
+            coll.add_child(instance)
+        # Without a checkpoint, everything is reindexed.
+        result = coll.reindex_modified()
+        self.assertEqual((result['reindexed'], result['unindexed']), (3, 0))
+        self.assertEqual(coll.get_reindex_checkpoint(), result['checkpoint'])
+        self.assertEqual(result['checkpoint'].microsecond % 1000, 0)
+
+        # The saved checkpoint has a margin, so move it past the saves above.
+        coll.set_reindex_checkpoint(dateutil.utcnow() + datetime.timedelta(minutes=1))
+        # Change one object and delete another behind Elastic's back.
+        coll.get_mongo_collection().update({'_id':instances[0]._id}, {'$set':{'_modified':dateutil.utcnow() + datetime.timedelta(minutes=5)}})
+        coll.get_mongo_collection().remove({'_id':instances[1]._id})
+        root.refresh_elastic()
+        self.assertEqual(root.reindex_modified(), dict(reindexed=1, unindexed=1))
+        root.refresh_elastic()
+        self.assertEqual(root.search_raw()['hits']['total'], 2)
+        result = coll.reindex_modified(since=dateutil.utcnow() + datetime.timedelta(minutes=10), save_checkpoint=False)
+        self.assertEqual((result['reindexed'], result['unindexed']), (0, 0))
+
+    def test_parallel_reindex(self):
+        root = _makeOneRoot(self.request)
+        coll = root['example_collection']
+        for i in range(10):
+            coll.add_child(_makeOneObject(self.request, title='Object %d' % i))
+        ids = [child._id for child in coll.get_children(sort=[('_id', 1)])]
+        self.assertEqual(coll.get_id_ranges(3), [(None, ids[2]), (ids[2], ids[5]), (ids[5], None)])
+        self.assertEqual(coll.get_id_ranges(20, start_after=ids[7]), [(ids[7], ids[8]), (ids[8], None)])
+        self.assertEqual(coll.reindex_all(up_to=ids[4]), 5)
+        self.assertEqual(coll.reindex_all(clear=True, processes=2), 10)
+        root.refresh_elastic()
+        self.assertEqual(root.search_raw()['hits']['total'], 10)
+        self.assertEqual(root.reindex_all(processes=2, start_after=('example_collection', ids[5])), 4)
+
+# The following tests only need access to a Mongo server.
+class OutboxTests(unittest.TestCase):
+
+    def setUp(self):
+        import pymongo
+        from audrey.outbox import Outbox
+        self.mongo_conn = pymongo.Connection("mongodb://127.0.0.1")
+        self.mongo_coll = self.mongo_conn['audrey_unittests']['test_outbox']
+        self.outbox = Outbox(self.mongo_coll, write_concern=dict(w=1))
+        self.outbox.ensure_indexes()
+
+    def tearDown(self):
+        self.mongo_coll.drop()
+        self.mongo_conn.disconnect()
+
+    def test_apply(self):
+        written = []
+        root = _makeDummyElasticRoot(written)
+        self.outbox.put('a', '1', 'index')
+        self.outbox.put_many([('a', '1', 'unindex'), ('b', '2', 'index')])
+        self.outbox.put_many([])
+        self.assertEqual(len(self.outbox), 3)
+        self.assertEqual(self.outbox.run(root, batch_size=2, forever=False), 3)
+        self.assertEqual(len(self.outbox), 0)
+        self.assertEqual(written, [('a', '1', 'unindex'), 'flush', ('b', '2', 'index'), 'flush'])
+
+    def test_retry(self):
+        written = []
+        root = _makeDummyElasticRoot(written)
+        def fail():
+            raise ValueError
+        root.flush_elastic_bulk = fail
+        self.outbox.put('a', '1', 'index')
+        self.assertRaises(ValueError, self.outbox.apply, root)
+        # The record is kept for a retry.
+        self.assertEqual(self.mongo_coll.find_one()['attempts'], 1)
+        self.outbox.put('a', '2', 'index')
+        root = _makeDummyElasticRoot(written)
+        # Records that haven't failed are applied first.
+        self.assertEqual(self.outbox.apply(root, batch_size=1), 1)
+        self.assertEqual(self.outbox.apply(root, batch_size=1), 1)
+        self.assertEqual(len(self.outbox), 0)
+        self.assertEqual(written, [('a', '1', 'index'), ('a', '2', 'index'), 'flush', ('a', '1', 'index'), 'flush'])
+
+    def test_isolates_failures(self):
+        written = []
+        root = _makeDummyElasticRoot(written)
+        for id in ['1', 'bad', '2', 'err', '3']:
+            self.outbox.put('a', id, 'index')
+        # Only the records that fail on their own are kept.
+        self.assertEqual(self.outbox.apply(root), 3)
+        kept = sorted((r['id'], r['attempts']) for r in self.mongo_coll.find())
+        self.assertEqual(kept, [('bad', 1), ('err', 1)])
+        self.assertEqual(sorted(set(x for x in written if x != 'flush')), [('a', '1', 'index'), ('a', '2', 'index'), ('a', '3', 'index'), ('a', 'err', 'index')])
+        # When nothing can be applied, an exception is raised.
+        self.assertRaises(ValueError, self.outbox.apply, root)
+        self.assertEqual(sorted((r['id'], r['attempts']) for r in self.mongo_coll.find()), [('bad', 2), ('err', 2)])
@@ -0,0 +1,120 @@
+import zlib
+from pyramid.settings import asbool, aslist
+from audrey.httputil import add_etag_suffix
+from audrey.unitofwork import begin_unit_of_work
+
+DEFAULT_COMPRESS_TYPES = ['application/hal+json', 'application/schema+json']
+DEFAULT_COMPRESS_MIN_LENGTH = 1024
+COMPRESS_LEVEL = 6
+
+# zlib window bits for each supported Content-Encoding.
+# Note that HTTP's "deflate" is the zlib format (RFC 1950), not raw deflate.
+WBITS = {
+    'gzip': 16 + zlib.MAX_WBITS,
+    'deflate': zlib.MAX_WBITS,
+}
+
+def compression_tween_factory(handler, registry):
+    """ A tween that compresses response bodies with gzip or deflate,
+    as negotiated by the request's ``Accept-Encoding`` header.
+
+    Only responses whose content type is listed in the
+    ``compress_types`` setting are compressed (by default
+    ``application/hal+json`` and ``application/schema+json``).
+    Bodies shorter than ``compress_min_length`` bytes are left alone,
+    while streamed bodies (see :class:`audrey.renderers.StreamingJSON`)
+    are always compressed incrementally.
+    A compressed response's ETag gets the content coding as a suffix
+    (see :func:`audrey.httputil.add_etag_suffix`), since it's no longer
+    the same entity as the uncompressed one.
+
+    Setting ``compress_responses`` to false disables this tween.
+    """
+    settings = registry.settings
+    if not asbool(settings.get('compress_responses', True)):
+        return handler
+    compress_types = set(aslist(settings.get('compress_types', '')) or DEFAULT_COMPRESS_TYPES)
+    min_length = int(settings.get('compress_min_length', DEFAULT_COMPRESS_MIN_LENGTH))
+
+    def compression_tween(request):
+        response = handler(request)
+        if response.content_type not in compress_types:
+            return response
+        response.vary = _add_vary(response.vary, 'Accept-Encoding')
+        if response.content_encoding or response.status_int in (204, 304):
+            return response
+        # Note that a missing Accept-Encoding header is falsy.
+        if request.method == 'HEAD' or not request.accept_encoding:
+            return response
+        encoding = request.accept_encoding.best_match(['gzip', 'deflate'])
+        if encoding not in WBITS:
+            return response
+        if response.content_length is not None:
+            if response.content_length < min_length:
+                return response
+            response.body = compress(response.body, encoding)
+        else:
+            response.app_iter = compress_iter(response.app_iter, encoding)
+        response.content_encoding = encoding
+        add_etag_suffix(response, encoding)
+        return response
+
+    return compression_tween
+
+def unit_of_work_tween_factory(handler, registry):
+    """ A tween that runs each request in a unit of work
+    (see :class:`audrey.unitofwork.UnitOfWork`), so that the saves and
+    deletes made by a view are written in bulk after it returns.
+
+    The unit of work is committed if the response status is less than 400
+    and aborted otherwise (or if the view raises an exception).
+    If the commit fails, the :class:`audrey.exceptions.CommitError`
+    is raised to the exception view (see :func:`audrey.views.commit_error`).
+
+    This tween is disabled unless the ``auto_unit_of_work`` setting is true.
+    """
+    if not asbool(registry.settings.get('auto_unit_of_work', False)):
+        return handler
+
+    def unit_of_work_tween(request):
+        uow = begin_unit_of_work(request.environ)
+        try:
+            response = handler(request)
+        except:
+            uow.abort()
+            raise
+        if response.status_int < 400:
+            uow.commit()
+        else:
+            uow.abort()
+        return response
+
+    return unit_of_work_tween
+
+def compress(data, encoding):
+    """ Return ``data`` compressed for the given Content-Encoding
+    (``gzip`` or ``deflate``).
+    """
+    compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, WBITS[encoding])
+    return compressor.compress(data) + compressor.flush()
+
+def compress_iter(app_iter, encoding):
+    """ Return a generator that compresses the chunks of ``app_iter``
+    as they are produced.
+    """
+    compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, WBITS[encoding])
+    try:
+        for chunk in app_iter:
+            # Sync-flush each chunk so that streamed output isn't
+            # held back in zlib's buffers.
+            yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        yield compressor.flush()
+    finally:
+        if hasattr(app_iter, 'close'):
+            app_iter.close()
+
+def _add_vary(vary, header):
+    vary = list(vary or ())
+    if header not in vary:
+        vary.append(header)
+    return tuple(vary)
@@ -0,0 +1,267 @@
+from collections import OrderedDict
+from bson.objectid import ObjectId
+from pymongo.errors import BulkWriteError
+from pyramid.traversal import find_root
+from audrey import dateutil
+from audrey.exceptions import CommitError
+from audrey.resources.collection import DUPLICATE_KEY_ERRORS
+
+# The WSGI environ key of a request's active unit of work.
+ENVIRON_KEY = 'audrey.unit_of_work'
+
+def get_unit_of_work(environ):
+    """ Return the active unit of work for a request, or ``None``.
+
+    :param environ: a WSGI environ
+    :type environ: dictionary
+    :rtype: :class:`UnitOfWork` or ``None``
+    """
+    return environ.get(ENVIRON_KEY)
+
+def begin_unit_of_work(environ):
+    """ Begin a unit of work for a request and return it.
+    If a unit of work is already active, the same one is returned
+    (and the caller's :meth:`UnitOfWork.commit` won't write anything
+    until the outermost caller commits).
+
+    :param environ: a WSGI environ
+    :type environ: dictionary
+    :rtype: :class:`UnitOfWork`
+    """
+    uow = environ.get(ENVIRON_KEY)
+    if uow is None:
+        uow = environ[ENVIRON_KEY] = UnitOfWork(environ)
+    uow._depth += 1
+    return uow
+
+class UnitOfWork(object):
+    """ Records saves and deletes of Objects so that they can be written
+    together.
+
+    While a unit of work is active for a request,
+    :meth:`audrey.resources.object.Object.save` (and so
+    :meth:`audrey.resources.collection.Collection.add_child`)
+    and :meth:`audrey.resources.collection.Collection.delete_child` don't
+    write anything themselves.  Instead they are recorded here, and
+    :meth:`flush` writes them all with one MongoDB bulk operation per
+    collection, one query and one bulk update for the "parents" of the
+    GridFS files involved, and one ElasticSearch bulk request.
+
+    Saves still validate their object immediately and new objects are
+    assigned an ``_id`` right away, but the MongoDB document is captured
+    at the time of the save; later changes to the object need another save.
+    Only new objects (those not loaded from MongoDB) are upserted; an
+    object that was deleted by someone else before the commit stays
+    deleted, and its save raises :class:`audrey.exceptions.CommitError`.
+    Only the last save or delete recorded for an object is written.
+    Since nothing is written until then, a new object whose name is
+    already in use isn't vetoed by ``add_child``; the duplicate key
+    error raises :class:`audrey.exceptions.CommitError` from the commit.
+    (:meth:`audrey.resources.collection.NamingCollection.rename_child`
+    isn't recorded; it writes immediately.)
+
+    Use :meth:`audrey.resources.root.Root.begin_unit_of_work` to
+    get one.  A unit of work is a context manager that commits
+    when the ``with`` block succeeds and aborts when it raises::
+
+        with root.begin_unit_of_work():
+            for obj in objects:
+                obj.save()
+    """
+
+    def __init__(self, environ):
+        self.environ = environ
+        self._ops = OrderedDict()
+        self._depth = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.abort()
+
+    def __len__(self):
+        return len(self._ops)
+
+    def save(self, obj, index=True):
+        """ Record a save of ``obj``.
+        This is normally called by :meth:`audrey.resources.object.Object.save`
+        after it has validated the object.
+
+        :param obj: an object with a ``__parent__``
+        :type obj: :class:`audrey.resources.object.Object`
+        :param index: Should the object be (re-)indexed in ElasticSearch?
+        :type index: boolean
+        """
+        # Objects that weren't loaded from (or saved to) MongoDB are new.
+        new = getattr(obj, '_saved_doc', None) is None
+        if obj._id is None:
+            obj._id = ObjectId()
+        self._record(_Operation(obj, doc=obj.get_mongo_save_doc(), index=index,
+            file_ids=set([x._id for x in obj.get_all_files()]), new=new))
+
+    def delete(self, obj):
+        """ Record a delete of ``obj``.
+        This is normally called by :meth:`audrey.resources.collection.Collection.delete_child`.
+
+        :param obj: an object with a ``__parent__``
+        :type obj: :class:`audrey.resources.object.Object`
+        """
+        self._record(_Operation(obj))
+
+    def _record(self, op):
+        key = (op.dbref.collection, op.dbref.id)
+        # Only the latest operation on an object matters.
+        self._ops.pop(key, None)
+        self._ops[key] = op
+
+    def flush(self):
+        """ Write all the pending operations.
+
+        Raises :class:`audrey.exceptions.CommitError` if any of them failed
+        (in which case the rest are still written).
+
+        :rtype: dictionary with the keys "saved" and "deleted" (integer counts of the successful operations)
+        """
+        ops = self._ops.values()
+        self._ops = OrderedDict()
+        counts = dict(saved=0, deleted=0)
+        if not ops:
+            return counts
+        root = find_root(ops[0].obj)
+
+        # Note the GridFS files that the objects used to refer to.
+        fs_files_coll = root.get_gridfs()._GridFS__files
+        old_file_ids = {}
+        for item in fs_files_coll.find({'parents':{'$in':[op.dbref for op in ops]}}, fields=['parents']):
+            for dbref in item['parents']:
+                old_file_ids.setdefault(dbref, set()).add(item['_id'])
+
+        # Add any outbox records before writing (see
+        # audrey.outbox.Outbox.write_ahead).
+        for op in ops:
+            if op.is_delete() or op.index:
+                op.obj._write_ahead_to_outbox()
+
+        # Write the objects, with one bulk operation per collection.
+        by_collection = OrderedDict()
+        for op in ops:
+            by_collection.setdefault(op.dbref.collection, []).append(op)
+        for coll_ops in by_collection.values():
+            parent = coll_ops[0].obj.__parent__
+            mongo_coll = parent.get_mongo_collection()
+            bulk = mongo_coll.initialize_unordered_bulk_op()
+            for op in coll_ops:
+                if op.is_delete():
+                    bulk.find({'_id':op.dbref.id}).remove_one()
+                elif op.new:
+                    bulk.find({'_id':op.dbref.id}).upsert().replace_one(op.doc)
+                else:
+                    # Don't undo a concurrent delete.
+                    bulk.find({'_id':op.dbref.id}).replace_one(op.doc)
+            try:
+                result = bulk.execute(write_concern=parent.get_write_concern())
+            except BulkWriteError, e:
+                result = e.details
+                for write_error in e.details['writeErrors']:
+                    op = coll_ops[write_error['index']]
+                    if write_error['code'] in DUPLICATE_KEY_ERRORS:
+                        op.error = op.obj.__parent__.get_duplicate_key_error(op.obj)
+                    else:
+                        op.error = write_error['errmsg']
+            # If fewer existing objects were replaced than expected
+            # (unknowable with unacknowledged writes), find the missing ones.
+            replaced = [op for op in coll_ops if not (op.is_delete() or op.new) and op.error is None]
+            if replaced and result is not None and result.get('nMatched', len(replaced)) < len(replaced):
+                found = set([doc['_id'] for doc in mongo_coll.find({'_id':{'$in':[op.dbref.id for op in replaced]}}, fields=[])])
+                for op in replaced:
+                    if op.dbref.id not in found:
+                        op.error = "The object has been removed."
+        done = [op for op in ops if op.error is None]
+
+        # Update GridFS file "parents", with one bulk operation per
+        # write concern of the objects' collections.
+        fs_bulks = OrderedDict()
+        now = dateutil.utcnow()
+        for op in done:
+            old = old_file_ids.get(op.dbref, set())
+            updates = []
+            if old - op.file_ids:
+                updates.append((old - op.file_ids, {"$pull":{"parents":op.dbref}, "$set":{"lastmodDate": now}}))
+            if op.file_ids - old:
+                updates.append((op.file_ids - old, {"$addToSet":{"parents":op.dbref}, "$set":{"lastmodDate": now}}))
+            if not updates:
+                continue
+            wc = op.obj.__parent__.get_write_concern()
+            key = tuple(sorted(wc.items()))
+            if key not in fs_bulks:
+                fs_bulks[key] = (wc, fs_files_coll.initialize_unordered_bulk_op())
+            fs_bulk = fs_bulks[key][1]
+            for (ids, update) in updates:
+                fs_bulk.find({'_id':{'$in':list(ids)}}).update(update)
+        for (wc, fs_bulk) in fs_bulks.values():
+            fs_bulk.execute(write_concern=wc)
+
+        # Update ElasticSearch.
+        for op in done:
+            if op.is_delete():
+                op.obj.unindex(bulk=True)
+                op.obj._saved_doc = None
+                op.obj._index_hash = None
+                counts['deleted'] += 1
+            else:
+                if op.index: op.obj.index(bulk=True)
+                op.obj._saved_doc = op.doc
+                # Replacing the document removed any saved index hash.
+                op.obj._index_hash = None
+                counts['saved'] += 1
+        root.flush_elastic_bulk()
+
+        errors = [(op.obj, op.error) for op in ops if op.error is not None]
+        if errors:
+            raise CommitError(errors)
+        return counts
+
+    def commit(self):
+        """ End this unit of work, writing the pending operations
+        (see :meth:`flush`).
+
+        If this unit of work was begun more than once (see
+        :func:`begin_unit_of_work`), only the outermost commit writes.
+
+        :rtype: dictionary like :meth:`flush` or ``None`` if this wasn't the outermost commit
+        """
+        self._depth -= 1
+        if self._depth > 0:
+            return None
+        self._end()
+        return self.flush()
+
+    def abort(self):
+        """ End this unit of work, discarding the pending operations.
+        """
+        self._ops = OrderedDict()
+        self._depth = 0
+        self._end()
+
+    def _end(self):
+        if self.environ.get(ENVIRON_KEY) is self:
+            del self.environ[ENVIRON_KEY]
+
+class _Operation(object):
+    # A pending save (when doc isn't None) or delete.
+
+    def __init__(self, obj, doc=None, index=True, file_ids=None, new=False):
+        self.obj = obj
+        self.dbref = obj.get_dbref()
+        self.doc = doc
+        self.index = index
+        self.file_ids = file_ids or set()
+        self.new = new
+        self.error = None
+
+    def is_delete(self):
+        return self.doc is None
@@ -1,19 +1,35 @@
+import base64
+import hashlib
+import hmac
+import json
+import logging
 import colander
 import webob
 from pyramid.encode import urlencode
 from pyramid.httpexceptions import HTTPNotFound
+from pyramid.request import Request
 from pyramid.traversal import find_root, resource_path
+from pyes.exceptions import ElasticSearchException
 import resources
-from exceptions import Veto
+from exceptions import Veto, PreconditionFailed
 import sortutil
 from bson.objectid import ObjectId
 import audrey.resources
 from audrey.colanderutil import AudreySchemaConverter
+from audrey.httputil import strip_etag_suffixes
 
 DEFAULT_BATCH_SIZE = 20
 MAX_BATCH_SIZE = 100
+MAX_BATCH_OPERATIONS = 100
+IMPORT_CHUNK_SIZE = 500
+MAX_IMPORT_CHUNK_SIZE = 5000
+BATCH_RESPONSE_HEADERS = ('Location', 'ETag', 'Last-Modified')
+# Acceptable Content-Types for PATCH request bodies.
+MERGE_PATCH_TYPES = ('application/merge-patch+json', 'application/json')
 SCHEMA_CONVERTER = AudreySchemaConverter()
 
+log = logging.getLogger(__name__)
+
 def get_href(context, *elements, **kw):
     # Return absolute url:
     #return context.request.resource_url(context, *elements, **kw)
@@ -145,7 +161,7 @@ def method_not_allowed(context, request):
         "%s not supported by this resource." % request.method)
 
 def object_options(context, request):
-    request.response.allow = "HEAD,GET,OPTIONS,PUT,DELETE"
+    request.response.allow = "HEAD,GET,OPTIONS,PUT,PATCH,DELETE"
     request.response.status_int = 204 # No Content
 
 def root_options(context, request):
@@ -210,7 +226,7 @@ def test_preconditions(context, request):
     if_match = request.headers.get('If-Match')
     if not (if_unmodified_since and if_match):
         error='Request must supply If-Unmodified-Since and If-Match headers.'
-    elif if_match != ('"%s"' % context._etag):
+    elif strip_etag_suffixes(if_match) != ('"%s"' % context._etag):
         error='If-Match header does not match current Etag.'
     elif if_unmodified_since != webob.datetime_utils.serialize_date(context._modified):
         error='If-Unmodified-Since header does not match current modification timestamp.'
@@ -218,6 +234,23 @@ def test_preconditions(context, request):
         return generic_response(request, 412, error)
     return None
 
+def get_preconditions(request):
+    # Like test_preconditions, but for views that check the preconditions
+    # as part of their write.  Returns a tuple (preconditions, error) where
+    # preconditions is a dictionary of if_match and if_unmodified_since
+    # kwargs (for Object.save or Collection.delete_child), and error is
+    # either None or a failure dictionary (like test_preconditions).
+    if_unmodified_since = request.headers.get('If-Unmodified-Since')
+    if_match = request.headers.get('If-Match')
+    if not (if_unmodified_since and if_match):
+        return (None, generic_response(request, 412, 'Request must supply If-Unmodified-Since and If-Match headers.'))
+    if not (len(if_match) > 1 and if_match.startswith('"') and if_match.endswith('"')):
+        return (None, generic_response(request, 412, 'If-Match header does not match current Etag.'))
+    if_unmodified_since = webob.datetime_utils.parse_date(if_unmodified_since)
+    if if_unmodified_since is None:
+        return (None, generic_response(request, 412, 'If-Unmodified-Since header does not match current modification timestamp.'))
+    return (dict(if_match=strip_etag_suffixes(if_match[1:-1]), if_unmodified_since=if_unmodified_since), None)
+
 def object_put(context, request):
     # Update an existing object.
     # Response body is simple application/json document with keys:
@@ -228,7 +261,10 @@ def object_put(context, request):
     # Possible failure statuses:
     # 412 Precondition Failed
     # 400 Bad Request: Validation failed.
-    err = test_preconditions(context, request)
+    # Note that the preconditions are checked atomically as part of
+    # the write, so the context may be a stub that wasn't loaded
+    # (see Collection.construct_child_stub).
+    (preconditions, err) = get_preconditions(request)
     if err: return err
     # FIXME: confirm that _object_type in json_body is correct?
     schema = context.get_schema()
@@ -238,13 +274,86 @@ def object_put(context, request):
         errors = e.asdict()
         return generic_response(request, 400, 'Validation failed.', errors=errors)
     context.set_schema_values(**deserialized)
-    # We just validated the schema, so no need to do it again.
-    context.save(validate_schema=False)
+    try:
+        # We just validated the schema, so no need to do it again.
+        context.save(validate_schema=False, **preconditions)
+    except PreconditionFailed, e:
+        return generic_response(request, 412, str(e))
     request.response.etag = context._etag
     request.response.last_modified = context._modified
     request.response.location = request.resource_url(context)
     return generic_response(request)
 
+def object_patch(context, request):
+    # Partially update an existing object.
+    # The request body should be a JSON Merge Patch (RFC 7386) of the
+    # object's schema values: only the top-level attributes present
+    # in the patch are changed (and validated), and null removes a value.
+    # Response body and statuses are like object_put's, with
+    # the addition of:
+    # 415 Unsupported Media Type: Request body isn't JSON.
+    # The preconditions are checked against the loaded object (which
+    # the patch is merged with) and again atomically as part of the write.
+    (preconditions, err) = get_preconditions(request)
+    if err: return err
+    err = test_preconditions(context, request)
+    if err: return err
+    if request.content_type not in MERGE_PATCH_TYPES:
+        return generic_response(request, 415, 'Request body must be application/merge-patch+json.')
+    try:
+        patch = request.json_body
+    except ValueError:
+        return generic_response(request, 400, 'Request body must be valid JSON.')
+    if type(patch) is not dict:
+        return generic_response(request, 400, 'Request body must be a JSON object.')
+    schema = context.get_schema()
+    values = {}
+    errors = {}
+    for (name, value) in patch.items():
+        if name.startswith('_'):
+            continue # such as _object_type
+        node = schema.get(name)
+        if node is None:
+            errors[name] = 'Unknown attribute.'
+            continue
+        if type(value) is dict:
+            current = getattr(context, name, None)
+            value = json_merge_patch(node.serialize(colander.null if current is None else current), value)
+        elif value is None:
+            value = colander.null
+        try:
+            values[name] = node.deserialize(value)
+        except colander.Invalid, e:
+            errors.update(e.asdict())
+    if errors:
+        return generic_response(request, 400, 'Validation failed.', errors=errors)
+    context.set_schema_values(**values)
+    # Only the changed attributes are written (see Object.save).
+    try:
+        context.save(validate_schema=False, **preconditions)
+    except PreconditionFailed, e:
+        return generic_response(request, 412, str(e))
+    request.response.etag = context._etag
+    request.response.last_modified = context._modified
+    request.response.location = request.resource_url(context)
+    return generic_response(request)
+
+def json_merge_patch(target, patch):
+    """ Return the result of applying a JSON Merge Patch (RFC 7386)
+    to ``target``.  Neither argument is modified.
+    """
+    if type(patch) is not dict:
+        return patch
+    if type(target) is not dict:
+        target = {}
+    result = dict(target)
+    for (key, value) in patch.items():
+        if value is None:
+            result.pop(key, None)
+        else:
+            result[key] = json_merge_patch(result.get(key), value)
+    return result
+
 def object_delete(context, request):
     # Delete an existing object.
     # Response body is simple application/json document with keys:
@@ -252,9 +361,13 @@ def object_delete(context, request):
     # On success, response status is 200.
     # Possible failure statuses:
     # 412 Precondition Failed
-    err = test_preconditions(context, request)
+    # As with object_put, the context may be a stub.
+    (preconditions, err) = get_preconditions(request)
     if err: return err
-    context.__parent__.delete_child(context)
+    try:
+        context.__parent__.delete_child(context, **preconditions)
+    except PreconditionFailed, e:
+        return generic_response(request, 412, str(e))
     return generic_response(request)
 
 def collection_rename(context, request):
@@ -280,11 +393,93 @@ def root_get(context, request):
     )
     econn = context.get_elastic_connection()
     if econn is not None:
-        ret['_links']['search'] = dict(href=get_href(context, '@@search')+"?q={q}{&collections,embed,fields,sort,per_batch}", templated=True)
+        ret['_links']['search'] = dict(href=get_href(context, '@@search')+"?q={q}{&collections,embed,fields,sort,per_batch,facets,scroll,export}", templated=True)
     ret['_links']['audrey:upload'] = dict(href=get_href(context, '@@upload'))
+    ret['_links']['audrey:batch'] = dict(href=get_href(context, '@@batch'))
     request.response.content_type = 'application/hal+json'
     return ret
 
+def root_batch(context, request):
+    # Execute an ordered list of operations in one HTTP request.
+    # Request body should be a JSON array of operations, each an object
+    # with the keys "method", "path", and optionally "headers" (an object)
+    # and "body" (any JSON value, sent as the operation's JSON body).
+    # Each operation is run as a Pyramid subrequest, so it goes through
+    # the same views (and preconditions) as a standalone request would.
+    # ElasticSearch writes made by the operations are queued and sent
+    # as bulk requests.
+    # Response body is simple application/json document with keys:
+    # "ok", "status", and "results" (a list with one object per operation,
+    # each with "status", "headers" and "body" keys).
+    # Note that operations are independent: a failed operation doesn't
+    # prevent later operations from running, nor undo earlier ones.
+    # An operation that raises an exception gets a 500 result.
+    # Operations' Accept-Encoding headers are ignored, since their
+    # results are embedded in this response.
+    # Possible failure statuses:
+    # 400 Bad Request: body isn't a list of operations, or has too many.
+    try:
+        operations = request.json_body
+    except ValueError:
+        return generic_response(request, 400, 'Request body is not valid JSON.')
+    if type(operations) is not list:
+        return generic_response(request, 400, 'Request body must be a list of operations.')
+    if len(operations) > MAX_BATCH_OPERATIONS:
+        return generic_response(request, 400, 'A batch may not have more than %d operations.' % MAX_BATCH_OPERATIONS)
+    results = []
+    try:
+        for op in operations:
+            try:
+                results.append(_run_batch_operation(request, op))
+            except Exception:
+                log.exception("Batch operation failed: %r" % (op,))
+                results.append(dict(status=500, headers={}, body=dict(status=500, ok=False,
+                    error='Operation failed.')))
+    finally:
+        context.flush_elastic_bulk()
+    return generic_response(request, results=results)
+
+def _run_batch_operation(request, op):
+    if type(op) is not dict or not op.get('method') or not op.get('path') or \
+       not isinstance(op['method'], basestring) or not isinstance(op['path'], basestring):
+        return dict(status=400, headers={}, body=dict(status=400, ok=False,
+            error='Operation must have "method" and "path".'))
+    if type(op.get('headers') or {}) is not dict:
+        return dict(status=400, headers={}, body=dict(status=400, ok=False,
+            error='Operation "headers" must be an object.'))
+    method = str(op['method'].upper())
+    subrequest = Request.blank(_header_str(op['path']), base_url=request.application_url)
+    subrequest.method = method
+    if method == 'GET':
+        subrequest.accept = 'application/hal+json'
+    else:
+        subrequest.accept = 'application/json'
+    for (name, value) in (op.get('headers') or {}).items():
+        subrequest.headers[_header_str(name)] = _header_str(value)
+    # The subresponse body is parsed below, so it mustn't be compressed.
+    if 'Accept-Encoding' in subrequest.headers:
+        del subrequest.headers['Accept-Encoding']
+    if 'body' in op:
+        subrequest.content_type = 'application/json'
+        subrequest.body = json.dumps(op['body'])
+    subrequest.environ['audrey.elastic_bulk'] = True
+    response = request.invoke_subrequest(subrequest, use_tweens=True)
+    headers = {}
+    for name in BATCH_RESPONSE_HEADERS:
+        if name in response.headers:
+            headers[name] = response.headers[name]
+    body = None
+    if response.content_type in ('application/json', 'application/hal+json', 'application/schema+json') and response.body:
+        body = json.loads(response.body)
+    return dict(status=response.status_int, headers=headers, body=body)
+
+def _header_str(value):
+    # Return a header (or path) value from a batch operation as a
+    # (UTF-8 encoded) str.
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
 def root_upload(context, request):
     ret = generic_response(request)
     for (name, val) in request.POST.items():
@@ -316,6 +511,50 @@ def root_search(context, request, highlight_fields=None):
     econn = context.get_elastic_connection()
     if econn is None:
         return generic_response(request, 501, 'Search is disabled.')
+    collection_names = str_to_list(request.GET.get('collections'))
+    def search(**kwargs):
+        if kwargs.get('facets'):
+            context.check_facets(kwargs['facets'], collection_names)
+        return context.basic_fulltext_search(collection_names=collection_names, **kwargs)
+    def export(**kwargs):
+        return context.export_search(collection_names=collection_names, **kwargs)
+    try:
+        return _search_response(context, request, search, export, dict(collections=collection_names), highlight_fields)
+    except ValueError, e:
+        return generic_response(request, 400, str(e))
+
+# Query params of collection_search() that aren't filters.
+COLLECTION_SEARCH_PARMS = ('q', 'sort', 'batch', 'per_batch', 'embed', 'fields', 'facets', 'scroll', 'cursor', 'export')
+
+def collection_search(context, request, highlight_fields=None):
+    # Any query params besides COLLECTION_SEARCH_PARMS are filters
+    # (see audrey.resources.collection.Collection.get_elastic_filter).
+    econn = context.get_elastic_connection()
+    if econn is None:
+        return generic_response(request, 501, 'Search is disabled.')
+    filters = dict((name, values) for (name, values) in request.GET.dict_of_lists().items() if name not in COLLECTION_SEARCH_PARMS)
+    def search(**kwargs):
+        return context.search(filters=filters, **kwargs)
+    def export(**kwargs):
+        return context.export_search(filters=filters, **kwargs)
+    try:
+        return _search_response(context, request, search, export, dict(filters=filters), highlight_fields)
+    except ValueError, e:
+        return generic_response(request, 400, str(e))
+
+def _search_response(context, request, search, export, summary, highlight_fields):
+    # Call search() (a function taking the params of
+    # Root.basic_fulltext_search() other than collection_names)
+    # and return a batch of its results like root_search().
+    #
+    # With the "scroll" param, the search is a scrolling one and the
+    # "next" link has an opaque "cursor" param for the following batch
+    # instead of a "batch" number, so that deep batches cost no more
+    # than the first.  Only the first batch of a scrolling search has
+    # facets (ElasticSearch doesn't return them when continuing a
+    # scroll), so "facets" is left out of the "_summary" of the
+    # batches after it.  With the "export" param, all the results of
+    # export() (like Root.export_search()) are streamed instead.
     embed = str_to_bool(request.GET.get('embed'), False)
     fields = None
     if embed:
@@ -327,40 +566,110 @@ def root_search(context, request, highlight_fields=None):
     (batch, per_batch, skip) = get_batch_parms(request)
     sort = request.GET.get('sort', None)
     q = request.GET.get('q', None)
-    collection_names = str_to_list(request.GET.get('collections'))
-    result = context.basic_fulltext_search(search_string=q, collection_names=collection_names, skip=skip, limit=per_batch, sort=sort, highlight_fields=highlight_fields)
-    total_items = result['total']
-    total_batches = total_items / per_batch
-    if total_items % per_batch: total_batches += 1
-
-    ret = {}
-    ret['_summary'] = dict(
-        total_items = total_items,
-        total_batches = total_batches,
-        batch = batch,
-        per_batch = per_batch,
-        sort = sort,
-        collections = collection_names,
-        q = q,
-    )
+    facets = str_to_list(request.GET.get('facets'))
     query_dict = {}
-    query_dict.update(request.GET)
-    ret['_links'] = dict(
-        self = dict(href=get_href(context, '@@search', query=query_dict)),
-    )
-    if batch > 1:
-        query_dict['batch'] = batch-1
-        ret['_links']['prev'] = dict(href=get_href(context, '@@search', query=query_dict))
-    if batch < total_batches:
-        query_dict['batch'] = batch+1
-        ret['_links']['next'] = dict(href=get_href(context, '@@search', query=query_dict))
+    query_dict.update(request.GET.dict_of_lists())
+    ret = {}
+    if str_to_bool(request.GET.get('export'), False):
+        result = export(search_string=q or '')
+        ret['_summary'] = dict(
+            total_items = result['total'],
+            q = q,
+        )
+        ret['_summary'].update(summary)
+        ret['_links'] = dict(
+            self = dict(href=get_href(context, '@@search', query=query_dict)),
+        )
+    else:
+        # Cursors are signed together with the context's path and the
+        # search's params (such as filters), so that one can't be used
+        # to continue any other scrolling search.
+        secret = request.registry.settings['search_cursor_secret']
+        binding = [resource_path(context), summary, q, sort]
+        cursor = request.GET.get('cursor')
+        if cursor is not None:
+            try:
+                (seen, per_batch, scroll_id) = _parse_search_cursor(cursor, secret, binding)
+            except ValueError:
+                return generic_response(request, 400, 'Invalid cursor.')
+            try:
+                result = find_root(context).continue_search(scroll_id, highlights=bool(highlight_fields))
+            except ElasticSearchException:
+                return generic_response(request, 410, 'The search has expired.')
+            batch = seen / per_batch + 1
+        else:
+            scroll = None
+            if str_to_bool(request.GET.get('scroll'), False):
+                scroll = resources.root.DEFAULT_SCROLL
+                (seen, batch, skip) = (0, 1, 0)
+            result = search(search_string=q or '', skip=skip, limit=per_batch, sort=sort, highlight_fields=highlight_fields, facets=facets, scroll=scroll)
+        total_items = result['total']
+        total_batches = total_items / per_batch
+        if total_items % per_batch: total_batches += 1
+
+        ret['_summary'] = dict(
+            total_items = total_items,
+            total_batches = total_batches,
+            batch = batch,
+            per_batch = per_batch,
+            sort = sort,
+            q = q,
+        )
+        ret['_summary'].update(summary)
+        if facets and cursor is None:
+            ret['_summary']['facets'] = result['facets']
+        ret['_links'] = dict(
+            self = dict(href=get_href(context, '@@search', query=query_dict)),
+        )
+        if result['scroll_id'] is not None:
+            if seen + per_batch < total_items:
+                for name in ('batch', 'scroll'):
+                    query_dict.pop(name, None)
+                query_dict['cursor'] = _make_search_cursor(seen + per_batch, per_batch, result['scroll_id'], secret, binding)
+                ret['_links']['next'] = dict(href=get_href(context, '@@search', query=query_dict))
+        else:
+            if batch > 1:
+                query_dict['batch'] = batch-1
+                ret['_links']['prev'] = dict(href=get_href(context, '@@search', query=query_dict))
+            if batch < total_batches:
+                query_dict['batch'] = batch+1
+                ret['_links']['next'] = dict(href=get_href(context, '@@search', query=query_dict))
 
     if item_handler.get_property() == '_embedded':
         ret['_embedded'] = {}
-    ret[item_handler.get_property()]['item'] = [item_handler.handle_item(obj, request) for obj in result['items']]
+    # A generator, so that the renderer can stream the items.
+    ret[item_handler.get_property()]['item'] = (item_handler.handle_item(obj, request) for obj in result['items'])
     request.response.content_type = 'application/hal+json'
     return ret
 
+def _make_search_cursor(seen, per_batch, scroll_id, secret, binding):
+    # Return an opaque "cursor" param for the batch of a scrolling
+    # search after the first ``seen`` results, with an HMAC of it and
+    # binding (JSON-serializable data identifying the search) keyed by
+    # secret.
+    payload = base64.urlsafe_b64encode('%d,%d,%s' % (seen, per_batch, scroll_id))
+    return '%s.%s' % (payload, _sign_search_cursor(payload, secret, binding))
+
+def _sign_search_cursor(payload, secret, binding):
+    msg = json.dumps([payload, binding], sort_keys=True)
+    return hmac.new(str(secret), msg, hashlib.sha256).hexdigest()
+
+def _parse_search_cursor(cursor, secret, binding):
+    # Return the (seen, per_batch, scroll_id) of a cursor made by
+    # _make_search_cursor() with the same secret and binding, or
+    # raise ValueError.
+    try:
+        (payload, signature) = str(cursor).rsplit('.', 1)
+        if not hmac.compare_digest(signature, _sign_search_cursor(payload, secret, binding)):
+            raise ValueError
+        (seen, per_batch, scroll_id) = base64.urlsafe_b64decode(payload).split(',', 2)
+        (seen, per_batch) = (int(seen), int(per_batch))
+    except (TypeError, ValueError, UnicodeError):
+        raise ValueError("Invalid cursor: %r" % cursor)
+    if seen < 0 or per_batch < 1 or not scroll_id:
+        raise ValueError("Invalid cursor: %r" % cursor)
+    return (seen, per_batch, scroll_id)
+
 def collection_get(context, request, spec=None):
     embed = str_to_bool(request.GET.get('embed'), False)
     fields = None
@@ -373,7 +682,7 @@ def collection_get(context, request, spec=None):
     (batch, per_batch, skip) = get_batch_parms(request)
     sort_string = request.GET.get('sort', None)
     mongo_sort = sortutil.sort_string_to_mongo(sort_string)
-    result = context.get_children_and_total(spec=spec, sort=mongo_sort, skip=skip, limit=per_batch, fields=fields)
+    result = context.get_children_and_total(spec=spec, sort=mongo_sort, skip=skip, limit=per_batch, fields=fields, lazy=True)
     total_items = result['total']
     total_batches = total_items / per_batch
     if total_items % per_batch: total_batches += 1
@@ -405,6 +714,9 @@ def collection_get(context, request, spec=None):
     ret['_links']['audrey:schema'] = [dict(name=x, href=get_href(context, '@@schema', x)) for x in context.get_object_types()]
     if isinstance(context, resources.collection.NamingCollection):
         ret['_links']['audrey:rename'] = dict(href=get_href(context, '@@rename'))
+    ret['_links']['audrey:import'] = dict(href=get_href(context, '@@import'))
+    if context.get_elastic_connection() is not None:
+        ret['_links']['search'] = dict(href=get_href(context, '@@search')+"?q={q}{&embed,fields,sort,per_batch,facets,scroll,export}", templated=True)
     if batch > 1:
         query_dict['batch'] = batch-1
         ret['_links']['prev'] = dict(href=get_href(context, query=query_dict))
@@ -414,7 +726,9 @@ def collection_get(context, request, spec=None):
 
     if item_handler.get_property() == '_embedded':
         ret['_embedded'] = {}
-    ret[item_handler.get_property()]['item'] = [item_handler.handle_item(obj, request) for obj in result['items']]
+    # A generator, so that the renderer can stream the items
+    # as they're loaded from Mongo.
+    ret[item_handler.get_property()]['item'] = (item_handler.handle_item(obj, request) for obj in result['items'])
 
     request.response.content_type = 'application/hal+json'
     return ret
@@ -431,32 +745,128 @@ def collection_post(context, request, __name__=None):
     # key containing a dictionary mapping field names to error messages.
     # Possible failure statuses:
     # 400 Bad Request: _object_type missing or invalid, or validation failed.
+    (obj, error, errors) = construct_object(context, request, request.json_body)
+    if error:
+        if errors:
+            return generic_response(request, 400, error, errors=errors)
+        return generic_response(request, 400, error)
+    if __name__: obj.__name__ = __name__
+    try:
+        # We just validated the schema, so no need to do it again.
+        context.add_child(obj, validate_schema=False)
+    except Veto, e:
+        return generic_response(request, 400, str(e))
+
+    request.response.location = request.resource_url(obj)
+    # FIXME: Should the body contain a representation of the object?
+    return generic_response(request, 201)
+
+def construct_object(context, request, json_body):
+    # Construct a new (unsaved) object for the collection context from
+    # a JSON document with the object's schema values and _object_type.
+    # Returns a tuple (obj, error, errors).
+    # On success, error and errors are None.  On failure, obj is None,
+    # error is an error message string, and errors is either None or
+    # (in the event of schema validation errors) a dictionary mapping
+    # field names to error messages.
+    if type(json_body) is not dict:
+        return (None, 'Request body must be a JSON object.', None)
     object_class = None
-    json_body = request.json_body
     _object_type = json_body.get('_object_type', None)
+    if _object_type and not isinstance(_object_type, basestring):
+        return (None, 'Unsupported _object_type.', None)
     if _object_type:
         object_class = context.get_object_class(_object_type)
     else:
-        return generic_response(request, 400, 'Request is missing _object_type.')
+        return (None, 'Request is missing _object_type.', None)
     if object_class is None:
-        return generic_response(request, 400, 'Unsupported _object_type.')
+        return (None, 'Unsupported _object_type.', None)
 
     schema = object_class.get_class_schema(request=request)
     try:
         deserialized = schema.deserialize(json_body)
     except colander.Invalid, e:
-        return generic_response(request, 400, 'Validation failed.', errors=e.asdict())
-    obj = object_class(request, **deserialized)
-    if __name__: obj.__name__ = __name__
-    try:
-        # We just validated the schema, so no need to do it again.
-        context.add_child(obj, validate_schema=False)
-    except Veto, e:
-        return generic_response(request, 400, str(e))
-
-    request.response.location = request.resource_url(obj)
-    # FIXME: Should the body contain a representation of the object?
-    return generic_response(request, 201)
+        return (None, 'Validation failed.', e.asdict())
+    return (object_class(request, **deserialized), None, None)
+
+def collection_import(context, request):
+    # Create many new objects/resources from a request body in
+    # newline-delimited JSON format (one JSON document per line, like
+    # the request body for collection_post).  For a NamingCollection,
+    # each document should also have a "__name__" key (a string).
+    # The body is read, validated and saved in chunks (using bulk writes
+    # to Mongo and Elastic), so memory use doesn't depend on body size.
+    # The response is streamed, also as newline-delimited JSON:
+    # one document per non-blank line of the request, in order, with the
+    # keys "line" (line number), "status" (201 on success, else 400),
+    # and either "href" or "error" (and maybe "errors"; see collection_post).
+    # A final document has the key "summary" whose value has the
+    # keys "created" and "failed".
+    chunk_size = get_int_query_parm(request, 'chunk_size', IMPORT_CHUNK_SIZE)
+    if chunk_size < 1 or chunk_size > MAX_IMPORT_CHUNK_SIZE: chunk_size = IMPORT_CHUNK_SIZE
+    is_naming = isinstance(context, resources.collection.NamingCollection)
+    body_file = request.body_file
+
+    def import_chunk(chunk, counts):
+        # chunk is a list of (line number, obj, error, errors) tuples.
+        # Yields a JSON result line for each tuple.
+        objs = [obj for (line, obj, error, errors) in chunk if obj is not None]
+        add_errors = iter(objs and context.add_children(objs, validate_schema=False) or [])
+        for (line, obj, error, errors) in chunk:
+            if obj is not None:
+                error = add_errors.next()
+            if error:
+                result = dict(line=line, status=400, error=error)
+                if errors: result['errors'] = errors
+                counts['failed'] += 1
+            else:
+                result = dict(line=line, status=201, href=request.resource_url(obj))
+                counts['created'] += 1
+            yield json.dumps(result) + '\n'
+
+    def results():
+        counts = dict(created=0, failed=0)
+        chunk = []
+        for (line_num, line) in enumerate(_iter_lines(body_file), 1):
+            if not line.strip(): continue
+            try:
+                json_body = json.loads(line)
+            except ValueError:
+                chunk.append((line_num, None, 'Invalid JSON.', None))
+            else:
+                (obj, error, errors) = construct_object(context, request, json_body)
+                if obj is not None and is_naming:
+                    name = json_body.get('__name__')
+                    if name is None or isinstance(name, basestring):
+                        obj.__name__ = name
+                    else:
+                        (obj, error) = (None, '__name__ must be a string.')
+                chunk.append((line_num, obj, error, errors))
+            if len(chunk) >= chunk_size:
+                for result in import_chunk(chunk, counts):
+                    yield result
+                chunk = []
+        for result in import_chunk(chunk, counts):
+            yield result
+        yield json.dumps(dict(summary=counts)) + '\n'
+
+    response = request.response
+    response.content_type = 'application/x-ndjson'
+    response.app_iter = results()
+    return response
+
+def _iter_lines(fileobj, blocksize=64*1024):
+    # Yield the lines of fileobj, reading it in blocks.
+    pending = ''
+    while True:
+        block = fileobj.read(blocksize)
+        if not block: break
+        lines = (pending + block).split('\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line
+    if pending:
+        yield pending
 
 def collection_schema(context, request):
     # Serve a JSON Schema for an object_type (specified as first subpath item).
@@ -485,6 +895,12 @@ def notfound_put(request):
 def notfound_default(request):
     return HTTPNotFound()
 
+def commit_error(context, request):
+    # Some writes recorded by a unit of work failed when it was committed
+    # (see audrey.tweens.unit_of_work_tween_factory).  Typically this is
+    # due to a name that's already in use.
+    return generic_response(request, 409, str(context))
+
 def get_int_query_parm(request, name, default=None):
     try:
         return int(request.GET[name])
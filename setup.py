@@ -8,6 +8,7 @@ CHANGES = open(os.path.join(here, 'CHANGES.txt')).read()
 
 requires = [
     'colander',
+    'msgpack-python',
     'pyes',
     'pymongo',
     'pyramid',
@@ -45,6 +46,10 @@ setup(name='Audrey',
       main = audrey:main
       [pyramid.scaffold]
       audrey=audrey.scaffolds:AudreyStarterTemplate
+      [console_scripts]
+      audrey_htmlbench = audrey.scripts.htmlbench:main
+      audrey_outbox = audrey.scripts.outbox:main
+      audrey_reindex = audrey.scripts.reindex:main
       """,
       )
 